@@ -0,0 +1,198 @@
+"""
+准入控制：全局并发上限 + 有界等待队列 + 优先级通道
+
+- 同时执行的请求数不超过 max_concurrent，超出的请求进入所属通道的等待队列
+- 名额释放时按通道优先级（lanes 的顺序）唤醒下一个等待者，同一通道内先到先得
+- 队列已满，或排队超过 max_wait 秒的请求立即以 Overloaded 拒绝（上层返回 503 + Retry-After）
+- lane_limits 限制单个通道最多占用的名额数（如批量通道），为其他通道保留余量
+- lane_queue_limits 为单个通道设置独立的队列上限，该通道的等待者不计入全局 max_queue，
+  排队很久的批量请求不会占满其他通道的队列
+"""
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Deque, Dict, Optional, Sequence
+
+
+class Overloaded(Exception):
+    """服务繁忙，请求被拒绝"""
+
+    def __init__(self, lane: str, reason: str, retry_after: float):
+        super().__init__(f"服务繁忙（{reason}），请稍后重试")
+        self.lane = lane
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _LaneStats:
+    __slots__ = ("admitted", "rejected_full", "rejected_timeout", "wait_count", "wait_total", "wait_max")
+
+    def __init__(self):
+        self.admitted = 0
+        self.rejected_full = 0
+        self.rejected_timeout = 0
+        self.wait_count = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+
+class AdmissionController:
+    """按优先级通道排队的全局并发限制器"""
+
+    def __init__(
+        self,
+        max_concurrent: int = 32,
+        max_queue: int = 128,
+        max_wait: float = 5.0,
+        retry_after: float = 2.0,
+        lanes: Sequence[str] = ("interactive", "api"),
+        lane_limits: Optional[Dict[str, int]] = None,
+        lane_queue_limits: Optional[Dict[str, int]] = None
+    ):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.retry_after = retry_after
+        self.lanes = list(lanes)
+        self.lane_limits = dict(lane_limits or {})
+        self.lane_queue_limits = dict(lane_queue_limits or {})
+        self.active = 0
+        self._lane_active: Dict[str, int] = {lane: 0 for lane in self.lanes}
+        self._waiters: Dict[str, Deque[asyncio.Future]] = {lane: deque() for lane in self.lanes}
+        self._stats: Dict[str, _LaneStats] = {lane: _LaneStats() for lane in self.lanes}
+
+    def queued(self) -> int:
+        return sum(len(q) for q in self._waiters.values())
+
+    def _queue_full(self, lane: str) -> bool:
+        """lane 的等待队列是否已满：有独立上限的通道只看自己，其余通道共享 max_queue"""
+        limit = self.lane_queue_limits.get(lane)
+        if limit is not None:
+            return len(self._waiters[lane]) >= limit
+        shared = sum(len(q) for name, q in self._waiters.items() if name not in self.lane_queue_limits)
+        return shared >= self.max_queue
+
+    async def acquire(self, lane: str, max_wait: Optional[float] = None) -> Callable[[], None]:
+        """
+        获取一个执行名额，返回释放函数（可重复调用，只生效一次）
+
+        max_wait 覆盖默认的最长排队时间（如批量请求可以等得更久）。
+        名额不足且无法排队或排队超时时抛出 Overloaded。
+        """
+        stats = self._stats[lane]
+        start = time.monotonic()
+        if self.active < self.max_concurrent and self._under_limit(lane) and not self._has_waiters_ahead(lane):
+            self.active += 1
+            self._lane_active[lane] += 1
+        else:
+            if self._queue_full(lane):
+                stats.rejected_full += 1
+                raise Overloaded(lane, "等待队列已满", self.retry_after)
+            await self._wait(lane, self.max_wait if max_wait is None else max_wait)
+            self._record_wait(stats, time.monotonic() - start)
+        stats.admitted += 1
+
+        released = False
+
+        def release():
+            nonlocal released
+            if not released:
+                released = True
+                self._release(lane)
+
+        return release
+
+    @asynccontextmanager
+    async def slot(self, lane: str, max_wait: Optional[float] = None):
+        """async with 形式的 acquire / release"""
+        release = await self.acquire(lane, max_wait)
+        try:
+            yield
+        finally:
+            release()
+
+    def _has_waiters_ahead(self, lane: str) -> bool:
+        """同优先级或更高优先级的通道中是否已有等待者（保证先到先得）"""
+        for name in self.lanes:
+            if self._waiters[name]:
+                return True
+            if name == lane:
+                return False
+        return False
+
+    def _under_limit(self, lane: str) -> bool:
+        limit = self.lane_limits.get(lane)
+        return limit is None or self._lane_active[lane] < limit
+
+    async def _wait(self, lane: str, max_wait: float):
+        future = asyncio.get_running_loop().create_future()
+        queue = self._waiters[lane]
+        queue.append(future)
+        try:
+            done, _ = await asyncio.wait({future}, timeout=max_wait)
+        except asyncio.CancelledError:
+            # 等待中被取消（客户端断开）：已经拿到名额则归还，否则退出队列
+            if future.done() and not future.cancelled():
+                self._release(lane)
+            else:
+                self._discard(queue, future)
+            raise
+        if not done:
+            self._discard(queue, future)
+            self._stats[lane].rejected_timeout += 1
+            raise Overloaded(lane, f"排队超过 {max_wait:g} 秒", self.retry_after)
+
+    @staticmethod
+    def _discard(queue: Deque[asyncio.Future], future: asyncio.Future):
+        future.cancel()
+        try:
+            queue.remove(future)
+        except ValueError:
+            pass
+
+    def _release(self, lane: str):
+        """归还名额：直接移交给优先级最高、且未达到通道上限的等待者"""
+        self._lane_active[lane] -= 1
+        for name in self.lanes:
+            if not self._under_limit(name):
+                continue
+            queue = self._waiters[name]
+            while queue:
+                future = queue.popleft()
+                if not future.done():
+                    future.set_result(None)
+                    self._lane_active[name] += 1
+                    return
+        self.active -= 1
+
+    @staticmethod
+    def _record_wait(stats: _LaneStats, seconds: float):
+        stats.wait_count += 1
+        stats.wait_total += seconds
+        stats.wait_max = max(stats.wait_max, seconds)
+
+    def stats(self) -> Dict[str, Any]:
+        """返回并发、队列深度和每个通道的等待时间统计"""
+        return {
+            "active": self.active,
+            "max_concurrent": self.max_concurrent,
+            "queued": self.queued(),
+            "max_queue": self.max_queue,
+            "max_wait": self.max_wait,
+            "lanes": {
+                lane: {
+                    "active": self._lane_active[lane],
+                    "limit": self.lane_limits.get(lane),
+                    "queue_limit": self.lane_queue_limits.get(lane),
+                    "queued": len(self._waiters[lane]),
+                    "admitted": s.admitted,
+                    "rejected_full": s.rejected_full,
+                    "rejected_timeout": s.rejected_timeout,
+                    "waited": s.wait_count,
+                    "wait_avg": round(s.wait_total / s.wait_count, 4) if s.wait_count else 0.0,
+                    "wait_max": round(s.wait_max, 4)
+                }
+                for lane, s in self._stats.items()
+            }
+        }
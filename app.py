@@ -13,7 +13,12 @@ import urllib.parse
 import json
 from pathlib import Path
 from typing import Optional
+import asyncio
 import logging
+import requests
+
+from resilience import Resilience, CircuitOpenError, RETRYABLE_STATUSES
+from compression import CompressionMiddleware
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -30,6 +35,15 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Gzip/brotli responses for clients that accept them; gzip/deflate request bodies are decompressed
+if os.getenv('COMPRESSION_ENABLED', 'true').lower() in ('1', 'true', 'yes'):
+    app.add_middleware(
+        CompressionMiddleware,
+        minimum_size=int(os.getenv('COMPRESSION_MIN_SIZE', 1024)),
+        gzip_level=int(os.getenv('COMPRESSION_GZIP_LEVEL', 6)),
+        max_request_size=int(os.getenv('REQUEST_MAX_DECOMPRESSED_SIZE', 32 * 1024 * 1024)),
+    )
+
 # Load API credentials from environment variables
 API_BASE_URL = os.getenv('AI_BUILDER_BASE_URL', 'https://space.ai-builders.com/backend')
 API_KEY = os.getenv('AI_BUILDER_API_KEY', '')
@@ -40,6 +54,41 @@ if not API_KEY:
 logger.info(f"API Base URL: {API_BASE_URL}")
 logger.info(f"API Key present: {bool(API_KEY)}")
 
+# Retries with jittered backoff and a circuit breaker per upstream endpoint
+upstream_resilience = Resilience(
+    # Only connection failures (including connect timeouts) are retried; a read timeout may mean the
+    # upstream is still processing the POST, so it only counts as a breaker failure
+    transient_errors=(requests.exceptions.ConnectionError,),
+    max_attempts=int(os.getenv('UPSTREAM_RETRY_ATTEMPTS', 3)),
+    failure_threshold=int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', 5)),
+    recovery_timeout=float(os.getenv('CIRCUIT_RECOVERY_TIMEOUT', 30)),
+    max_elapsed=float(os.getenv('UPSTREAM_RETRY_MAX_ELAPSED', 30))
+)
+
+
+def _post_with_resilience(endpoint: str, url: str, **kwargs) -> requests.Response:
+    """POST to the upstream API, retrying transient failures (runs in a worker thread)"""
+    def send():
+        response = requests.post(url, **kwargs)
+        if response.status_code in RETRYABLE_STATUSES:
+            response.raise_for_status()
+        return response
+
+    try:
+        return upstream_resilience.call_sync(endpoint, send)
+    except requests.exceptions.HTTPError as e:
+        # Retries exhausted: pass the upstream error response through unchanged
+        return e.response
+
+
+def _circuit_open_response(e: CircuitOpenError) -> JSONResponse:
+    return JSONResponse(
+        content={"error": str(e)},
+        status_code=503,
+        headers={"Retry-After": str(max(1, int(e.retry_after)))}
+    )
+
+
 # Serve static files
 static_dir = Path(__file__).parent
 if (static_dir / "index.html").exists():
@@ -61,7 +110,8 @@ async def health_check():
     return {
         "status": "healthy",
         "api_base_url": API_BASE_URL,
-        "api_key_configured": bool(API_KEY)
+        "api_key_configured": bool(API_KEY),
+        "upstream": upstream_resilience.stats()
     }
 
 
@@ -81,8 +131,6 @@ async def proxy_transcriptions(
     
     try:
         # Use requests library for better multipart handling
-        import requests
-        
         # Prepare form data
         files = {}
         data = {}
@@ -104,7 +152,10 @@ async def proxy_transcriptions(
             'Authorization': f'Bearer {API_KEY}'
         }
         
-        response = requests.post(api_url, files=files, data=data, headers=headers, timeout=60)
+        response = await asyncio.to_thread(
+            _post_with_resilience, "transcriptions", api_url,
+            files=files, data=data, headers=headers, timeout=60
+        )
         
         logger.info(f"API Response: {response.status_code}")
         
@@ -113,6 +164,9 @@ async def proxy_transcriptions(
             status_code=response.status_code
         )
             
+    except CircuitOpenError as e:
+        logger.warning(f"Failing fast: {str(e)}")
+        return _circuit_open_response(e)
     except requests.exceptions.RequestException as e:
         logger.error(f"Request error: {str(e)}", exc_info=True)
         return JSONResponse(
@@ -139,15 +193,15 @@ async def proxy_chat_completions(request: Request):
         logger.info(f"Proxying chat completion request to: {api_url}")
         logger.info(f"Model: {request_data.get('model', 'unknown')}")
         
-        # Use requests library for better error handling
-        import requests
-        
         headers = {
             'Authorization': f'Bearer {API_KEY}',
             'Content-Type': 'application/json'
         }
         
-        response = requests.post(api_url, data=body, headers=headers, timeout=60)
+        response = await asyncio.to_thread(
+            _post_with_resilience, "chat", api_url,
+            data=body, headers=headers, timeout=60
+        )
         
         logger.info(f"API Response: {response.status_code}")
         
@@ -156,6 +210,9 @@ async def proxy_chat_completions(request: Request):
             status_code=response.status_code
         )
             
+    except CircuitOpenError as e:
+        logger.warning(f"Failing fast: {str(e)}")
+        return _circuit_open_response(e)
     except requests.exceptions.RequestException as e:
         logger.error(f"Request error: {str(e)}", exc_info=True)
         return JSONResponse(
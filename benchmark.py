@@ -0,0 +1,286 @@
+"""
+并发压测：按场景文件向 /v1/chat/completions、/api/chat、/search 发请求，统计吞吐、延迟分位数、首字节时间和错误率
+
+用法：
+    python benchmark.py benchmarks/search_needed.json benchmarks/no_search.json -c 16 -n 200
+    python benchmark.py benchmarks/*.json --rate 5 --duration 60 --output results/run.json
+    python benchmark.py benchmarks/*.json --compare results/baseline.json
+
+- 默认是闭环模式：-c 个 worker 各自循环发请求，共 -n 个（或持续 --duration 秒）
+- --rate 指定到达速率（请求/秒）时为开环模式：按泊松过程（--arrival uniform 为等间隔）到达，
+  最多 -c 个并发；延迟从计划到达时间算起，服务变慢时排队时间也计入延迟（避免协调遗漏）
+- 场景文件格式见 benchmarks/README.md；流式请求的首字节时间为收到第一个响应体 chunk 的时间
+- --output 写出 JSON 结果（含 git 提交、参数和每个场景的统计），--compare 与之前的结果对比 p50/p95/吞吐
+
+配合 mock_upstream.py 可以在不消耗上游配额的情况下测量服务自身的开销。
+"""
+import argparse
+import asyncio
+import glob
+import itertools
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+
+def load_scenario(path: str) -> Dict[str, Any]:
+    """读取场景文件，展开 history 配置生成的长对话历史"""
+    with open(path, "r", encoding="utf-8") as f:
+        scenario = json.load(f)
+    scenario.setdefault("name", os.path.splitext(os.path.basename(path))[0])
+    scenario.setdefault("endpoint", "/v1/chat/completions")
+    if not scenario.get("payloads"):
+        raise ValueError(f"场景 {path} 缺少 payloads")
+
+    history = scenario.get("history")
+    if history:
+        turns, chars = int(history.get("turns", 20)), int(history.get("chars", 400))
+        filler = ("这是一段用于压测的历史对话内容。" * (chars // 16 + 1))[:chars]
+        messages = [
+            {"role": "user" if i % 2 == 0 else "assistant", "content": f"[{i}] {filler}"}
+            for i in range(turns * 2)
+        ]
+        for payload in scenario["payloads"]:
+            payload["messages"] = messages + payload.get("messages", [])
+    return scenario
+
+
+def percentile(sorted_values: List[float], p: float) -> Optional[float]:
+    """线性插值的分位数（输入需已排序）"""
+    if not sorted_values:
+        return None
+    k = (len(sorted_values) - 1) * p / 100
+    low = int(k)
+    high = min(low + 1, len(sorted_values) - 1)
+    return sorted_values[low] + (sorted_values[high] - sorted_values[low]) * (k - low)
+
+
+class Result:
+    """单个请求的结果"""
+
+    __slots__ = ("status", "latency", "ttfb", "error")
+
+    def __init__(self, status: int, latency: float, ttfb: Optional[float], error: Optional[str]):
+        self.status = status
+        self.latency = latency
+        self.ttfb = ttfb
+        self.error = error
+
+
+async def send(client: httpx.AsyncClient, scenario: Dict[str, Any], payload: Dict[str, Any], started: float) -> Result:
+    """发送一个请求并读完响应体；流式响应中的 error 事件也算作错误"""
+    ttfb = None
+    status = 0
+    try:
+        async with client.stream("POST", scenario["endpoint"], json=payload) as response:
+            status = response.status_code
+            tail = b""
+            async for chunk in response.aiter_bytes():
+                if ttfb is None:
+                    ttfb = time.perf_counter() - started
+                tail = (tail + chunk)[-4096:]
+                if payload.get("stream") and b'data: {"error"' in tail:
+                    return Result(status, time.perf_counter() - started, ttfb, "stream_error")
+        error = f"http_{status}" if status >= 400 else None
+        return Result(status, time.perf_counter() - started, ttfb, error)
+    except httpx.HTTPError as e:
+        return Result(status, time.perf_counter() - started, ttfb, type(e).__name__)
+
+
+async def run_scenario(client: httpx.AsyncClient, scenario: Dict[str, Any], args: argparse.Namespace) -> Dict[str, Any]:
+    payloads = itertools.cycle(scenario["payloads"])
+    results: List[Result] = []
+    deadline = time.perf_counter() + args.duration if args.duration else None
+
+    def more(issued: int) -> bool:
+        if deadline is not None:
+            return time.perf_counter() < deadline
+        return issued < args.requests
+
+    for payload in itertools.islice(payloads, args.warmup):
+        await send(client, scenario, payload, time.perf_counter())
+
+    start = time.perf_counter()
+    if args.rate:
+        # 开环：按计划时间发出，信号量限制最大并发
+        semaphore = asyncio.Semaphore(args.concurrency)
+        rng = random.Random(args.seed)
+        tasks = []
+
+        async def fire(payload: Dict[str, Any], scheduled: float):
+            async with semaphore:
+                results.append(await send(client, scenario, payload, scheduled))
+
+        next_at = start
+        issued = 0
+        while more(issued):
+            delay = next_at - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(fire(next(payloads), next_at)))
+            issued += 1
+            next_at += rng.expovariate(args.rate) if args.arrival == "poisson" else 1 / args.rate
+        await asyncio.gather(*tasks)
+    else:
+        # 闭环：每个 worker 收到响应后立即发下一个
+        issued = 0
+
+        async def worker():
+            nonlocal issued
+            while more(issued):
+                issued += 1
+                results.append(await send(client, scenario, next(payloads), time.perf_counter()))
+
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - start
+    return summarize(scenario, results, elapsed)
+
+
+def summarize(scenario: Dict[str, Any], results: List[Result], elapsed: float) -> Dict[str, Any]:
+    latencies = sorted(r.latency for r in results)
+    ok_latencies = sorted(r.latency for r in results if r.error is None)
+    ttfbs = sorted(r.ttfb for r in results if r.ttfb is not None)
+    errors: Dict[str, int] = {}
+    statuses: Dict[str, int] = {}
+    for r in results:
+        statuses[str(r.status)] = statuses.get(str(r.status), 0) + 1
+        if r.error is not None:
+            errors[r.error] = errors.get(r.error, 0) + 1
+
+    def dist(values: List[float]) -> Dict[str, Optional[float]]:
+        return {
+            "p50": percentile(values, 50),
+            "p95": percentile(values, 95),
+            "p99": percentile(values, 99),
+            "mean": sum(values) / len(values) if values else None,
+            "max": values[-1] if values else None
+        }
+
+    return {
+        "scenario": scenario["name"],
+        "endpoint": scenario["endpoint"],
+        "requests": len(results),
+        "elapsed": elapsed,
+        "throughput": len(results) / elapsed if elapsed > 0 else 0.0,
+        "error_rate": sum(errors.values()) / len(results) if results else 0.0,
+        "errors": errors,
+        "status_codes": statuses,
+        "latency": dist(latencies),
+        "latency_ok": dist(ok_latencies),
+        "ttfb": dist(ttfbs)
+    }
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _ms(value: Optional[float]) -> str:
+    return f"{value * 1000:8.1f}" if value is not None else f"{'-':>8}"
+
+
+def print_table(summaries: List[Dict[str, Any]]):
+    print(f"{'scenario':<20} {'reqs':>6} {'rps':>8} {'err%':>6} {'p50ms':>8} {'p95ms':>8} {'p99ms':>8} {'ttfb50':>8} {'ttfb95':>8}")
+    for s in summaries:
+        print(
+            f"{s['scenario']:<20} {s['requests']:>6} {s['throughput']:>8.2f} {s['error_rate'] * 100:>6.1f} "
+            f"{_ms(s['latency']['p50'])} {_ms(s['latency']['p95'])} {_ms(s['latency']['p99'])} "
+            f"{_ms(s['ttfb']['p50'])} {_ms(s['ttfb']['p95'])}"
+        )
+
+
+def print_comparison(summaries: List[Dict[str, Any]], baseline_path: str):
+    """与之前写出的结果文件按场景名对比"""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = {s["scenario"]: s for s in json.load(f)["scenarios"]}
+
+    def delta(new: Optional[float], old: Optional[float]) -> str:
+        if not new or not old:
+            return f"{'-':>8}"
+        return f"{(new - old) / old * 100:+7.1f}%"
+
+    print(f"\n对比 {baseline_path}:")
+    print(f"{'scenario':<20} {'rps':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'err%':>8}")
+    for s in summaries:
+        old = baseline.get(s["scenario"])
+        if old is None:
+            print(f"{s['scenario']:<20} (基线中没有该场景)")
+            continue
+        print(
+            f"{s['scenario']:<20} {delta(s['throughput'], old['throughput'])} "
+            f"{delta(s['latency']['p50'], old['latency']['p50'])} {delta(s['latency']['p95'], old['latency']['p95'])} "
+            f"{delta(s['latency']['p99'], old['latency']['p99'])} "
+            f"{(s['error_rate'] - old['error_rate']) * 100:+7.1f}pp"
+        )
+
+
+async def main(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    paths = [p for pattern in args.scenarios for p in sorted(glob.glob(pattern)) or [pattern]]
+    scenarios = [load_scenario(p) for p in paths]
+    headers = {"Authorization": f"Bearer {args.api_key}"} if args.api_key else {}
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.base_url, headers=headers, limits=limits, timeout=args.timeout) as client:
+        summaries = []
+        for scenario in scenarios:
+            print(f"运行场景 {scenario['name']} -> {scenario['endpoint']} ...", file=sys.stderr)
+            summaries.append(await run_scenario(client, scenario, args))
+    return summaries
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="聊天接口并发压测")
+    parser.add_argument("scenarios", nargs="+", help="场景文件（支持通配符）")
+    parser.add_argument("--base-url", default=os.getenv("BENCHMARK_BASE_URL", "http://127.0.0.1:8000"))
+    parser.add_argument("--api-key", default=os.getenv("BENCHMARK_API_KEY"), help="作为 Authorization: Bearer 发送")
+    parser.add_argument("-c", "--concurrency", type=int, default=8, help="并发数（开环模式下为最大并发）")
+    parser.add_argument("-n", "--requests", type=int, default=50, help="每个场景的请求数")
+    parser.add_argument("-d", "--duration", type=float, default=0, help="每个场景持续的秒数（设置后忽略 -n）")
+    parser.add_argument("-r", "--rate", type=float, default=0, help="到达速率（请求/秒），0 为闭环模式")
+    parser.add_argument("--arrival", choices=("poisson", "uniform"), default="poisson")
+    parser.add_argument("--warmup", type=int, default=0, help="每个场景正式计时前的预热请求数")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--label", default=None, help="写入结果文件的标签")
+    parser.add_argument("-o", "--output", default=None, help="结果 JSON 文件路径")
+    parser.add_argument("--compare", default=None, help="与之前的结果 JSON 对比")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    started_at = time.time()
+    summaries = asyncio.run(main(args))
+    print_table(summaries)
+    if args.compare:
+        print_comparison(summaries, args.compare)
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({
+                "label": args.label,
+                "commit": _git_commit(),
+                "started_at": started_at,
+                "base_url": args.base_url,
+                "params": {
+                    "concurrency": args.concurrency,
+                    "requests": args.requests,
+                    "duration": args.duration,
+                    "rate": args.rate,
+                    "arrival": args.arrival,
+                    "warmup": args.warmup
+                },
+                "scenarios": summaries
+            }, f, ensure_ascii=False, indent=2)
+        print(f"\n结果已写入 {args.output}", file=sys.stderr)
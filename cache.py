@@ -0,0 +1,124 @@
+"""
+进程内 TTL + LRU 缓存
+
+- 条目在 ttl 秒内为新鲜数据，直接返回
+- 超过 ttl 但仍在 stale_ttl 宽限期内时，先返回旧值，同时在后台刷新（stale-while-revalidate）
+- 超过宽限期视为未命中，同步重新获取
+- 条目数超过 max_size 时按最近最少使用淘汰
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+
+class TTLCache:
+    """支持 stale-while-revalidate 的异步 TTL + LRU 缓存"""
+
+    def __init__(self, name: str, max_size: int = 1024, ttl: float = 300.0, stale_ttl: float = 600.0):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        # key -> (存入时间, 值)
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._refreshing: Set[Hashable] = set()
+        self._refresh_tasks: Set[asyncio.Task] = set()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.refresh_errors = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """仅在有新鲜条目时返回值，不触发获取，也不计入命中统计"""
+        entry = self._entries.get(key)
+        if entry is None or time.monotonic() - entry[0] >= self.ttl:
+            return None
+        return entry[1]
+
+    def set(self, key: Hashable, value: Any):
+        """写入条目，必要时按 LRU 淘汰"""
+        self._entries[key] = (time.monotonic(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def get_or_fetch(self, key: Hashable, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        从缓存读取，未命中时调用 fetch 获取并写入缓存
+
+        fetch 抛出的异常会直接向上传播，失败结果不会被缓存。
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            age = time.monotonic() - entry[0]
+            if age < self.ttl:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return entry[1]
+            if age < self.ttl + self.stale_ttl:
+                self.stale_hits += 1
+                self._entries.move_to_end(key)
+                self._schedule_refresh(key, fetch)
+                return entry[1]
+            # 超过宽限期，丢弃旧值
+            del self._entries[key]
+
+        self.misses += 1
+        value = await fetch()
+        self.set(key, value)
+        return value
+
+    def _schedule_refresh(self, key: Hashable, fetch: Callable[[], Awaitable[Any]]):
+        """在后台刷新过期条目，同一个 key 同时只刷新一次"""
+        if key in self._refreshing:
+            return
+        self._refreshing.add(key)
+
+        async def refresh():
+            try:
+                self.set(key, await fetch())
+            except Exception as e:
+                self.refresh_errors += 1
+                logger.warning(f"缓存 {self.name} 后台刷新失败: {str(e)}")
+            finally:
+                self._refreshing.discard(key)
+
+        task = asyncio.create_task(refresh())
+        self._refresh_tasks.add(task)
+        task.add_done_callback(self._refresh_tasks.discard)
+
+    def clear(self):
+        """清空所有条目（统计计数保留）"""
+        self._entries.clear()
+
+    async def close(self):
+        """取消仍在进行的后台刷新"""
+        for task in list(self._refresh_tasks):
+            task.cancel()
+        if self._refresh_tasks:
+            await asyncio.gather(*self._refresh_tasks, return_exceptions=True)
+
+    def stats(self) -> Dict[str, Any]:
+        """返回命中/未命中等统计信息"""
+        lookups = self.hits + self.stale_hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "stale_ttl": self.stale_ttl,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "refresh_errors": self.refresh_errors,
+            "hit_rate": round((self.hits + self.stale_hits) / lookups, 4) if lookups else 0.0
+        }
@@ -0,0 +1,353 @@
+"""
+HTTP 压缩：请求体解压、响应压缩协商，以及上游请求体压缩
+
+- CompressionMiddleware（纯 ASGI 中间件）
+  - 请求：Content-Encoding 为 gzip / deflate / br 的请求体在交给应用前解压，解压后超过 max_request_size 返回 413，
+    数据损坏返回 400，不支持的编码返回 415
+  - 响应：按 Accept-Encoding 选择 br（安装了 brotli 包时）或 gzip。一次性返回的响应体小于 minimum_size 时不压缩；
+    流式响应（SSE、NDJSON 等）每个 chunk 压缩后立即 flush，客户端仍能逐条收到事件
+  - 已经带 Content-Encoding 的响应（如预压缩的静态资源）、不可压缩的类型、HEAD / 204 / 304 原样透传
+- UpstreamBodyCompressor：大于阈值的上游请求体用 gzip 压缩；上游返回 415 时自动停用，
+  UpstreamCompressionTransport 把触发 415 的请求以未压缩的请求体重发一次
+"""
+import gzip
+import json
+import logging
+import zlib
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import httpx
+
+from static_assets import accepted_encodings
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - 取决于运行环境
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+_DECOMPRESS_ERRORS = (zlib.error, EOFError) + ((brotli.error,) if brotli is not None else ())
+
+_COMPRESSIBLE_PREFIXES = (
+    "text/", "application/json", "application/x-ndjson", "application/javascript",
+    "application/xml", "application/problem+json", "image/svg+xml"
+)
+
+
+def _header(headers: List[Tuple[bytes, bytes]], name: bytes) -> Optional[str]:
+    for key, value in headers:
+        if key.lower() == name:
+            return value.decode("latin-1")
+    return None
+
+
+class _Decompressor:
+    """增量解压，累计输出超过 limit 时抛出 OverflowError"""
+
+    def __init__(self, encoding: str, limit: int):
+        self.limit = limit
+        self.size = 0
+        if encoding == "br":
+            self._obj = brotli.Decompressor()
+            self._decompress = self._obj.process
+        else:
+            # gzip 头（wbits=31）或 zlib 头（deflate，wbits=15）
+            self._obj = zlib.decompressobj(31 if encoding == "gzip" else 15)
+            self._decompress = lambda data: self._obj.decompress(data, self.limit - self.size + 1)
+
+    def feed(self, data: bytes) -> bytes:
+        out = self._decompress(data)
+        self.size += len(out)
+        if self.size > self.limit:
+            raise OverflowError
+        return out
+
+    def close(self):
+        """检查压缩流是否完整（被截断时抛出 EOFError）"""
+        finished = self._obj.is_finished() if hasattr(self._obj, "is_finished") else self._obj.eof
+        if not finished:
+            raise EOFError("压缩数据不完整")
+
+
+class _StreamCompressor:
+    """按 chunk flush 的压缩器（gzip 或 br）"""
+
+    def __init__(self, encoding: str, gzip_level: int, brotli_quality: int):
+        self.encoding = encoding
+        if encoding == "br":
+            self._obj = brotli.Compressor(quality=brotli_quality)
+        else:
+            self._obj = zlib.compressobj(gzip_level, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes, flush: bool) -> bytes:
+        if self.encoding == "br":
+            out = self._obj.process(data)
+            return out + (self._obj.flush() if flush else b"")
+        return self._obj.compress(data) + (self._obj.flush(zlib.Z_SYNC_FLUSH) if flush else b"")
+
+    def finish(self) -> bytes:
+        return self._obj.finish() if self.encoding == "br" else self._obj.flush(zlib.Z_FINISH)
+
+
+class CompressionStats:
+    """压缩中间件的计数（中间件实例由框架创建，统计对象由调用方传入以便读取）"""
+
+    def __init__(self):
+        self.requests_decompressed = 0
+        self.request_bytes_in = 0
+        self.request_bytes_out = 0
+        self.responses_compressed = 0
+        self.response_bytes_in = 0
+        self.response_bytes_out = 0
+
+    def stats(self) -> Dict[str, int]:
+        return dict(vars(self))
+
+
+class CompressionMiddleware:
+    """请求体解压 + 响应压缩的 ASGI 中间件"""
+
+    def __init__(
+        self,
+        app: Callable,
+        minimum_size: int = 1024,
+        gzip_level: int = 6,
+        brotli_quality: int = 4,
+        max_request_size: int = 32 * 1024 * 1024,
+        compress_responses: bool = True,
+        decompress_requests: bool = True,
+        stats: Optional[CompressionStats] = None
+    ):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.max_request_size = max_request_size
+        self.compress_responses = compress_responses
+        self.decompress_requests = decompress_requests
+        self.stats = stats if stats is not None else CompressionStats()
+
+    async def __call__(self, scope: Dict[str, Any], receive: Callable, send: Callable):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = scope["headers"]
+        content_encoding = (_header(headers, b"content-encoding") or "identity").strip().lower()
+        if self.decompress_requests and content_encoding != "identity":
+            result = await self._decompress_request(scope, receive, send, content_encoding)
+            if result is None:
+                return
+            scope, receive = result
+
+        if self.compress_responses and scope["method"] != "HEAD":
+            encoding = self._choose_encoding(_header(headers, b"accept-encoding") or "")
+            if encoding is not None:
+                send = self._compressing_send(send, encoding)
+        await self.app(scope, receive, send)
+
+    def _choose_encoding(self, accept_encoding: str) -> Optional[str]:
+        accepted = accepted_encodings(accept_encoding)
+        if brotli is not None and accepted.get("br", 0.0) > 0:
+            return "br"
+        if accepted.get("gzip", accepted.get("*", 0.0)) > 0:
+            return "gzip"
+        return None
+
+    async def _decompress_request(self, scope, receive, send, encoding: str):
+        """读完并解压请求体，返回替换后的 (scope, receive)；出错时直接返回错误响应并返回 None"""
+        if encoding not in ("gzip", "deflate", "br") or (encoding == "br" and brotli is None):
+            await _plain_response(send, 415, f"不支持的 Content-Encoding: {encoding}")
+            return None
+
+        decompressor = _Decompressor(encoding, self.max_request_size)
+        chunks = []
+        compressed_size = 0
+        try:
+            while True:
+                message = await receive()
+                if message["type"] == "http.disconnect":
+                    return None
+                body = message.get("body", b"")
+                compressed_size += len(body)
+                chunks.append(decompressor.feed(body))
+                if not message.get("more_body", False):
+                    break
+            decompressor.close()
+        except OverflowError:
+            await _plain_response(send, 413, "解压后的请求体过大")
+            return None
+        except _DECOMPRESS_ERRORS:
+            await _plain_response(send, 400, "请求体解压失败")
+            return None
+
+        body = b"".join(chunks)
+        self.stats.requests_decompressed += 1
+        self.stats.request_bytes_in += compressed_size
+        self.stats.request_bytes_out += len(body)
+
+        new_headers = [(k, v) for k, v in scope["headers"] if k.lower() not in (b"content-encoding", b"content-length")]
+        new_headers.append((b"content-length", str(len(body)).encode("latin-1")))
+        scope = {**scope, "headers": new_headers}
+        delivered = False
+
+        async def replay_receive():
+            nonlocal delivered
+            if not delivered:
+                delivered = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        return scope, replay_receive
+
+    def _compressing_send(self, send: Callable, encoding: str) -> Callable:
+        """包装 send：按响应头和第一个 body 消息决定是否压缩"""
+        start_message: Optional[Dict[str, Any]] = None
+        compressor: Optional[_StreamCompressor] = None
+        passthrough = False
+
+        async def wrapped(message: Dict[str, Any]):
+            nonlocal start_message, compressor, passthrough
+            if message["type"] == "http.response.start":
+                response_headers = message.get("headers", [])
+                content_type = (_header(response_headers, b"content-type") or "").lower()
+                passthrough = (
+                    message["status"] in (204, 304)
+                    or _header(response_headers, b"content-encoding") is not None
+                    or not content_type.startswith(_COMPRESSIBLE_PREFIXES)
+                )
+                if passthrough:
+                    await send(message)
+                else:
+                    # 等到第一个 body 消息再决定（需要知道大小和是否流式）
+                    start_message = message
+                return
+            if message["type"] != "http.response.body" or passthrough:
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if start_message is not None:
+                start, start_message = start_message, None
+                if not more_body and len(body) < self.minimum_size:
+                    passthrough = True
+                    await send(start)
+                    await send(message)
+                    return
+                compressor = _StreamCompressor(encoding, self.gzip_level, self.brotli_quality)
+                response_headers = [
+                    (k, v) for k, v in start.get("headers", [])
+                    if k.lower() not in (b"content-length", b"content-encoding")
+                ]
+                response_headers.append((b"content-encoding", encoding.encode("latin-1")))
+                vary = _header(response_headers, b"vary")
+                if vary is None:
+                    response_headers.append((b"vary", b"Accept-Encoding"))
+                elif "accept-encoding" not in vary.lower():
+                    response_headers = [(k, v) for k, v in response_headers if k.lower() != b"vary"]
+                    response_headers.append((b"vary", f"{vary}, Accept-Encoding".encode("latin-1")))
+                if not more_body:
+                    compressed = compressor.compress(body, flush=False) + compressor.finish()
+                    response_headers.append((b"content-length", str(len(compressed)).encode("latin-1")))
+                    self._record(len(body), len(compressed))
+                    await send({**start, "headers": response_headers})
+                    await send({"type": "http.response.body", "body": compressed, "more_body": False})
+                    return
+                await send({**start, "headers": response_headers})
+                self.stats.responses_compressed += 1
+
+            # 流式响应：每个 chunk 立即 flush，保证 SSE 事件及时送达
+            if more_body:
+                out = compressor.compress(body, flush=True)
+            else:
+                out = compressor.compress(body, flush=False) + compressor.finish()
+            self.stats.response_bytes_in += len(body)
+            self.stats.response_bytes_out += len(out)
+            await send({"type": "http.response.body", "body": out, "more_body": more_body})
+
+        return wrapped
+
+    def _record(self, size_in: int, size_out: int):
+        self.stats.responses_compressed += 1
+        self.stats.response_bytes_in += size_in
+        self.stats.response_bytes_out += size_out
+
+
+async def _plain_response(send: Callable, status: int, detail: str):
+    body = json.dumps({"detail": detail}, ensure_ascii=False).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode("latin-1"))]
+    })
+    await send({"type": "http.response.body", "body": body, "more_body": False})
+
+
+class UpstreamBodyCompressor:
+    """上游请求体 gzip 压缩；上游不支持（返回 415）时自动停用"""
+
+    def __init__(self, enabled: bool = False, minimum_size: int = 4096, level: int = 5):
+        self.enabled = enabled
+        self.minimum_size = minimum_size
+        self.level = level
+        self.compressed = 0
+        self.resent = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def encode(self, body: bytes) -> Tuple[bytes, Dict[str, str]]:
+        """返回 (请求体, 额外的请求头)；未启用或小于阈值时原样返回"""
+        if not self.enabled or len(body) < self.minimum_size:
+            return body, {}
+        compressed = gzip.compress(body, compresslevel=self.level, mtime=0)
+        self.compressed += 1
+        self.bytes_in += len(body)
+        self.bytes_out += len(compressed)
+        return compressed, {"Content-Encoding": "gzip"}
+
+    def observe(self, status_code: int, request_headers: Any) -> bool:
+        """根据上游响应判断是否支持压缩的请求体；返回 True 表示该请求因压缩被拒绝，应以未压缩的请求体重发"""
+        if status_code != 415 or request_headers.get("content-encoding") != "gzip":
+            return False
+        if self.enabled:
+            self.enabled = False
+            logger.warning("上游不接受 gzip 请求体（415），已停用上游请求体压缩")
+        self.resent += 1
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "minimum_size": self.minimum_size,
+            "compressed": self.compressed,
+            "resent": self.resent,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out
+        }
+
+
+class UpstreamCompressionTransport(httpx.AsyncBaseTransport):
+    """包装上游 transport：gzip 请求体被拒绝（415）时停用压缩，并把该请求以未压缩的请求体重发一次"""
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, compressor: UpstreamBodyCompressor):
+        self.transport = transport
+        self.compressor = compressor
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        response = await self.transport.handle_async_request(request)
+        if not self.compressor.observe(response.status_code, request.headers):
+            return response
+        await response.aclose()
+        headers = request.headers.copy()
+        del headers["Content-Encoding"]
+        del headers["Content-Length"]
+        retry = httpx.Request(
+            request.method, request.url, headers=headers,
+            content=gzip.decompress(request.content), extensions=request.extensions
+        )
+        return await self.transport.handle_async_request(retry)
+
+    async def aclose(self):
+        await self.transport.aclose()
@@ -0,0 +1,248 @@
+"""
+长对话的上下文压缩
+
+按 token 预算控制发送给上游的消息：
+1. 未超预算时原样发送
+2. 超预算时先截断过期的工具输出（最近一批工具结果保持完整）
+3. 仍超预算时，把较早的对话轮次交给廉价模型压缩成摘要，只保留最近几轮原文
+4. 仍超预算时（轮次太少、摘要失败或最近几轮本身就超预算），从最早的消息开始截断较长的文本内容；
+   system 消息（包括摘要）和最后一条消息不截断，只剩这些时仍可能超预算，记入 over_budget
+
+摘要按对话前缀的哈希缓存；对话继续增长时，会在已缓存的最长前缀摘要基础上增量总结，
+而不是每轮从头重新总结。
+"""
+import asyncio
+import hashlib
+import json
+import logging
+from functools import lru_cache
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# 每条消息的固定开销（role、分隔符等）
+MESSAGE_OVERHEAD_TOKENS = 4
+
+SUMMARY_PREFIX = "以下是之前对话的摘要（较早的消息已被压缩）：\n"
+TRUNCATED_SUFFIX = "…（内容已截断）"
+# 截断后每条消息至少保留的字符数
+TRUNCATE_MIN_CHARS = 200
+
+
+@lru_cache(maxsize=4096)
+def estimate_text_tokens(text: str) -> int:
+    """
+    粗略估算文本的 token 数：中日韩字符按 1 个 token 计，其余字符按 4 个字符 1 个 token 计
+
+    结果按文本缓存，同一条消息在每一轮中只计算一次。
+    """
+    cjk = sum(1 for ch in text if "⺀" <= ch <= "鿿" or "가" <= ch <= "힯" or "＀" <= ch <= "￯")
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def message_text(message: Dict[str, Any]) -> str:
+    """提取消息中参与计费的文本（content + tool_calls）"""
+    content = message.get("content")
+    if content is None:
+        text = ""
+    elif isinstance(content, str):
+        text = content
+    elif isinstance(content, list):
+        text = "".join(part.get("text", "") for part in content if isinstance(part, dict))
+    else:
+        text = json.dumps(content, ensure_ascii=False)
+    if message.get("tool_calls"):
+        text += json.dumps(message["tool_calls"], ensure_ascii=False)
+    return text
+
+
+def estimate_message_tokens(message: Dict[str, Any]) -> int:
+    """估算单条消息的 token 数"""
+    return MESSAGE_OVERHEAD_TOKENS + estimate_text_tokens(message_text(message))
+
+
+def estimate_tokens(messages: List[Dict[str, Any]]) -> int:
+    """估算消息列表的 token 总数"""
+    return sum(estimate_message_tokens(m) for m in messages)
+
+
+def _hash_messages(previous: str, messages: List[Dict[str, Any]]) -> str:
+    """在前一个前缀哈希的基础上追加消息，得到新前缀的哈希"""
+    payload = json.dumps(messages, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256((previous + payload).encode("utf-8")).hexdigest()
+
+
+class ContextManager:
+    """按 token 预算压缩对话上下文"""
+
+    def __init__(
+        self,
+        summarize: Callable[[Optional[str], List[Dict[str, Any]]], Awaitable[str]],
+        budget_tokens: int = 24000,
+        keep_recent_turns: int = 4,
+        tool_output_max_chars: int = 2000,
+        summary_cache_size: int = 512,
+        summary_cache_ttl: float = 3600.0
+    ):
+        """
+        summarize(previous_summary, messages) 返回新的摘要文本：
+        previous_summary 为更短前缀的已有摘要（可能为 None），messages 为需要并入摘要的新消息。
+        """
+        self.summarize = summarize
+        self.budget_tokens = budget_tokens
+        self.keep_recent_turns = max(1, keep_recent_turns)
+        self.tool_output_max_chars = tool_output_max_chars
+        self.summary_cache = TTLCache("context_summary", max_size=summary_cache_size, ttl=summary_cache_ttl, stale_ttl=0)
+        self.compactions = 0
+        self.tool_outputs_trimmed = 0
+        self.summary_errors = 0
+        self.summaries_skipped = 0
+        self.messages_truncated = 0
+        self.over_budget = 0
+
+    async def compact(self, messages: List[Dict[str, Any]], timeout: Optional[float] = None) -> List[Dict[str, Any]]:
+        """
+        返回不超过预算的消息列表，不修改传入的列表
+
+        system 消息和最后一条消息本身超预算时无法满足，此时返回尽量截断后的列表并计入 over_budget。
+        timeout: 生成摘要的最长时间（秒）；不大于 0 时跳过摘要，超时时视为摘要失败
+        """
+        if estimate_tokens(messages) <= self.budget_tokens:
+            return messages
+
+        self.compactions += 1
+        return self._truncate_to_budget(await self._compact(messages, timeout))
+
+    async def _compact(self, messages: List[Dict[str, Any]], timeout: Optional[float]) -> List[Dict[str, Any]]:
+        """截断过期的工具输出，仍超预算时总结较早的轮次"""
+        messages = self._trim_stale_tool_outputs(messages)
+        if estimate_tokens(messages) <= self.budget_tokens:
+            return messages
+
+        system_messages, turns = self._split_turns(messages)
+        if len(turns) <= self.keep_recent_turns:
+            return messages
+
+        if timeout is not None and timeout <= 0:
+            self.summaries_skipped += 1
+            logger.info("剩余时间不足，跳过上下文摘要")
+            return messages
+
+        old_turns = turns[:-self.keep_recent_turns]
+        recent = [m for turn in turns[-self.keep_recent_turns:] for m in turn]
+        try:
+            summary = await asyncio.wait_for(self._summarize_turns(old_turns), timeout)
+        except Exception as e:
+            self.summary_errors += 1
+            logger.warning(f"上下文摘要失败，发送截断工具输出后的完整上下文: {str(e)}")
+            return messages
+
+        return system_messages + [{"role": "system", "content": SUMMARY_PREFIX + summary}] + recent
+
+    def _truncate_to_budget(self, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """从最早的消息开始截断较长的文本内容，直到不超过预算（system 消息和最后一条消息保持完整）"""
+        over = estimate_tokens(messages) - self.budget_tokens
+        if over <= 0:
+            return messages
+        truncated = list(messages)
+        for i, m in enumerate(truncated[:-1]):
+            content = m.get("content")
+            if m.get("role") == "system" or not isinstance(content, str) or len(content) <= TRUNCATE_MIN_CHARS:
+                continue
+            tokens = estimate_text_tokens(content)
+            # 按 token 占比估算需要保留的字符数（扣除截断标记的 token，并为取整留出余量）
+            budget = tokens - over - estimate_text_tokens(TRUNCATED_SUFFIX)
+            keep = max(TRUNCATE_MIN_CHARS, int(len(content) * budget / tokens) - 4)
+            if keep >= len(content):
+                continue
+            truncated[i] = {**m, "content": content[:keep] + TRUNCATED_SUFFIX}
+            self.messages_truncated += 1
+            over = estimate_tokens(truncated) - self.budget_tokens
+            if over <= 0:
+                return truncated
+        self.over_budget += 1
+        logger.warning("上下文截断后仍超出预算约 %d 个 token", over)
+        return truncated
+
+    def _trim_stale_tool_outputs(self, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """截断除最近一批以外的工具输出"""
+        last_tool_call_idx = max(
+            (i for i, m in enumerate(messages) if m.get("role") == "assistant" and m.get("tool_calls")),
+            default=len(messages)
+        )
+        trimmed = []
+        for i, m in enumerate(messages):
+            content = m.get("content")
+            if (
+                i < last_tool_call_idx
+                and m.get("role") == "tool"
+                and isinstance(content, str)
+                and len(content) > self.tool_output_max_chars
+            ):
+                m = {**m, "content": content[:self.tool_output_max_chars] + "…（工具输出已截断）"}
+                self.tool_outputs_trimmed += 1
+            trimmed.append(m)
+        return trimmed
+
+    @staticmethod
+    def _split_turns(messages: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], List[List[Dict[str, Any]]]]:
+        """
+        拆分出开头的 system 消息和按 user 消息分隔的对话轮次
+
+        一轮包含一条 user 消息及其后的 assistant / tool 消息，保证 tool_calls 与工具结果不被拆开。
+        """
+        idx = 0
+        while idx < len(messages) and messages[idx].get("role") == "system":
+            idx += 1
+        system_messages = messages[:idx]
+
+        turns: List[List[Dict[str, Any]]] = []
+        for m in messages[idx:]:
+            if m.get("role") == "user" or not turns:
+                turns.append([])
+            turns[-1].append(m)
+        return system_messages, turns
+
+    async def _summarize_turns(self, turns: List[List[Dict[str, Any]]]) -> str:
+        """总结较早的轮次，优先复用已缓存的最长前缀摘要"""
+        prefix_hashes = []
+        current = ""
+        for turn in turns:
+            current = _hash_messages(current, turn)
+            prefix_hashes.append(current)
+
+        # 从最长前缀往回找已缓存的摘要
+        previous_summary = None
+        start = 0
+        for i in range(len(prefix_hashes) - 1, -1, -1):
+            cached = self.summary_cache.get(prefix_hashes[i])
+            if cached is not None:
+                previous_summary = cached
+                start = i + 1
+                break
+
+        if start == len(turns):
+            return previous_summary
+
+        new_messages = [m for turn in turns[start:] for m in turn]
+        return await self.summary_cache.get_or_fetch(
+            prefix_hashes[-1],
+            lambda: self.summarize(previous_summary, new_messages)
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        """返回压缩统计"""
+        token_cache = estimate_text_tokens.cache_info()
+        return {
+            "budget_tokens": self.budget_tokens,
+            "compactions": self.compactions,
+            "tool_outputs_trimmed": self.tool_outputs_trimmed,
+            "summary_errors": self.summary_errors,
+            "summaries_skipped": self.summaries_skipped,
+            "messages_truncated": self.messages_truncated,
+            "over_budget": self.over_budget,
+            "summary_cache": self.summary_cache.stats(),
+            "token_estimate_cache": {"hits": token_cache.hits, "misses": token_cache.misses, "size": token_cache.currsize}
+        }
@@ -0,0 +1,149 @@
+"""
+服务端会话存储：客户端只上传新消息，历史（包括工具调用消息）保存在服务端
+
+- 会话中的消息组成一棵树：每条消息记录父消息 ID，编辑或重新生成时从某个父消息分出新分支，
+  各分支共享公共前缀，不复制历史
+- 会话记录当前分支的末端（head）并缓存从根到 head 的消息列表；沿 head 追加时只需 O(1) 扩展缓存，
+  切换分支时才沿父指针重建
+- 会话数超过 max_conversations 时按最近最少使用淘汰，超过 ttl 秒未访问的会话视为过期
+"""
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional
+
+
+class ConversationLimitError(Exception):
+    """会话中的消息数超过上限"""
+
+
+class _Node:
+    __slots__ = ("id", "parent_id", "message", "created_at")
+
+    def __init__(self, parent_id: Optional[str], message: Dict[str, Any]):
+        self.id = f"msg_{uuid.uuid4().hex[:16]}"
+        self.parent_id = parent_id
+        self.message = message
+        self.created_at = time.time()
+
+
+class Conversation:
+    """一个会话的消息树"""
+
+    def __init__(self, max_messages: int):
+        self.id = f"conv_{uuid.uuid4().hex}"
+        self.max_messages = max_messages
+        self.created_at = time.time()
+        self.nodes: Dict[str, _Node] = {}
+        self.head: Optional[str] = None
+        # 从根到 head 的节点（按顺序）
+        self._path: List[_Node] = []
+
+    def has(self, node_id: str) -> bool:
+        return node_id in self.nodes
+
+    def role_of(self, node_id: str) -> str:
+        return self.nodes[node_id].message.get("role", "")
+
+    def parent_of(self, node_id: str) -> Optional[str]:
+        return self.nodes[node_id].parent_id
+
+    def checkout(self, node_id: Optional[str]):
+        """把 head 移到 node_id（None 表示空会话的根），必要时重建路径缓存"""
+        if node_id == self.head:
+            return
+        path: List[_Node] = []
+        current = node_id
+        while current is not None:
+            node = self.nodes[current]
+            path.append(node)
+            current = node.parent_id
+        path.reverse()
+        self._path = path
+        self.head = node_id
+
+    def messages(self) -> List[Dict[str, Any]]:
+        """从根到 head 的消息列表"""
+        return [node.message for node in self._path]
+
+    def append(self, parent_id: Optional[str], messages: Iterable[Dict[str, Any]]) -> List[str]:
+        """在 parent_id 之后依次追加消息（parent_id 不是 head 时形成新分支），head 移到最后一条，返回新消息的 ID"""
+        messages = list(messages)
+        if len(self.nodes) + len(messages) > self.max_messages:
+            raise ConversationLimitError(f"会话消息数超过上限 {self.max_messages}")
+        self.checkout(parent_id)
+        ids = []
+        for message in messages:
+            node = _Node(self.head, message)
+            self.nodes[node.id] = node
+            self._path.append(node)
+            self.head = node.id
+            ids.append(node.id)
+        return ids
+
+    def branches(self) -> int:
+        """叶子节点数（即分支数）"""
+        parents = {node.parent_id for node in self.nodes.values()}
+        return sum(1 for node_id in self.nodes if node_id not in parents)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "head": self.head,
+            "created_at": self.created_at,
+            "branches": self.branches(),
+            "messages": [
+                {"id": node.id, "parent_id": node.parent_id, **node.message}
+                for node in self._path
+            ]
+        }
+
+
+class ConversationStore:
+    """有界的会话存储（LRU + 空闲过期）"""
+
+    def __init__(self, max_conversations: int = 1000, max_messages: int = 2000, ttl: float = 86400.0):
+        self.max_conversations = max_conversations
+        self.max_messages = max_messages
+        self.ttl = ttl
+        # 会话 ID -> (最后访问时间, 会话)
+        self._conversations: "OrderedDict[str, tuple]" = OrderedDict()
+        self.created = 0
+        self.evicted = 0
+        self.expired = 0
+
+    def create(self) -> Conversation:
+        conversation = Conversation(self.max_messages)
+        self._conversations[conversation.id] = (time.monotonic(), conversation)
+        self.created += 1
+        while len(self._conversations) > self.max_conversations:
+            self._conversations.popitem(last=False)
+            self.evicted += 1
+        return conversation
+
+    def get(self, conversation_id: str) -> Optional[Conversation]:
+        """获取会话并刷新访问时间；不存在或已过期时返回 None"""
+        entry = self._conversations.get(conversation_id)
+        if entry is None:
+            return None
+        now = time.monotonic()
+        if now - entry[0] >= self.ttl:
+            del self._conversations[conversation_id]
+            self.expired += 1
+            return None
+        self._conversations[conversation_id] = (now, entry[1])
+        self._conversations.move_to_end(conversation_id)
+        return entry[1]
+
+    def delete(self, conversation_id: str) -> bool:
+        return self._conversations.pop(conversation_id, None) is not None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "conversations": len(self._conversations),
+            "max_conversations": self.max_conversations,
+            "messages": sum(len(c.nodes) for _, c in self._conversations.values()),
+            "created": self.created,
+            "evicted": self.evicted,
+            "expired": self.expired
+        }
@@ -0,0 +1,71 @@
+"""
+JSON 编解码：安装了 orjson 时使用 orjson，否则回退到标准库 json
+
+- dumps() 返回 UTF-8 bytes（不转义非 ASCII 字符，与 json.dumps(..., ensure_ascii=False) 等价）
+- RawJSON 是带原始响应字节的 dict：上游响应未被修改时可以直接把原始字节返回给客户端，
+  省去一次序列化；持有方应把它视为只读
+- JSONBytesResponse 用于路由直接返回，跳过 FastAPI 默认的 jsonable_encoder + json.dumps
+"""
+import json
+from typing import Any, Optional, Union
+
+from fastapi.responses import Response
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - 取决于运行环境
+    orjson = None
+
+BACKEND = "orjson" if orjson is not None else "json"
+
+
+def dumps(obj: Any) -> bytes:
+    """序列化为 UTF-8 bytes"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            # orjson 不支持的类型（如超过 64 位的整数）回退到标准库
+            pass
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def dumps_str(obj: Any) -> str:
+    """序列化为 str（用于 SSE 事件和工具消息的 content）"""
+    if isinstance(obj, RawJSON) and obj.raw is not None:
+        return obj.raw.decode("utf-8")
+    return dumps(obj).decode("utf-8")
+
+
+def loads(data: Union[bytes, bytearray, memoryview, str]) -> Any:
+    """解析 JSON，格式错误时抛出 ValueError"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class RawJSON(dict):
+    """解析后的 JSON 对象，同时保留上游返回的原始字节"""
+
+    __slots__ = ("raw",)
+
+    def __init__(self, data: dict, raw: Optional[bytes] = None):
+        super().__init__(data)
+        self.raw = raw
+
+
+def parse_response(content: bytes) -> Any:
+    """解析上游响应体；结果为对象时包装成 RawJSON 以便原样返回"""
+    data = loads(content)
+    return RawJSON(data, content) if isinstance(data, dict) else data
+
+
+class JSONBytesResponse(Response):
+    """用 dumps() 渲染的 JSON 响应；RawJSON 直接写出原始字节"""
+
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        if isinstance(content, RawJSON) and content.raw is not None:
+            return content.raw
+        return dumps(content)
@@ -0,0 +1,136 @@
+"""
+基于延迟分位数的请求对冲（hedged requests）
+
+按 key（例如模型名）维护滚动的延迟样本。一次调用耗时超过配置的分位数（如 p95）后，
+再发出一个相同的请求，取先完成的结果并取消另一个。
+对冲比例有硬上限（最近若干次调用中被对冲的占比），避免在上游整体变慢时把负载翻倍。
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class LatencyTracker:
+    """按 key 保存最近 window 个延迟样本，计算分位数"""
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.window = window
+        self.min_samples = min_samples
+        self._samples: Dict[str, Deque[float]] = {}
+
+    def record(self, key: str, seconds: float):
+        self._samples.setdefault(key, deque(maxlen=self.window)).append(seconds)
+
+    def percentile(self, key: str, p: float) -> Optional[float]:
+        """返回第 p 百分位的延迟；样本不足 min_samples 时返回 None"""
+        samples = self._samples.get(key)
+        if not samples or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        idx = min(len(ordered) - 1, max(0, int(round(p / 100.0 * len(ordered))) - 1))
+        return ordered[idx]
+
+    def keys(self):
+        return list(self._samples.keys())
+
+
+class Hedger:
+    """对慢调用发起对冲请求"""
+
+    def __init__(
+        self,
+        percentile: float = 95.0,
+        window: int = 200,
+        min_samples: int = 20,
+        max_hedge_ratio: float = 0.1,
+        min_delay: float = 0.5
+    ):
+        self.percentile = percentile
+        self.max_hedge_ratio = max_hedge_ratio
+        self.min_delay = min_delay
+        self.tracker = LatencyTracker(window=window, min_samples=min_samples)
+        # 最近 window 次调用是否被对冲，用于限制对冲比例
+        self._recent: Deque[bool] = deque(maxlen=window)
+        self._recent_hedged = 0
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.hedges_suppressed = 0
+
+    def _hedge_allowed(self) -> bool:
+        if not self._recent:
+            return False
+        return (self._recent_hedged + 1) / len(self._recent) <= self.max_hedge_ratio
+
+    def _remember(self, hedged: bool):
+        if len(self._recent) == self._recent.maxlen and self._recent[0]:
+            self._recent_hedged -= 1
+        self._recent.append(hedged)
+        if hedged:
+            self._recent_hedged += 1
+
+    async def run(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """执行 fn；超过 key 的延迟分位数仍未完成时，在比例上限内再发起一次并取先完成者"""
+        self.calls += 1
+        start = time.monotonic()
+        delay = self.tracker.percentile(key, self.percentile)
+        if delay is None:
+            result = await fn()
+            self._remember(False)
+            self.tracker.record(key, time.monotonic() - start)
+            return result
+
+        primary = asyncio.create_task(fn())
+        tasks = {primary}
+        hedged = False
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=max(delay, self.min_delay))
+            if not done:
+                if self._hedge_allowed():
+                    hedged = True
+                    self.hedges += 1
+                    logger.info(f"上游调用 {key} 超过 p{self.percentile:g}（{delay:.2f} 秒），发起对冲请求")
+                    tasks.add(asyncio.create_task(fn()))
+                else:
+                    self.hedges_suppressed += 1
+
+            # 取第一个成功完成的结果；某个请求失败时继续等待另一个
+            error: Optional[BaseException] = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            self.hedge_wins += 1
+                        self.tracker.record(key, time.monotonic() - start)
+                        return task.result()
+                    error = error or task.exception()
+            raise error
+        finally:
+            self._remember(hedged)
+            for task in tasks:
+                task.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        """返回对冲统计和每个 key 的延迟分位数"""
+        return {
+            "percentile": self.percentile,
+            "max_hedge_ratio": self.max_hedge_ratio,
+            "calls": self.calls,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "hedges_suppressed": self.hedges_suppressed,
+            "recent_hedge_ratio": round(self._recent_hedged / len(self._recent), 4) if self._recent else 0.0,
+            "latency": {
+                key: {
+                    "p50": self.tracker.percentile(key, 50),
+                    "p95": self.tracker.percentile(key, 95),
+                    "p99": self.tracker.percentile(key, 99)
+                }
+                for key in self.tracker.keys()
+            }
+        }
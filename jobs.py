@@ -0,0 +1,216 @@
+"""
+异步任务：提交后立即返回任务 ID，由固定数量的后台 worker 执行，结果保存在有界的内存存储中
+
+- 提交的任务进入有界队列，最多 workers 个同时执行；队列已满时以 Overloaded 拒绝
+- 执行过程中的进度事件（轮次开始、工具调用等）追加到任务的事件列表，watch() 按游标逐个返回，
+  任务结束后返回最后的状态事件后停止
+- 已结束的任务保留 ttl 秒；任务数超过 max_jobs 时先淘汰最早结束的任务（未结束的任务不会被淘汰）
+"""
+import asyncio
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+from admission import Overloaded
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+_FINISHED = (SUCCEEDED, FAILED, CANCELLED)
+
+
+class Job:
+    """一个异步任务的状态、进度事件和结果"""
+
+    __slots__ = ("id", "payload", "status", "created_at", "started_at", "finished_at", "events", "result", "error", "_waiters")
+
+    def __init__(self, payload: Dict[str, Any]):
+        self.id = f"job_{uuid.uuid4().hex}"
+        self.payload = payload
+        self.status = QUEUED
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.events: List[Dict[str, Any]] = []
+        self.result: Any = None
+        self.error: Optional[Dict[str, Any]] = None
+        self._waiters: List[asyncio.Future] = []
+
+    @property
+    def finished(self) -> bool:
+        return self.status in _FINISHED
+
+    async def emit(self, event: Dict[str, Any]):
+        """追加一个进度事件（可直接作为 Agentic Loop 的事件回调）"""
+        self.events.append({**event, "time": time.time()})
+        self._notify()
+
+    def _set_status(self, status: str):
+        self.status = status
+        now = time.time()
+        if status == RUNNING:
+            self.started_at = now
+        elif status in _FINISHED:
+            self.finished_at = now
+        self.events.append({"type": "status", "status": status, "time": now})
+        self._notify()
+
+    def _notify(self):
+        for waiter in self._waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self._waiters.clear()
+
+    async def wait_for_change(self):
+        """等待下一个事件或状态变化"""
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        await waiter
+
+    def to_dict(self, include_result: bool = True) -> Dict[str, Any]:
+        data = {
+            "id": self.id,
+            "object": "job",
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "progress": [e for e in self.events if e["type"] != "status"],
+            "error": self.error
+        }
+        if include_result:
+            data["result"] = self.result
+        return data
+
+
+class JobManager:
+    """有界任务队列 + 后台 worker 池 + 带 TTL 的任务存储"""
+
+    def __init__(
+        self,
+        run: Callable[[Job], Awaitable[Any]],
+        workers: int = 4,
+        max_queue: int = 100,
+        max_jobs: int = 1000,
+        ttl: float = 3600.0,
+        retry_after: float = 5.0,
+        describe_error: Callable[[Exception], Dict[str, Any]] = lambda e: {"message": str(e)}
+    ):
+        self.run = run
+        self.workers = workers
+        self.max_queue = max_queue
+        self.max_jobs = max(max_jobs, workers + max_queue)
+        self.ttl = ttl
+        self.retry_after = retry_after
+        self.describe_error = describe_error
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self.submitted = 0
+        self.rejected = 0
+        self.evicted = 0
+        self.completed: Dict[str, int] = {SUCCEEDED: 0, FAILED: 0, CANCELLED: 0}
+
+    def start(self):
+        """启动 worker（重复调用无效）"""
+        if not self._tasks:
+            self._queue = asyncio.Queue(maxsize=self.max_queue)
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        """停止 worker：执行中的任务标记为 cancelled，排队中的任务随之丢弃"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for job in self._jobs.values():
+            if not job.finished:
+                self._finish(job, CANCELLED)
+
+    def submit(self, payload: Dict[str, Any]) -> Job:
+        """提交任务并立即返回；队列已满时抛出 Overloaded"""
+        self.start()
+        self._evict(reserve=1)
+        job = Job(payload)
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise Overloaded("jobs", "任务队列已满", self.retry_after)
+        self._jobs[job.id] = job
+        self.submitted += 1
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        self._evict()
+        return self._jobs.get(job_id)
+
+    async def watch(self, job: Job) -> AsyncIterator[Dict[str, Any]]:
+        """依次返回任务的全部事件（包括已发生的），任务结束后停止"""
+        cursor = 0
+        while True:
+            while cursor < len(job.events):
+                yield job.events[cursor]
+                cursor += 1
+            if job.finished:
+                return
+            await job.wait_for_change()
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            if job.finished:
+                continue
+            job._set_status(RUNNING)
+            try:
+                job.result = await self.run(job)
+                self._finish(job, SUCCEEDED)
+            except asyncio.CancelledError:
+                self._finish(job, CANCELLED)
+                raise
+            except Exception as e:
+                job.error = self.describe_error(e)
+                logger.warning("任务 %s 失败: %s", job.id, job.error.get("message"))
+                self._finish(job, FAILED)
+
+    def _finish(self, job: Job, status: str):
+        job._set_status(status)
+        self.completed[status] += 1
+
+    def _evict(self, reserve: int = 0):
+        """删除过期的已结束任务；加上 reserve 个新任务仍超过 max_jobs 时按结束时间从早到晚淘汰"""
+        now = time.time()
+        expired = [job_id for job_id, job in self._jobs.items() if job.finished and now - job.finished_at >= self.ttl]
+        overflow = len(self._jobs) - len(expired) - self.max_jobs + reserve
+        if overflow > 0:
+            finished = sorted(
+                (job for job in self._jobs.values() if job.finished and job.id not in expired),
+                key=lambda job: job.finished_at
+            )
+            expired.extend(job.id for job in finished[:overflow])
+        for job_id in expired:
+            del self._jobs[job_id]
+        self.evicted += len(expired)
+
+    def stats(self) -> Dict[str, Any]:
+        counts: Dict[str, int] = {}
+        for job in self._jobs.values():
+            counts[job.status] = counts.get(job.status, 0) + 1
+        return {
+            "workers": self.workers,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "max_queue": self.max_queue,
+            "stored": len(self._jobs),
+            "max_jobs": self.max_jobs,
+            "by_status": counts,
+            "submitted": self.submitted,
+            "rejected": self.rejected,
+            "evicted": self.evicted,
+            "completed": self.completed
+        }
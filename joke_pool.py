@@ -0,0 +1,117 @@
+"""
+后台预填充的笑话池
+
+后台生产者保持池中有 low_watermark ~ high_watermark 个新鲜条目：
+池深度低于低水位时唤醒生产者，一直补充到高水位。
+超过 max_age 的条目在取出时丢弃。
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class JokePool:
+    """有界的后台预填充池，取出操作只读内存"""
+
+    def __init__(
+        self,
+        fetch: Callable[[], Awaitable[Any]],
+        low_watermark: int = 3,
+        high_watermark: int = 10,
+        max_age: float = 3600.0,
+        retry_delay: float = 5.0
+    ):
+        self.fetch = fetch
+        self.low_watermark = low_watermark
+        self.high_watermark = max(high_watermark, low_watermark)
+        self.max_age = max_age
+        self.retry_delay = retry_delay
+        # (生成时间, 条目)
+        self._items: Deque[Tuple[float, Any]] = deque()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.served = 0
+        self.empty = 0
+        self.expired = 0
+        self.produced = 0
+        self.fetch_errors = 0
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def start(self):
+        """启动后台生产者"""
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._wakeup.set()
+            self._task = asyncio.create_task(self._producer())
+
+    async def stop(self):
+        """停止后台生产者"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def take(self) -> Optional[Any]:
+        """从池中取出一个新鲜条目，池为空时返回 None"""
+        now = time.monotonic()
+        item = None
+        while self._items:
+            created, candidate = self._items.popleft()
+            if now - created < self.max_age:
+                item = candidate
+                break
+            self.expired += 1
+
+        if item is None:
+            self.empty += 1
+        else:
+            self.served += 1
+        if len(self._items) < self.low_watermark:
+            self._wakeup.set()
+        return item
+
+    async def _producer(self):
+        """后台循环：低于低水位时补充到高水位"""
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            self._drop_expired()
+            while len(self._items) < self.high_watermark:
+                try:
+                    item = await self.fetch()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self.fetch_errors += 1
+                    logger.warning(f"笑话池补充失败: {str(e)}，{self.retry_delay} 秒后重试")
+                    await asyncio.sleep(self.retry_delay)
+                    continue
+                self._items.append((time.monotonic(), item))
+                self.produced += 1
+
+    def _drop_expired(self):
+        now = time.monotonic()
+        while self._items and now - self._items[0][0] >= self.max_age:
+            self._items.popleft()
+            self.expired += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """返回池深度和取用统计"""
+        return {
+            "depth": len(self._items),
+            "low_watermark": self.low_watermark,
+            "high_watermark": self.high_watermark,
+            "max_age": self.max_age,
+            "served": self.served,
+            "empty": self.empty,
+            "expired": self.expired,
+            "produced": self.produced,
+            "fetch_errors": self.fetch_errors,
+            "running": self._task is not None and not self._task.done()
+        }
@@ -1,27 +1,61 @@
 import os
-import json
 import logging
 import asyncio
-from typing import Optional, Dict, Any, List, Union
-from fastapi import FastAPI, HTTPException, Header, Body, Request
-from fastapi.responses import HTMLResponse, FileResponse
-from fastapi.staticfiles import StaticFiles
+from contextlib import asynccontextmanager
+import time
+import uuid
+from typing import Optional, Dict, Any, List, Union, AsyncIterator, Awaitable, Callable
+from fastapi import FastAPI, HTTPException, Header, Request
+from fastapi.responses import HTMLResponse, FileResponse, StreamingResponse, Response
 from pydantic import BaseModel, Field, field_validator
 from dotenv import load_dotenv
 import httpx
 import markdown
 
-# 配置日志
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S'
-)
-logger = logging.getLogger(__name__)
+from cache import TTLCache
+from joke_pool import JokePool
+from singleflight import SingleFlight, canonical_key
+from context_manager import ContextManager, message_text
+from tools import Tool, ToolRegistry
+from speculative_search import SearchSpeculator
+from hedging import Hedger
+from resilience import Resilience, CircuitOpenError
+from admission import AdmissionController, Overloaded
+from jobs import Job, JobManager
+from conversations import ConversationLimitError, ConversationStore
+from metrics import Registry, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from tracing import Span, Tracer, TraceExporter
+import structured_logging
+from structured_logging import setup_logging, verbose_logging
+import fastjson
+from fastjson import JSONBytesResponse
+from static_assets import AssetStore
+from routing import ModelRouter, ComplexityClassifier, RouteDecision
+from compression import CompressionMiddleware, CompressionStats, UpstreamBodyCompressor, UpstreamCompressionTransport
 
 # 加载环境变量
 load_dotenv()
 
+# 日志配置：JSON 行经有界队列由后台线程写出，格式化不在事件循环中进行
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_SAMPLING = os.getenv("LOG_SAMPLING", "")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# 全局开启工具调用的详细日志（单个请求也可以通过 verbose_logging 字段开启）
+LOG_TOOL_DETAILS = os.getenv("LOG_TOOL_DETAILS", "false").lower() in ("1", "true", "yes")
+
+
+def _log_context() -> Dict[str, Any]:
+    """日志入队时附带当前 trace_id，便于与 /debug/traces 关联"""
+    span = Tracer.current()
+    return {"trace_id": span.trace_id} if span is not None else {}
+
+
+setup_logging(LOG_LEVEL, LOG_FORMAT, LOG_SAMPLING, LOG_QUEUE_SIZE, context=_log_context)
+# httpx 每个上游请求一条 INFO 日志，耗时和状态已由 /metrics 和追踪记录
+logging.getLogger("httpx").setLevel(logging.WARNING)
+logger = logging.getLogger(__name__)
+
 # 从环境变量读取配置
 AI_BUILDER_API_KEY = os.getenv("AI_BUILDER_API_KEY")
 AI_BUILDER_BASE_URL = os.getenv("AI_BUILDER_BASE_URL", "https://space.ai-builders.com/backend")
@@ -29,12 +63,241 @@ AI_BUILDER_BASE_URL = os.getenv("AI_BUILDER_BASE_URL", "https://space.ai-builder
 if not AI_BUILDER_API_KEY:
     raise ValueError("AI_BUILDER_API_KEY 未在环境变量中设置，请检查 .env 文件")
 
+# 上游连接池配置
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "100"))
+UPSTREAM_MAX_KEEPALIVE = int(os.getenv("UPSTREAM_MAX_KEEPALIVE", "20"))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", "30"))
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "10"))
+UPSTREAM_READ_TIMEOUT = float(os.getenv("UPSTREAM_READ_TIMEOUT", "60"))
+UPSTREAM_WRITE_TIMEOUT = float(os.getenv("UPSTREAM_WRITE_TIMEOUT", "60"))
+UPSTREAM_POOL_TIMEOUT = float(os.getenv("UPSTREAM_POOL_TIMEOUT", "10"))
+UPSTREAM_HTTP2 = os.getenv("UPSTREAM_HTTP2", "false").lower() in ("1", "true", "yes")
+# 上游请求体 gzip 压缩（需要上游支持 Content-Encoding: gzip 的请求体，返回 415 时自动停用）
+UPSTREAM_REQUEST_COMPRESSION = os.getenv("UPSTREAM_REQUEST_COMPRESSION", "false").lower() in ("1", "true", "yes")
+UPSTREAM_COMPRESSION_MIN_SIZE = int(os.getenv("UPSTREAM_COMPRESSION_MIN_SIZE", "4096"))
+
+# 搜索结果缓存配置
+SEARCH_CACHE_ENABLED = os.getenv("SEARCH_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "300"))
+SEARCH_CACHE_STALE_TTL = float(os.getenv("SEARCH_CACHE_STALE_TTL", "600"))
+SEARCH_CACHE_MAX_SIZE = int(os.getenv("SEARCH_CACHE_MAX_SIZE", "1024"))
+# 多关键词搜索拆分后，同一请求内并发请求上游的关键词数上限
+SEARCH_FANOUT_CONCURRENCY = int(os.getenv("SEARCH_FANOUT_CONCURRENCY", "4"))
+
+# 合并并发中完全相同的上游请求（single-flight）
+SINGLEFLIGHT_ENABLED = os.getenv("SINGLEFLIGHT_ENABLED", "true").lower() in ("1", "true", "yes")
+
+# 上下文压缩配置（长对话超出预算时压缩较早的轮次）
+CONTEXT_COMPACTION_ENABLED = os.getenv("CONTEXT_COMPACTION_ENABLED", "true").lower() in ("1", "true", "yes")
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "24000"))
+CONTEXT_KEEP_RECENT_TURNS = int(os.getenv("CONTEXT_KEEP_RECENT_TURNS", "4"))
+CONTEXT_TOOL_OUTPUT_MAX_CHARS = int(os.getenv("CONTEXT_TOOL_OUTPUT_MAX_CHARS", "2000"))
+CONTEXT_SUMMARY_MODEL = os.getenv("CONTEXT_SUMMARY_MODEL", "grok-4-fast")
+
+# 工具执行配置
+SEARCH_TOOL_TIMEOUT = float(os.getenv("SEARCH_TOOL_TIMEOUT", "30"))
+SEARCH_TOOL_MAX_CONCURRENCY = int(os.getenv("SEARCH_TOOL_MAX_CONCURRENCY", "16"))
+# 同一轮内并行执行的工具调用数上限
+TOOL_ROUND_CONCURRENCY = int(os.getenv("TOOL_ROUND_CONCURRENCY", "4"))
+
+# Agentic Loop 轮数与截止时间配置
+AGENTIC_MAX_ROUNDS = int(os.getenv("AGENTIC_MAX_ROUNDS", "3"))
+AGENTIC_DEFAULT_DEADLINE = float(os.getenv("AGENTIC_DEFAULT_DEADLINE", "60"))
+AGENTIC_MAX_DEADLINE = float(os.getenv("AGENTIC_MAX_DEADLINE", "300"))
+# 轮次耗时的初始估计（秒），之后按实际耗时做指数加权移动平均
+AGENTIC_TOOL_ROUND_ESTIMATE = float(os.getenv("AGENTIC_TOOL_ROUND_ESTIMATE", "15"))
+AGENTIC_FINAL_ROUND_ESTIMATE = float(os.getenv("AGENTIC_FINAL_ROUND_ESTIMATE", "10"))
+
+# 推测性搜索预取（第一轮 LLM 调用期间根据用户消息预取搜索结果，请求体 speculative_search 可覆盖）
+SPECULATIVE_SEARCH_ENABLED = os.getenv("SPECULATIVE_SEARCH_ENABLED", "false").lower() in ("1", "true", "yes")
+SPECULATIVE_MAX_KEYWORDS = int(os.getenv("SPECULATIVE_MAX_KEYWORDS", "2"))
+
+# 对冲请求：chat completions 调用超过该模型延迟分位数时再发一次，取先完成者
+HEDGING_ENABLED = os.getenv("HEDGING_ENABLED", "false").lower() in ("1", "true", "yes")
+HEDGING_PERCENTILE = float(os.getenv("HEDGING_PERCENTILE", "95"))
+HEDGING_MAX_RATIO = float(os.getenv("HEDGING_MAX_RATIO", "0.1"))
+HEDGING_MIN_SAMPLES = int(os.getenv("HEDGING_MIN_SAMPLES", "20"))
+HEDGING_WINDOW = int(os.getenv("HEDGING_WINDOW", "200"))
+
+# 模型路由：请求未指定模型（或为 "auto"）时，简单/简短的问题发给快速模型，复杂或需要搜索的发给强模型
+MODEL_ROUTING_ENABLED = os.getenv("MODEL_ROUTING_ENABLED", "true").lower() in ("1", "true", "yes")
+MODEL_ROUTER_FAST_MODEL = os.getenv("MODEL_ROUTER_FAST_MODEL", "grok-4-fast")
+MODEL_ROUTER_STRONG_MODEL = os.getenv("MODEL_ROUTER_STRONG_MODEL", "gpt-5")
+MODEL_ROUTER_THRESHOLD = float(os.getenv("MODEL_ROUTER_THRESHOLD", "2"))
+MODEL_ROUTER_LONG_PROMPT_CHARS = int(os.getenv("MODEL_ROUTER_LONG_PROMPT_CHARS", "400"))
+MODEL_ROUTER_LONG_CONTEXT_TOKENS = int(os.getenv("MODEL_ROUTER_LONG_CONTEXT_TOKENS", "4000"))
+# 只接受固定 temperature 的模型
+_FIXED_TEMPERATURE = {"gpt-5": 1.0}
+
+# 上游重试与熔断
+UPSTREAM_RETRY_ATTEMPTS = int(os.getenv("UPSTREAM_RETRY_ATTEMPTS", "3"))
+UPSTREAM_RETRY_BASE_DELAY = float(os.getenv("UPSTREAM_RETRY_BASE_DELAY", "0.5"))
+UPSTREAM_RETRY_MAX_DELAY = float(os.getenv("UPSTREAM_RETRY_MAX_DELAY", "8"))
+UPSTREAM_RETRY_MAX_RETRY_AFTER = float(os.getenv("UPSTREAM_RETRY_MAX_RETRY_AFTER", "30"))
+# 单次调用（包括所有重试和等待）的时间预算，超过后不再重试
+UPSTREAM_RETRY_MAX_ELAPSED = float(os.getenv("UPSTREAM_RETRY_MAX_ELAPSED", "30"))
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RECOVERY_TIMEOUT = float(os.getenv("CIRCUIT_RECOVERY_TIMEOUT", "30"))
+
+# 准入控制：Agentic Loop 请求的全局并发上限和有界排队（/api/chat 优先于 /v1/chat/completions）
+ADMISSION_MAX_CONCURRENT = int(os.getenv("ADMISSION_MAX_CONCURRENT", "32"))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "128"))
+ADMISSION_MAX_WAIT = float(os.getenv("ADMISSION_MAX_WAIT", "5"))
+ADMISSION_RETRY_AFTER = float(os.getenv("ADMISSION_RETRY_AFTER", "2"))
+# 批量通道优先级最低，且最多占用的名额数有上限，避免批量任务占满名额时交互请求只能排队
+ADMISSION_BATCH_MAX_ACTIVE = int(os.getenv("ADMISSION_BATCH_MAX_ACTIVE", str(max(1, ADMISSION_MAX_CONCURRENT // 2))))
+# 批量通道的独立等待队列上限（批量等待者不计入 ADMISSION_MAX_QUEUE）
+ADMISSION_BATCH_MAX_QUEUE = int(os.getenv("ADMISSION_BATCH_MAX_QUEUE", str(ADMISSION_MAX_QUEUE)))
+
+# 批量接口：单个请求的最大条目数、默认和最大并发数，以及每个条目等待准入名额的最长时间（秒）
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "1000"))
+BATCH_DEFAULT_CONCURRENCY = int(os.getenv("BATCH_DEFAULT_CONCURRENCY", "4"))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "16"))
+BATCH_ITEM_MAX_WAIT = float(os.getenv("BATCH_ITEM_MAX_WAIT", "300"))
+
+# 异步任务：后台 worker 数、排队上限、内存中保留的任务数和已结束任务的保留时间（秒）
+JOBS_WORKERS = int(os.getenv("JOBS_WORKERS", "4"))
+JOBS_MAX_QUEUE = int(os.getenv("JOBS_MAX_QUEUE", "100"))
+JOBS_MAX_STORED = int(os.getenv("JOBS_MAX_STORED", "1000"))
+JOBS_TTL = float(os.getenv("JOBS_TTL", "3600"))
+
+# 服务端会话存储（/api/chat 的 conversation_id 模式）：会话数上限、单个会话的消息数上限和空闲过期时间（秒）
+CONVERSATION_MAX = int(os.getenv("CONVERSATION_MAX", "1000"))
+CONVERSATION_MAX_MESSAGES = int(os.getenv("CONVERSATION_MAX_MESSAGES", "2000"))
+CONVERSATION_TTL = float(os.getenv("CONVERSATION_TTL", "86400"))
+
+# 入站压缩：解压 gzip / br 请求体，按 Accept-Encoding 压缩响应（小于 COMPRESSION_MIN_SIZE 字节的响应不压缩）
+COMPRESSION_ENABLED = os.getenv("COMPRESSION_ENABLED", "true").lower() in ("1", "true", "yes")
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+COMPRESSION_GZIP_LEVEL = int(os.getenv("COMPRESSION_GZIP_LEVEL", "6"))
+COMPRESSION_BROTLI_QUALITY = int(os.getenv("COMPRESSION_BROTLI_QUALITY", "4"))
+REQUEST_MAX_DECOMPRESSED_SIZE = int(os.getenv("REQUEST_MAX_DECOMPRESSED_SIZE", str(32 * 1024 * 1024)))
+
+# 追踪配置：请求、每轮、上游调用和工具调用的 span，可通过 /debug/traces/{trace_id} 查看
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "true").lower() in ("1", "true", "yes")
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.1"))
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "200"))
+TRACE_EXPORT_FILE = os.getenv("TRACE_EXPORT_FILE", "")
+
+# 静态资源：启动时加载到内存并预压缩；开发模式下文件变化后自动重新加载
+STATIC_MAX_AGE = int(os.getenv("STATIC_MAX_AGE", "3600"))
+STATIC_DEV_RELOAD = os.getenv("STATIC_DEV_RELOAD", "false").lower() in ("1", "true", "yes")
+STATIC_RELOAD_INTERVAL = float(os.getenv("STATIC_RELOAD_INTERVAL", "1"))
+
+# 笑话池配置（后台预填充 /api/joke 的结果）
+JOKE_POOL_ENABLED = os.getenv("JOKE_POOL_ENABLED", "true").lower() in ("1", "true", "yes")
+JOKE_POOL_LOW_WATERMARK = int(os.getenv("JOKE_POOL_LOW_WATERMARK", "3"))
+JOKE_POOL_HIGH_WATERMARK = int(os.getenv("JOKE_POOL_HIGH_WATERMARK", "10"))
+JOKE_POOL_MAX_AGE = float(os.getenv("JOKE_POOL_MAX_AGE", "3600"))
+
+# 全局共享的上游 HTTP 客户端（在 lifespan 中创建和关闭）
+_http_client: Optional[httpx.AsyncClient] = None
+
+
+def _create_http_client() -> httpx.AsyncClient:
+    """创建带连接池的上游 HTTP 客户端"""
+    http2 = UPSTREAM_HTTP2
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            logger.warning("UPSTREAM_HTTP2 已开启，但未安装 h2 包，回退到 HTTP/1.1")
+            http2 = False
+
+    limits = httpx.Limits(
+        max_connections=UPSTREAM_MAX_CONNECTIONS,
+        max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE,
+        keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY
+    )
+    timeout = httpx.Timeout(
+        connect=UPSTREAM_CONNECT_TIMEOUT,
+        read=UPSTREAM_READ_TIMEOUT,
+        write=UPSTREAM_WRITE_TIMEOUT,
+        pool=UPSTREAM_POOL_TIMEOUT
+    )
+    return httpx.AsyncClient(
+        headers={"Authorization": f"Bearer {AI_BUILDER_API_KEY}"},
+        timeout=timeout,
+        # 上游拒绝 gzip 请求体（415）时停用压缩，并以未压缩的请求体重发该请求
+        transport=UpstreamCompressionTransport(httpx.AsyncHTTPTransport(limits=limits, http2=http2), upstream_compressor),
+        event_hooks={"request": [_inject_trace_headers]}
+    )
+
+
+upstream_compressor = UpstreamBodyCompressor(enabled=UPSTREAM_REQUEST_COMPRESSION, minimum_size=UPSTREAM_COMPRESSION_MIN_SIZE)
+
+
+def _json_body(data: Dict[str, Any]) -> Dict[str, Any]:
+    """上游请求体参数：用 fastjson 序列化（替代 httpx 的 json= 参数），启用时对较大的请求体做 gzip 压缩"""
+    content, headers = upstream_compressor.encode(fastjson.dumps(data))
+    return {"content": content, "headers": {"Content-Type": "application/json", **headers}}
+
+
+async def _inject_trace_headers(request: httpx.Request):
+    """把当前 span 的 traceparent 传给上游"""
+    request.headers.update(tracer.inject())
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """获取共享的上游 HTTP 客户端，未初始化时（例如在 lifespan 之外调用）延迟创建"""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = _create_http_client()
+    return _http_client
+
+
+async def close_http_client():
+    """关闭共享的上游 HTTP 客户端，释放连接池"""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """应用生命周期：启动时创建上游连接池，关闭时释放"""
+    get_http_client()
+    logger.info(
+        f"上游连接池已创建: max_connections={UPSTREAM_MAX_CONNECTIONS}, "
+        f"max_keepalive={UPSTREAM_MAX_KEEPALIVE}, http2={UPSTREAM_HTTP2}"
+    )
+    if JOKE_POOL_ENABLED:
+        joke_pool.start()
+    static_assets.start()
+    job_manager.start()
+    try:
+        yield
+    finally:
+        await job_manager.stop()
+        await static_assets.stop()
+        await joke_pool.stop()
+        await search_cache.close()
+        await close_http_client()
+        logger.info("上游连接池已关闭")
+        tracer.exporter.close()
+
+
 app = FastAPI(
     title="Hello API",
     description="一个简单的 FastAPI 示例应用，提供 hello 问候接口和 OpenAI 兼容的 Chat API",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=JSONBytesResponse
 )
 
+# 请求体解压和响应压缩（SSE / NDJSON 流按 chunk flush，预压缩的静态资源原样透传）
+compression_stats = CompressionStats()
+if COMPRESSION_ENABLED:
+    app.add_middleware(
+        CompressionMiddleware,
+        minimum_size=COMPRESSION_MIN_SIZE,
+        gzip_level=COMPRESSION_GZIP_LEVEL,
+        brotli_quality=COMPRESSION_BROTLI_QUALITY,
+        max_request_size=REQUEST_MAX_DECOMPRESSED_SIZE,
+        stats=compression_stats
+    )
+
 
 class NameRequest(BaseModel):
     """请求模型：用于接收用户输入的名字"""
@@ -106,8 +369,16 @@ class ChatMessage(BaseModel):
 
 
 class ChatRequest(BaseModel):
-    """聊天请求模型"""
-    messages: List[ChatMessage] = Field(..., description="消息列表", min_items=1)
+    """聊天请求模型：传完整的 messages，或使用 conversation_id 模式只传新消息"""
+    messages: Optional[List[ChatMessage]] = Field(None, description="消息列表（不使用会话模式时必填；创建新会话时作为已有的历史）", min_items=1)
+    conversation_id: Optional[str] = Field(None, description="服务端会话 ID；省略且提供 message 时创建新会话")
+    message: Optional[str] = Field(None, description="会话模式下新的用户消息")
+    parent_id: Optional[str] = Field(
+        None,
+        description="会话模式下接在哪条消息之后，默认为当前分支末端；指向更早的消息即编辑（形成新分支），"
+                    "省略 message 并指向一条用户消息即重新生成该消息的回答"
+    )
+    model: Optional[str] = Field(None, description="使用的模型；省略或为 auto 时由模型路由器按问题选择", min_length=1)
 
 
 # 搜索工具定义
@@ -138,47 +409,364 @@ SEARCH_TOOL = {
 }
 
 
+# Agentic Loop 进度事件回调（流式输出等场景使用）
+EventCallback = Callable[[Dict[str, Any]], Awaitable[None]]
+
+
+# 准入控制器：通道按优先级排列，interactive（前端聊天）先于 api（OpenAI 兼容接口）先于 batch（批量接口）
+admission = AdmissionController(
+    max_concurrent=ADMISSION_MAX_CONCURRENT,
+    max_queue=ADMISSION_MAX_QUEUE,
+    max_wait=ADMISSION_MAX_WAIT,
+    retry_after=ADMISSION_RETRY_AFTER,
+    lanes=("interactive", "api", "batch"),
+    lane_limits={"batch": ADMISSION_BATCH_MAX_ACTIVE},
+    # 批量条目可以排队很久，使用独立的队列上限，不占用前端和 API 请求的排队位置
+    lane_queue_limits={"batch": ADMISSION_BATCH_MAX_QUEUE}
+)
+
+# 服务端会话存储：/api/chat 的 conversation_id 模式下客户端只上传新消息
+conversation_store = ConversationStore(
+    max_conversations=CONVERSATION_MAX,
+    max_messages=CONVERSATION_MAX_MESSAGES,
+    ttl=CONVERSATION_TTL
+)
+
+# Prometheus 指标（/metrics）：热路径上只做计数和分桶，文本在抓取时生成
+metrics_registry = Registry()
+REQUEST_LATENCY = metrics_registry.histogram(
+    "agentic_request_duration_seconds", "Agentic Loop 请求总耗时（秒）", ["stream", "outcome"]
+)
+REQUESTS_IN_FLIGHT = metrics_registry.gauge("agentic_requests_in_flight", "正在执行的 Agentic Loop 请求数")
+ROUND_LATENCY = metrics_registry.histogram(
+    "agentic_round_duration_seconds", "单轮耗时（秒），kind=tool 为带工具执行的轮次，final 为生成答案的轮次", ["kind"]
+)
+ROUNDS = metrics_registry.counter("agentic_rounds_total", "完成的轮次数", ["kind"])
+UPSTREAM_LATENCY = metrics_registry.histogram(
+    "upstream_request_duration_seconds", "单次上游 HTTP 调用耗时（秒，每次重试/对冲单独计）", ["endpoint", "model", "outcome"]
+)
+UPSTREAM_ERRORS = metrics_registry.counter("upstream_errors_total", "上游调用失败次数", ["endpoint", "error"])
+TOOL_LATENCY = metrics_registry.histogram("tool_duration_seconds", "工具执行耗时（秒）", ["tool", "outcome"])
+TOOL_CALLS = metrics_registry.counter("tool_calls_total", "工具调用次数", ["tool", "outcome"])
+TOKENS = metrics_registry.counter("upstream_tokens_total", "上游响应 usage 中的 token 数", ["model", "type"])
+ROUTE_DECISIONS = metrics_registry.counter("model_route_decisions_total", "模型路由决策次数", ["model", "reason"])
+MODEL_REQUEST_LATENCY = metrics_registry.histogram(
+    "model_request_duration_seconds", "按路由到的模型统计的 Agentic Loop 请求总耗时（秒）", ["model", "outcome"]
+)
+
+# 追踪器：新 trace 按 TRACE_SAMPLE_RATE 采样，入站 traceparent 的采样决定优先
+tracer = Tracer(
+    TraceExporter(max_traces=TRACE_BUFFER_SIZE, path=TRACE_EXPORT_FILE or None),
+    sample_rate=TRACE_SAMPLE_RATE,
+    enabled=TRACING_ENABLED
+)
+
+# 上游弹性层：chat 和 search 两个端点各自一个熔断器
+upstream_resilience = Resilience(
+    # 只重试请求肯定没有发出去的连接类故障；读超时/读错误时上游可能已在处理（chat 调用不是幂等的），
+    # 这些只记为熔断器失败，不重试
+    transient_errors=(httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout),
+    max_attempts=UPSTREAM_RETRY_ATTEMPTS,
+    base_delay=UPSTREAM_RETRY_BASE_DELAY,
+    max_delay=UPSTREAM_RETRY_MAX_DELAY,
+    max_retry_after=UPSTREAM_RETRY_MAX_RETRY_AFTER,
+    max_elapsed=UPSTREAM_RETRY_MAX_ELAPSED,
+    failure_threshold=CIRCUIT_FAILURE_THRESHOLD,
+    recovery_timeout=CIRCUIT_RECOVERY_TIMEOUT
+)
+
+# 按模型统计延迟并对慢调用发起对冲
+upstream_hedger = Hedger(
+    percentile=HEDGING_PERCENTILE,
+    window=HEDGING_WINDOW,
+    min_samples=HEDGING_MIN_SAMPLES,
+    max_hedge_ratio=HEDGING_MAX_RATIO
+)
+
+# 模型路由器（不调用上游，只按请求内容做本地分类）
+model_router = ModelRouter(
+    fast_model=MODEL_ROUTER_FAST_MODEL,
+    strong_model=MODEL_ROUTER_STRONG_MODEL,
+    enabled=MODEL_ROUTING_ENABLED,
+    classifier=ComplexityClassifier(
+        threshold=MODEL_ROUTER_THRESHOLD,
+        long_prompt_chars=MODEL_ROUTER_LONG_PROMPT_CHARS,
+        long_context_tokens=MODEL_ROUTER_LONG_CONTEXT_TOKENS
+    ),
+    # 请求体可以指定任意模型名，指标、路由统计和对冲延迟样本只区分这些模型，其余记为 other
+    known_models=(CONTEXT_SUMMARY_MODEL, *_FIXED_TEMPERATURE)
+)
+
+# 上游请求合并器（搜索和 chat completions 共用，key 中包含请求类型）
+upstream_singleflight = SingleFlight("upstream")
+
+# 搜索结果缓存（按单个关键词缓存，key 为规范化后的关键词 + max_results）
+search_cache = TTLCache(
+    "search",
+    max_size=SEARCH_CACHE_MAX_SIZE,
+    ttl=SEARCH_CACHE_TTL,
+    stale_ttl=SEARCH_CACHE_STALE_TTL
+)
+
+
+def _log_detail(msg: str, *args: Any, event: str, **fields: Any):
+    """详细日志：全局或当前请求开启详细日志时以 INFO 输出，否则为 DEBUG"""
+    level = logging.INFO if LOG_TOOL_DETAILS or verbose_logging.get() else logging.DEBUG
+    if logger.isEnabledFor(level):
+        logger.log(level, msg, *args, extra={"event": event, **fields})
+
+
+def _detail_enabled() -> bool:
+    """当前请求是否会输出详细日志（用于跳过只为日志准备的计算）"""
+    return logger.isEnabledFor(logging.INFO if LOG_TOOL_DETAILS or verbose_logging.get() else logging.DEBUG)
+
+
+@asynccontextmanager
+async def _observe_upstream(endpoint: str, model: str = ""):
+    """记录一次上游 HTTP 调用的耗时、错误和 span（被取消的对冲请求不计为错误）"""
+    model_label = model_router.label(model) if model else ""
+    start = time.monotonic()
+    outcome = "ok"
+    try:
+        with tracer.span("upstream", endpoint=endpoint, model=model) as span:
+            yield
+    except Exception as e:
+        outcome = "error"
+        error = str(e.response.status_code) if isinstance(e, httpx.HTTPStatusError) else type(e).__name__
+        UPSTREAM_ERRORS.labels(endpoint, error).inc()
+        span.set_attribute("error", error)
+        raise
+    except BaseException:
+        outcome = "cancelled"
+        raise
+    finally:
+        UPSTREAM_LATENCY.labels(endpoint, model_label, outcome).observe(time.monotonic() - start)
+
+
+def _record_usage(response: Dict[str, Any]):
+    """累计上游响应 usage 中的 token 数"""
+    usage = response.get("usage")
+    if not usage:
+        return
+    model = response.get("model")
+    model = model_router.label(model) if isinstance(model, str) and model else ""
+    for kind in ("prompt_tokens", "completion_tokens"):
+        if usage.get(kind):
+            TOKENS.labels(model, kind[:-len("_tokens")]).inc(usage[kind])
+
+
+def _normalize_keyword(keyword: str) -> str:
+    """规范化关键词：去掉首尾空白、合并连续空白并转为小写"""
+    return " ".join(str(keyword).split()).lower()
+
+
+async def _fetch_search(keywords: List[str], max_results: int) -> Dict[str, Any]:
+    """直接请求上游搜索 API，失败时抛出 httpx 异常"""
+    request_data = {
+        "keywords": keywords,
+        "max_results": max_results
+    }
+    
+    url = f"{AI_BUILDER_BASE_URL}/v1/search/"
+    
+    logger.debug("发送搜索请求到: %s, 请求数据: %s", url, request_data)
+    
+    async def send():
+        async with _observe_upstream("search"):
+            response = await get_http_client().post(url, **_json_body(request_data))
+            response.raise_for_status()
+        logger.debug("搜索请求成功，状态码: %d", response.status_code)
+        return fastjson.parse_response(response.content)
+    
+    async def post():
+        return await upstream_resilience.call("search", send)
+    
+    if not SINGLEFLIGHT_ENABLED:
+        return await post()
+    return await upstream_singleflight.do(canonical_key("search", request_data), post)
+
+
+async def _search_keyword(keyword: str, max_results: int, semaphore: asyncio.Semaphore) -> Dict[str, Any]:
+    """搜索单个关键词（带缓存），只有真正请求上游时才占用并发名额"""
+    async def fetch():
+        async with semaphore:
+            return await _fetch_search([keyword], max_results)
+    
+    if not SEARCH_CACHE_ENABLED:
+        return await fetch()
+    
+    key = (_normalize_keyword(keyword), max_results)
+    return await search_cache.get_or_fetch(key, fetch)
+
+
+def _merge_search_results(keywords: List[str], results: List[Any]) -> Dict[str, Any]:
+    """
+    将按关键词拆分的搜索结果合并回上游的响应结构（queries + combined_answer）
+    
+    部分关键词失败时，以 {"keyword": ..., "error": ...} 的形式保留在 queries 中。
+    """
+    merged: Dict[str, Any] = {}
+    queries: List[Dict[str, Any]] = []
+    answers: List[str] = []
+    for keyword, result in zip(keywords, results):
+        if isinstance(result, BaseException):
+            queries.append({"keyword": keyword, "error": f"搜索失败: {str(result)}"})
+            continue
+        # 保留上游响应中的其他顶层字段（以第一个成功的结果为准）
+        for k, v in result.items():
+            if k not in ("queries", "combined_answer"):
+                merged.setdefault(k, v)
+        queries.extend(result.get("queries", []))
+        if result.get("combined_answer"):
+            answers.append(result["combined_answer"])
+    
+    merged["queries"] = queries
+    merged["combined_answer"] = "\n\n".join(answers) if answers else None
+    return merged
+
+
+def _coerce_keywords(keywords: Any) -> List[str]:
+    """把关键词参数规范成非空的字符串列表（单个字符串视为一个关键词），不合法时抛出 ValueError"""
+    if isinstance(keywords, str):
+        keywords = [keywords]
+    if not isinstance(keywords, list) or not all(isinstance(keyword, str) for keyword in keywords):
+        raise ValueError("keywords 必须是字符串或字符串列表")
+    keywords = [keyword for keyword in keywords if keyword.strip()]
+    if not keywords:
+        raise ValueError("没有提供搜索关键词")
+    return keywords
+
+
+async def cached_search(keywords: Union[str, List[str]], max_results: int = 6) -> Dict[str, Any]:
+    """
+    带缓存的搜索：按关键词拆分、并发获取、分别缓存，再合并结果
+    
+    关键词为空或类型不对时抛出 ValueError；所有关键词都失败时抛出第一个异常（失败结果不缓存）。
+    """
+    keywords = _coerce_keywords(keywords)
+    
+    # 同一请求内重复的关键词只请求一次
+    unique_keywords: Dict[str, str] = {}
+    for keyword in keywords:
+        unique_keywords.setdefault(_normalize_keyword(keyword), keyword)
+    
+    keywords = list(unique_keywords.values())
+    
+    semaphore = asyncio.Semaphore(SEARCH_FANOUT_CONCURRENCY)
+    results = await asyncio.gather(
+        *[_search_keyword(keyword, max_results, semaphore) for keyword in keywords],
+        return_exceptions=True
+    )
+    
+    if all(isinstance(result, BaseException) for result in results):
+        raise results[0]
+    if len(results) == 1:
+        return results[0]
+    return _merge_search_results(keywords, results)
+
+
 async def execute_search(keywords: List[str], max_results: int = 6) -> Dict[str, Any]:
     """执行搜索的内部函数"""
     try:
-        request_data = {
-            "keywords": keywords,
-            "max_results": max_results
-        }
-        
-        url = f"{AI_BUILDER_BASE_URL}/v1/search/"
-        headers = {
-            "Authorization": f"Bearer {AI_BUILDER_API_KEY}",
-            "Content-Type": "application/json"
-        }
-        
-        logger.debug(f"    发送搜索请求到: {url}")
-        logger.debug(f"    请求数据: {json.dumps(request_data, ensure_ascii=False)}")
-        
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            response = await client.post(url, json=request_data, headers=headers)
-            response.raise_for_status()
-            result = response.json()
-            logger.debug(f"    搜索请求成功，状态码: {response.status_code}")
-            return result
+        return await cached_search(keywords, max_results)
     except Exception as e:
-        logger.error(f"    搜索失败: {str(e)}")
+        logger.error("搜索失败: %s", e, extra={"event": "search_error"})
         return {"error": f"搜索失败: {str(e)}"}
 
 
-async def call_ai_builder_api(messages: List[Dict[str, Any]], tools: Optional[List[Dict[str, Any]]] = None, extra_params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
-    """调用 AI Builder API 的辅助函数"""
+async def _search_tool_handler(arguments: Dict[str, Any]) -> Dict[str, Any]:
+    """search 工具的处理函数：执行搜索并记录结果摘要"""
+    keywords = arguments.get("keywords", [])
+    max_results = arguments.get("max_results", 6)
+    
+    _log_detail("搜索参数: keywords=%s, max_results=%s", keywords, max_results, event="search_args")
+    
+    # 执行搜索
+    search_result = await execute_search(keywords, max_results)
+    
+    # 记录搜索结果摘要（只在开启详细日志时计算）
+    if "error" in search_result:
+        logger.warning("搜索结果: 错误 - %s", search_result.get("error", "Unknown error"), extra={"event": "search_error"})
+    elif _detail_enabled():
+        queries = search_result.get("queries", [])
+        combined_answer = search_result.get("combined_answer") or ""
+        # 只记录前2个查询的摘要
+        summary = [
+            {"keyword": query.get("keyword", "unknown"), "results": len(query.get("response", {}).get("results", []))}
+            for query in queries[:2]
+        ]
+        _log_detail(
+            "搜索结果: %d 个查询", len(queries),
+            event="search_result", queries=summary, combined_answer=combined_answer[:200]
+        )
+    
+    return search_result
+
+
+# 推测性搜索：预取结果进入搜索缓存，模型请求相同关键词时直接命中
+search_speculator = SearchSpeculator(
+    cached_search,
+    _normalize_keyword,
+    max_keywords=SPECULATIVE_MAX_KEYWORDS
+)
+
+
+def _requested_search_keywords(tool_calls: List[Dict[str, Any]]) -> List[tuple]:
+    """提取模型请求的 search 工具调用中的 (关键词, max_results)"""
+    requested = []
+    for tool_call in tool_calls:
+        function = tool_call.get("function", {})
+        if function.get("name") != "search":
+            continue
+        try:
+            arguments = fastjson.loads(function.get("arguments") or "{}")
+        except ValueError:
+            continue
+        try:
+            keywords = _coerce_keywords(arguments.get("keywords", []))
+        except ValueError:
+            continue
+        requested.extend((keyword, arguments.get("max_results", 6)) for keyword in keywords)
+    return requested
+
+
+# 工具注册表：Agentic Loop 通过它分发所有工具调用
+tool_registry = ToolRegistry()
+tool_registry.register(Tool(
+    SEARCH_TOOL,
+    _search_tool_handler,
+    max_concurrency=SEARCH_TOOL_MAX_CONCURRENCY,
+    timeout=SEARCH_TOOL_TIMEOUT,
+    # 搜索在 cached_search 中按关键词缓存，粒度更细，这里不再整体缓存
+    cacheable=False,
+    # 搜索端点熔断时不向模型提供搜索工具，避免浪费一轮只拿到错误结果
+    available=upstream_resilience.breaker("search").allows_requests
+))
+
+
+def _chat_breaker(model: str) -> str:
+    """Agentic Loop 的 chat 调用按模型使用各自的熔断器（未知模型共用一个）"""
+    return f"chat:{model_router.label(model)}"
+
+
+def _build_chat_request(messages: List[Dict[str, Any]], tools: Optional[List[Dict[str, Any]]] = None, extra_params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """构建发送给 AI Builder API 的 chat completions 请求体（模型由 extra_params["model"] 指定，默认强模型）"""
     request_data = {
-        "model": "gpt-5",
-        "messages": messages,
-        "temperature": 1.0  # gpt-5 必须使用 temperature=1.0
+        "model": MODEL_ROUTER_STRONG_MODEL,
+        "messages": messages
     }
     
-    # 添加额外参数（如 max_tokens），但排除 temperature（必须保持为 1.0）
+    # 添加额外参数（如 model、max_tokens、temperature）
+    # stream 相关参数由调用方决定（普通调用 / 流式调用），不透传
     if extra_params:
-        filtered_params = {k: v for k, v in extra_params.items() if k != "temperature"}
+        filtered_params = {k: v for k, v in extra_params.items() if k not in ("stream", "stream_options")}
         request_data.update(filtered_params)
     
+    # gpt-5 必须使用 temperature=1.0，忽略调用方的设置
+    fixed_temperature = _FIXED_TEMPERATURE.get(request_data["model"])
+    if fixed_temperature is not None:
+        request_data["temperature"] = fixed_temperature
+    
     if tools:
         request_data["tools"] = tools
     
@@ -186,50 +774,347 @@ async def call_ai_builder_api(messages: List[Dict[str, Any]], tools: Optional[Li
     if "max_tokens" in request_data:
         request_data["max_completion_tokens"] = request_data.pop("max_tokens")
     
+    return request_data
+
+
+async def call_ai_builder_api(messages: List[Dict[str, Any]], tools: Optional[List[Dict[str, Any]]] = None, extra_params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """调用 AI Builder API 的辅助函数"""
+    request_data = _build_chat_request(messages, tools, extra_params)
     url = f"{AI_BUILDER_BASE_URL}/v1/chat/completions"
-    headers = {
-        "Authorization": f"Bearer {AI_BUILDER_API_KEY}",
-        "Content-Type": "application/json"
+    
+    async def send():
+        async with _observe_upstream("chat", request_data["model"]):
+            response = await get_http_client().post(url, **_json_body(request_data))
+            response.raise_for_status()
+        # 保留原始字节：最后一轮的响应可以原样返回给客户端
+        return fastjson.parse_response(response.content)
+    
+    async def hedged():
+        # 对冲只作用于单次上游调用，合并后的调用方共享对冲结果
+        if not HEDGING_ENABLED:
+            return await send()
+        return await upstream_hedger.run(model_router.label(request_data["model"]), send)
+    
+    async def post():
+        return await upstream_resilience.call(_chat_breaker(request_data["model"]), hedged)
+    
+    # 并发中完全相同的请求只发送一次
+    if not SINGLEFLIGHT_ENABLED:
+        return await post()
+    return await upstream_singleflight.do(canonical_key("chat", request_data), post)
+
+
+async def stream_ai_builder_api(messages: List[Dict[str, Any]], tools: Optional[List[Dict[str, Any]]] = None, extra_params: Optional[Dict[str, Any]] = None) -> AsyncIterator[Dict[str, Any]]:
+    """以流式方式调用 AI Builder API，逐个产出上游的 chat.completion.chunk"""
+    request_data = _build_chat_request(messages, tools, extra_params)
+    request_data["stream"] = True
+    url = f"{AI_BUILDER_BASE_URL}/v1/chat/completions"
+    
+    async with _observe_upstream("chat_stream", request_data["model"]):
+        async with get_http_client().stream("POST", url, **_json_body(request_data)) as response:
+            if response.is_error:
+                # 读取错误响应体，便于上层生成错误信息
+                await response.aread()
+                response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if not data:
+                    continue
+                if data == "[DONE]":
+                    break
+                yield fastjson.loads(data)
+
+
+async def _stream_round(messages: List[Dict[str, Any]], tools: Optional[List[Dict[str, Any]]], extra_params: Dict[str, Any], on_event: Optional[EventCallback]) -> Dict[str, Any]:
+    """
+    流式执行一轮调用：内容增量实时通过 on_event 转发，
+    同时把所有 chunk 累积成与非流式调用相同结构的响应
+    
+    只有在还没有向客户端转发任何内容时才会重试。
+    """
+    emitted = False
+    
+    async def forward(event: Dict[str, Any]):
+        nonlocal emitted
+        emitted = True
+        if on_event:
+            await on_event(event)
+    
+    return await upstream_resilience.call(
+        _chat_breaker(extra_params.get("model", MODEL_ROUTER_STRONG_MODEL)),
+        lambda: _stream_round_once(messages, tools, extra_params, forward),
+        can_retry=lambda: not emitted
+    )
+
+
+async def _stream_round_once(messages: List[Dict[str, Any]], tools: Optional[List[Dict[str, Any]]], extra_params: Dict[str, Any], on_event: Optional[EventCallback]) -> Dict[str, Any]:
+    """执行一次流式上游调用并累积响应"""
+    content_parts: List[str] = []
+    tool_calls_by_index: Dict[int, Dict[str, Any]] = {}
+    finish_reason = None
+    response_meta: Dict[str, Any] = {}
+    usage = None
+    
+    async for chunk in stream_ai_builder_api(messages, tools=tools, extra_params=extra_params):
+        if not response_meta:
+            response_meta = {k: chunk.get(k) for k in ("id", "created", "model")}
+        if chunk.get("usage"):
+            usage = chunk["usage"]
+        for choice in chunk.get("choices", []):
+            delta = choice.get("delta", {})
+            if choice.get("finish_reason"):
+                finish_reason = choice["finish_reason"]
+            if delta.get("content"):
+                content_parts.append(delta["content"])
+                if on_event:
+                    await on_event({"type": "delta", "content": delta["content"]})
+            # 工具调用按 index 分片到达，需要拼接 name 和 arguments
+            for tc_delta in delta.get("tool_calls") or []:
+                tc = tool_calls_by_index.setdefault(tc_delta.get("index", 0), {
+                    "id": None,
+                    "type": "function",
+                    "function": {"name": "", "arguments": ""}
+                })
+                if tc_delta.get("id"):
+                    tc["id"] = tc_delta["id"]
+                function_delta = tc_delta.get("function") or {}
+                if function_delta.get("name"):
+                    tc["function"]["name"] += function_delta["name"]
+                if function_delta.get("arguments"):
+                    tc["function"]["arguments"] += function_delta["arguments"]
+    
+    message: Dict[str, Any] = {
+        "role": "assistant",
+        "content": "".join(content_parts) if content_parts else None
     }
+    if tool_calls_by_index:
+        message["tool_calls"] = [tool_calls_by_index[i] for i in sorted(tool_calls_by_index)]
     
-    async with httpx.AsyncClient(timeout=60.0) as client:
-        response = await client.post(url, json=request_data, headers=headers)
-        response.raise_for_status()
-        return response.json()
+    response = {
+        **response_meta,
+        "object": "chat.completion",
+        "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}]
+    }
+    if usage:
+        response["usage"] = usage
+    return response
 
 
-# 在启动时预加载 HTML 内容
-_html_content = None
+async def _summarize_context(previous_summary: Optional[str], messages: List[Dict[str, Any]]) -> str:
+    """使用廉价模型把较早的对话压缩成摘要（在已有摘要基础上增量总结）"""
+    lines = []
+    for m in messages:
+        text = message_text(m)
+        if m.get("role") == "tool":
+            text = text[:CONTEXT_TOOL_OUTPUT_MAX_CHARS]
+        lines.append(f"[{m.get('role')}] {text}")
+    transcript = "\n".join(lines)
+    
+    prompt = "请用中文简洁地总结下面的对话，保留用户的目标、关键事实、数字、结论以及搜索得到的重要信息，不要编造内容。\n\n"
+    if previous_summary:
+        prompt += f"已有的摘要：\n{previous_summary}\n\n需要并入摘要的新对话：\n"
+    prompt += transcript
+    
+    request_data = {
+        "model": CONTEXT_SUMMARY_MODEL,
+        "messages": [{"role": "user", "content": prompt}],
+        "temperature": 0.2,
+        "max_tokens": 800
+    }
+    url = f"{AI_BUILDER_BASE_URL}/v1/chat/completions"
+    
+    async def send():
+        async with _observe_upstream("chat", request_data["model"]):
+            response = await get_http_client().post(url, **_json_body(request_data))
+            response.raise_for_status()
+        return fastjson.loads(response.content)
+    
+    # 摘要和笑话使用各自的熔断器，它们的失败不会让 Agentic Loop 的调用被熔断
+    result = await upstream_resilience.call("summary", send)
+    return result.get("choices", [{}])[0].get("message", {}).get("content") or ""
 
-def _load_html_content():
-    """在启动时加载 HTML 内容"""
-    global _html_content
-    if _html_content is None:
-        import os
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        html_path = os.path.join(current_dir, "static", "index.html")
-        try:
-            with open(html_path, "r", encoding="utf-8") as f:
-                _html_content = f.read()
-            logger.info(f"HTML 内容已加载: {len(_html_content)} 字符")
-        except Exception as e:
-            logger.error(f"加载 HTML 文件失败: {e}")
-            _html_content = f"<h1>Error loading chat interface</h1><p>{str(e)}</p>"
-    return _html_content
 
-# 启动时加载
-_load_html_content()
+# 上下文管理器：按 token 预算压缩发送给上游的消息，摘要按对话前缀缓存
+context_manager = ContextManager(
+    _summarize_context,
+    budget_tokens=CONTEXT_TOKEN_BUDGET,
+    keep_recent_turns=CONTEXT_KEEP_RECENT_TURNS,
+    tool_output_max_chars=CONTEXT_TOOL_OUTPUT_MAX_CHARS
+)
+
+
+# 静态资源（包括聊天界面 index.html）在启动时加载到内存，并预先生成 gzip / brotli 版本
+static_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+static_assets = AssetStore(
+    static_dir,
+    max_age=STATIC_MAX_AGE,
+    dev_mode=STATIC_DEV_RELOAD,
+    reload_interval=STATIC_RELOAD_INTERVAL
+)
+if os.path.exists(static_dir):
+    static_assets.load()
+    logger.info(f"静态文件已加载: {static_assets.stats()}")
+else:
+    logger.warning(f"静态文件目录不存在: {static_dir}")
 
 @app.get("/health")
 async def health():
     """健康检查端点"""
     return {"status": "ok", "message": "Service is running"}
 
+@app.get("/stats", summary="运行时统计", tags=["监控"])
+async def stats():
+    """返回缓存等组件的运行时统计信息"""
+    return {
+        "search_cache": search_cache.stats(),
+        "joke_pool": joke_pool.stats(),
+        "singleflight": upstream_singleflight.stats(),
+        "context": context_manager.stats(),
+        "tools": tool_registry.stats(),
+        "speculative_search": search_speculator.stats(),
+        "hedging": {"enabled": HEDGING_ENABLED, **upstream_hedger.stats()},
+        "routing": model_router.stats(),
+        "resilience": upstream_resilience.stats(),
+        "admission": admission.stats(),
+        "tracing": tracer.stats(),
+        "logging": structured_logging.stats(),
+        "static": static_assets.stats(),
+        "jobs": job_manager.stats(),
+        "conversations": conversation_store.stats(),
+        "compression": {"enabled": COMPRESSION_ENABLED, **compression_stats.stats(), "upstream": upstream_compressor.stats()}
+    }
+
+def _component_metrics():
+    """把各组件 stats() 中的计数和状态转换成 Prometheus 指标族"""
+    caches = {"search": search_cache.stats(), "context_summary": context_manager.stats()["summary_cache"]}
+    cache_lookups = []
+    for name, s in caches.items():
+        cache_lookups += [({"cache": name, "result": "hit"}, s["hits"]),
+                          ({"cache": name, "result": "stale"}, s["stale_hits"]),
+                          ({"cache": name, "result": "miss"}, s["misses"])]
+    yield "cache_lookups_total", "counter", "缓存查询次数", cache_lookups
+    yield "cache_evictions_total", "counter", "缓存淘汰次数", [({"cache": n}, s["evictions"]) for n, s in caches.items()]
+    yield "cache_entries", "gauge", "缓存条目数", [({"cache": n}, s["size"]) for n, s in caches.items()]
+    
+    pool = joke_pool.stats()
+    yield "joke_pool_depth", "gauge", "笑话池中可用的笑话数", [({}, pool["depth"])]
+    yield "joke_pool_served_total", "counter", "从笑话池取出的笑话数", [({}, pool["served"])]
+    yield "joke_pool_empty_total", "counter", "笑话池为空时的取用次数", [({}, pool["empty"])]
+    
+    resilience = upstream_resilience.stats()
+    breakers = resilience["breakers"]
+    yield "upstream_retries_total", "counter", "上游调用重试次数", [({}, resilience["retries"])]
+    yield "circuit_breaker_state", "gauge", "熔断器当前状态（取值为 1 的 state 为当前状态）", [
+        ({"endpoint": endpoint, "state": state}, int(b["state"] == state))
+        for endpoint, b in breakers.items() for state in ("closed", "open", "half_open")
+    ]
+    yield "circuit_breaker_rejections_total", "counter", "熔断期间被快速拒绝的调用数", [
+        ({"endpoint": endpoint}, b["rejections"]) for endpoint, b in breakers.items()
+    ]
+    
+    adm = admission.stats()
+    lanes = adm["lanes"]
+    yield "admission_active", "gauge", "已获得准入名额的请求数", [({}, adm["active"])]
+    yield "admission_queued", "gauge", "排队等待准入的请求数", [({"lane": lane}, l["queued"]) for lane, l in lanes.items()]
+    yield "admission_admitted_total", "counter", "获得准入的请求数", [({"lane": lane}, l["admitted"]) for lane, l in lanes.items()]
+    yield "admission_rejected_total", "counter", "被准入控制拒绝的请求数", [
+        ({"lane": lane, "reason": reason}, l[f"rejected_{reason}"]) for lane, l in lanes.items() for reason in ("full", "timeout")
+    ]
+    yield "admission_wait_seconds_max", "gauge", "排队等待时间的最大值（秒）", [({"lane": lane}, l["wait_max"]) for lane, l in lanes.items()]
+    
+    spec = search_speculator.stats()
+    yield "speculative_search_prefetched_total", "counter", "推测性预取的关键词数", [({}, spec["prefetched"])]
+    yield "speculative_search_used_total", "counter", "被模型实际使用的预取关键词数", [({}, spec["used"])]
+    
+    hedging = upstream_hedger.stats()
+    yield "hedged_requests_total", "counter", "发起的对冲请求数", [({}, hedging["hedges"])]
+    yield "hedged_request_wins_total", "counter", "对冲请求先于原请求完成的次数", [({}, hedging["hedge_wins"])]
+    yield "singleflight_coalesced_total", "counter", "被合并到进行中请求的上游调用数", [({}, upstream_singleflight.stats()["coalesced"])]
+    yield "tool_in_flight", "gauge", "正在执行的工具调用数", [({"tool": n}, t["in_flight"]) for n, t in tool_registry.stats().items()]
+    
+    comp = compression_stats.stats()
+    yield "http_compressed_bytes_total", "counter", "压缩前后的字节数（direction=request 为解压的请求体，response 为压缩的响应体）", [
+        ({"direction": "request", "stage": "compressed"}, comp["request_bytes_in"]),
+        ({"direction": "request", "stage": "uncompressed"}, comp["request_bytes_out"]),
+        ({"direction": "response", "stage": "uncompressed"}, comp["response_bytes_in"]),
+        ({"direction": "response", "stage": "compressed"}, comp["response_bytes_out"])
+    ]
+    
+    jobs = job_manager.stats()
+    yield "jobs_queued", "gauge", "等待执行的异步任务数", [({}, jobs["queued"])]
+    yield "jobs_stored", "gauge", "内存中保存的异步任务数", [({}, jobs["stored"])]
+    yield "jobs_completed_total", "counter", "已结束的异步任务数", [({"status": st}, n) for st, n in jobs["completed"].items()]
+    yield "jobs_rejected_total", "counter", "因队列已满被拒绝的异步任务数", [({}, jobs["rejected"])]
+
+
+metrics_registry.register_collector(_component_metrics)
+
+
+@app.get("/metrics", summary="Prometheus 指标", tags=["监控"])
+async def metrics():
+    """以 Prometheus 文本格式导出延迟直方图、计数器和各组件状态"""
+    return Response(content=metrics_registry.render(), media_type=METRICS_CONTENT_TYPE)
+
+@app.get("/debug/traces", summary="最近的 trace", tags=["监控"])
+async def list_traces(limit: int = 50):
+    """列出内存缓冲区中最近的 trace 摘要"""
+    return {"traces": tracer.exporter.recent(limit)}
+
+
+@app.get("/debug/traces/{trace_id}", summary="查看 trace", tags=["监控"])
+async def get_trace(trace_id: str):
+    """返回一个 trace 的所有 span（按开始时间排序）"""
+    spans = tracer.exporter.get(trace_id.lower())
+    if spans is None:
+        raise HTTPException(status_code=404, detail="trace 不存在（未被采样或已被淘汰）")
+    return {"trace_id": trace_id.lower(), "spans": spans}
+
 @app.get("/", response_class=HTMLResponse)
-async def root():
-    """返回聊天界面主页"""
-    content = _load_html_content()
-    return HTMLResponse(content=content)
+async def root(request: Request):
+    """返回聊天界面主页（每次都需要用 ETag 重新验证，界面更新后立即生效）"""
+    response = static_assets.response(request, "index.html", cache_control="no-cache")
+    if response is None:
+        return HTMLResponse(content="<h1>Error loading chat interface</h1><p>static/index.html 不存在</p>", status_code=500)
+    return response
+
+
+@app.api_route("/static/{path:path}", methods=["GET", "HEAD"], include_in_schema=False)
+async def static_file(path: str, request: Request):
+    """返回内存中的静态文件，支持 gzip / brotli 和 304"""
+    response = static_assets.response(request, path)
+    if response is None:
+        raise HTTPException(status_code=404, detail="Not Found")
+    return response
+
+
+def _resolve_conversation_turn(request: ChatRequest):
+    """
+    解析会话模式的请求，返回 (会话, 父消息 ID, 新的用户消息或 None)；新会话返回的会话为 None
+
+    - 提供 message：新的用户消息接在 parent_id（默认为当前分支末端）之后
+    - 省略 message：parent_id 必须指向一条用户消息，重新生成它的回答
+    """
+    if request.conversation_id is None:
+        if request.message is None or request.parent_id is not None:
+            raise HTTPException(status_code=400, detail="新会话只需提供 message")
+        return None, None, {"role": "user", "content": request.message}
+    conversation = conversation_store.get(request.conversation_id)
+    if conversation is None:
+        raise HTTPException(status_code=404, detail="会话不存在或已过期")
+    # 至少还要写入一条回答，已满时在执行 Agentic Loop 之前拒绝
+    if len(conversation.nodes) + 2 > conversation.max_messages:
+        raise HTTPException(status_code=413, detail=f"会话消息数超过上限 {conversation.max_messages}")
+    
+    parent_id = request.parent_id if request.parent_id is not None else conversation.head
+    if parent_id is not None and not conversation.has(parent_id):
+        raise HTTPException(status_code=404, detail="parent_id 不存在")
+    if request.message is not None:
+        return conversation, parent_id, {"role": "user", "content": request.message}
+    if request.parent_id is None or conversation.role_of(parent_id) != "user":
+        raise HTTPException(status_code=400, detail="重新生成时 parent_id 必须指向一条用户消息")
+    return conversation, parent_id, None
 
 
 @app.post("/api/chat", summary="聊天 API（简化版）")
@@ -237,35 +1122,98 @@ async def chat_api(request: ChatRequest):
     """
     简化的聊天 API，用于前端调用
     
-    接收消息列表，返回 AI 的回复
+    接收消息列表，返回 AI 的回复。
+    
+    会话模式：提供 `message`（以及后续轮次的 `conversation_id`）时历史保存在服务端，
+    客户端每轮只上传新消息；响应中返回 `conversation_id` 和新消息的 ID。
+    用 `parent_id` 指向更早的消息即可编辑或重新生成，新分支与原分支共享公共前缀。
+    创建新会话时可以同时提供 `messages` 作为已有的历史。
+    
+    未指定 `model` 时由模型路由器按问题选择模型，响应中的 `model` 为实际使用的模型。
     """
-    try:
+    conversation_mode = request.conversation_id is not None or request.message is not None
+    # 新会话可以用 messages 预置历史（如客户端的会话已过期）
+    seed: List[Dict[str, Any]] = []
+    if conversation_mode:
+        conversation, parent_id, user_message = _resolve_conversation_turn(request)
+        if conversation is not None:
+            conversation.checkout(parent_id)
+            messages = conversation.messages()
+        else:
+            seed = [{"role": msg.role, "content": msg.content} for msg in request.messages or []]
+            messages = list(seed)
+        if user_message is not None:
+            messages.append(user_message)
+    elif request.messages:
         # 转换为 OpenAI 格式
         messages = [{"role": msg.role, "content": msg.content} for msg in request.messages]
-        
-        # 调用 chat_completions 端点
-        chat_request = {
-            "model": "gpt-5",
-            "messages": messages
-        }
-        
-        # 直接调用内部的 chat_completions 逻辑
-        response_data = await chat_completions(chat_request, None)
+    else:
+        raise HTTPException(status_code=400, detail="需要提供 messages，或使用 conversation_id / message")
+    
+    try:
+        # 直接调用内部的 Agentic Loop 逻辑（交互式通道，优先于 API 流量）
+        transcript: List[Dict[str, Any]] = []
+        with tracer.trace("POST /api/chat", conversation=conversation_mode):
+            with tracer.span("admission", lane="interactive"):
+                release = await admission.acquire("interactive")
+            try:
+                route = _route_model(messages, request.model)
+                response_data = await run_agentic_loop(messages, {}, transcript=transcript, route=route)
+            finally:
+                release()
         
         # 提取回复内容
         choice = response_data.get("choices", [{}])[0]
         message = choice.get("message", {})
         content = message.get("content", "")
         
+        if not conversation_mode:
+            return {
+                "content": content,
+                "role": "assistant",
+                "model": route.model
+            }
+        
+        # 本轮的用户消息、工具调用消息和最终回答一起写入会话（失败的轮次不写入，新会话也在成功后才创建）
+        if conversation is None:
+            conversation = conversation_store.create()
+        new_messages = seed + ([user_message] if user_message is not None else []) + transcript
+        new_messages.append({"role": "assistant", "content": content})
+        ids = conversation.append(parent_id, new_messages)
         return {
             "content": content,
-            "role": "assistant"
+            "role": "assistant",
+            "model": route.model,
+            "conversation_id": conversation.id,
+            "message_id": ids[-1],
+            "user_message_id": ids[len(seed)] if user_message is not None else parent_id
         }
+    except Overloaded as e:
+        logger.warning("聊天 API 被准入控制拒绝: %s", e)
+        raise _to_http_exception(e)
+    except ConversationLimitError as e:
+        raise HTTPException(status_code=413, detail=str(e))
     except Exception as e:
-        logger.error(f"聊天 API 错误: {str(e)}")
+        logger.error("聊天 API 错误: %s", e)
         raise HTTPException(status_code=500, detail=f"聊天 API 错误: {str(e)}")
 
 
+@app.get("/api/conversations/{conversation_id}", summary="查看会话", tags=["Chat API"])
+async def get_conversation(conversation_id: str):
+    """返回会话当前分支上的消息（包括工具调用消息）及其 ID"""
+    conversation = conversation_store.get(conversation_id)
+    if conversation is None:
+        raise HTTPException(status_code=404, detail="会话不存在或已过期")
+    return conversation.to_dict()
+
+
+@app.delete("/api/conversations/{conversation_id}", summary="删除会话", tags=["Chat API"])
+async def delete_conversation(conversation_id: str):
+    if not conversation_store.delete(conversation_id):
+        raise HTTPException(status_code=404, detail="会话不存在或已过期")
+    return {"deleted": True}
+
+
 @app.post(
     "/hello",
     summary="Hello 问候接口",
@@ -283,6 +1231,53 @@ async def hello(request: NameRequest):
     return {"message": f"hello, {request.name}"}
 
 
+async def _fetch_joke() -> Dict[str, Any]:
+    """调用 grok-4-fast 生成一个笑话，失败时抛出 httpx 异常"""
+    url = f"{AI_BUILDER_BASE_URL}/v1/chat/completions"
+    
+    request_data = {
+        "model": "grok-4-fast",
+        "messages": [
+            {
+                "role": "user",
+                "content": "请给我讲一个有趣的笑话，用中文回答。"
+            }
+        ],
+        "temperature": 0.7,
+        "max_tokens": 500
+    }
+    
+    async def send():
+        async with _observe_upstream("chat", request_data["model"]):
+            response = await get_http_client().post(url, **_json_body(request_data))
+            response.raise_for_status()
+        return fastjson.loads(response.content)
+    
+    result = await upstream_resilience.call("joke", send)
+    
+    # 提取回复内容
+    choice = result.get("choices", [{}])[0]
+    message = choice.get("message", {})
+    content = message.get("content", "")
+    
+    usage = result.get("usage", {})
+    
+    return {
+        "joke": content,
+        "model": "grok-4-fast",
+        "usage": usage
+    }
+
+
+# 笑话池：后台保持若干个新鲜笑话，/api/joke 直接从内存返回
+joke_pool = JokePool(
+    _fetch_joke,
+    low_watermark=JOKE_POOL_LOW_WATERMARK,
+    high_watermark=JOKE_POOL_HIGH_WATERMARK,
+    max_age=JOKE_POOL_MAX_AGE
+)
+
+
 @app.get(
     "/api/joke",
     summary="获取笑话 (使用 grok-4-fast)",
@@ -293,58 +1288,31 @@ async def get_joke():
     使用 grok-4-fast 模型获取一个中文笑话
     """
     try:
-        url = f"{AI_BUILDER_BASE_URL}/v1/chat/completions"
-        headers = {
-            "Authorization": f"Bearer {AI_BUILDER_API_KEY}",
-            "Content-Type": "application/json"
-        }
-        
-        request_data = {
-            "model": "grok-4-fast",
-            "messages": [
-                {
-                    "role": "user",
-                    "content": "请给我讲一个有趣的笑话，用中文回答。"
-                }
-            ],
-            "temperature": 0.7,
-            "max_tokens": 500
-        }
+        # 优先从后台预填充的笑话池中取，池为空时才实时调用
+        joke = joke_pool.take() if JOKE_POOL_ENABLED else None
+        if joke is not None:
+            return joke
         
-        logger.info(f"调用 grok-4-fast 获取笑话...")
-        
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            response = await client.post(url, json=request_data, headers=headers)
-            response.raise_for_status()
-            result = response.json()
-            
-            # 提取回复内容
-            choice = result.get("choices", [{}])[0]
-            message = choice.get("message", {})
-            content = message.get("content", "")
-            
-            usage = result.get("usage", {})
-            
-            return {
-                "joke": content,
-                "model": "grok-4-fast",
-                "usage": usage
-            }
+        logger.info("笑话池为空，调用 grok-4-fast 获取笑话...")
+        return await _fetch_joke()
             
+    except CircuitOpenError as e:
+        logger.warning("笑话接口快速失败: %s", e)
+        raise _to_http_exception(e)
     except httpx.HTTPStatusError as e:
-        logger.error(f"HTTP 错误: {e.response.status_code} - {e.response.text}")
+        logger.error("HTTP 错误: %d - %s", e.response.status_code, e.response.text)
         raise HTTPException(
             status_code=e.response.status_code,
             detail=f"AI Builder API 错误: {e.response.text}"
         )
     except httpx.RequestError as e:
-        logger.error(f"连接错误: {str(e)}")
+        logger.error("连接错误: %s", e)
         raise HTTPException(
             status_code=503,
             detail=f"无法连接到 AI Builder API: {str(e)}"
         )
     except Exception as e:
-        logger.error(f"服务器错误: {str(e)}")
+        logger.error("服务器错误: %s", e)
         raise HTTPException(
             status_code=500,
             detail=f"服务器错误: {str(e)}"
@@ -363,31 +1331,14 @@ async def search(request: SearchRequest):
     接收搜索关键词，转发到 AI Builder Space 的搜索 API。
     """
     try:
-        # 构建请求数据
-        request_data = {
-            "keywords": request.keywords,
-            "max_results": request.max_results
-        }
-        
-        # 构建 AI Builder API 的完整 URL
-        url = f"{AI_BUILDER_BASE_URL}/v1/search/"
-        
-        # 准备请求头
-        headers = {
-            "Authorization": f"Bearer {AI_BUILDER_API_KEY}",
-            "Content-Type": "application/json"
-        }
-        
-        # 转发请求到 AI Builder API
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            response = await client.post(
-                url,
-                json=request_data,
-                headers=headers
-            )
-            response.raise_for_status()
-            return response.json()
+        # 转发请求到 AI Builder API（相同关键词在 TTL 内直接命中缓存）
+        # 单个关键词的结果未经修改，直接返回上游的原始字节
+        return JSONBytesResponse(await cached_search(request.keywords, request.max_results))
             
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except CircuitOpenError as e:
+        raise _to_http_exception(e)
     except httpx.HTTPStatusError as e:
         raise HTTPException(
             status_code=e.response.status_code,
@@ -405,56 +1356,242 @@ async def search(request: SearchRequest):
         )
 
 
-@app.post(
-    "/v1/chat/completions",
-    summary="Chat Completions (OpenAI 兼容 + Agentic Loop)",
-    tags=["Chat API"]
-)
-async def chat_completions(
-    request: Dict[str, Any] = Body(...),
-    authorization: Optional[str] = Header(None, alias="Authorization")
-):
+# 轮次耗时估计（指数加权移动平均），用于判断剩余预算能否再容纳一轮工具调用
+_round_estimates = {"tool": AGENTIC_TOOL_ROUND_ESTIMATE, "final": AGENTIC_FINAL_ROUND_ESTIMATE}
+
+
+def _record_round_latency(kind: str, seconds: float):
+    """记录一轮的实际耗时（kind: tool 为带工具执行的轮次，final 为生成答案的轮次）"""
+    _round_estimates[kind] = 0.8 * _round_estimates[kind] + 0.2 * seconds
+    ROUND_LATENCY.labels(kind).observe(seconds)
+    ROUNDS.labels(kind).inc()
+
+
+def _remaining(deadline: float) -> float:
+    """距离截止时间的剩余秒数"""
+    return deadline - time.monotonic()
+
+
+def resolve_deadline(request: Dict[str, Any], header_timeout: Optional[str] = None) -> float:
     """
-    Chat Completions 接口 - 支持多轮 Agentic Loop
+    根据请求体的 request_timeout 字段或 X-Request-Timeout 请求头（秒）计算截止时间，
+    都未提供时使用服务端默认值，并限制在 AGENTIC_MAX_DEADLINE 以内
+    """
+    raw = request.get("request_timeout", header_timeout)
+    if raw is None:
+        timeout = AGENTIC_DEFAULT_DEADLINE
+    else:
+        try:
+            timeout = float(raw)
+        except (TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="request_timeout 必须是秒数")
+        if timeout <= 0:
+            raise HTTPException(status_code=400, detail="request_timeout 必须大于 0")
+    return time.monotonic() + min(timeout, AGENTIC_MAX_DEADLINE)
+
+
+async def execute_tool_call(
+    tool_call: Dict[str, Any],
+    idx: int,
+    total: int,
+    current_round: int,
+    emit: EventCallback,
+    deadline: Optional[float] = None
+) -> Dict[str, Any]:
+    """执行单个工具调用并返回结果（超时和异常都转为错误结果）"""
+    tool_name = tool_call.get("function", {}).get("name", "unknown")
+    tool_id = tool_call.get("id", "unknown")
     
-    接收 OpenAI 格式的请求，实现 agentic loop：
-    1. 第一轮：提供搜索工具，LLM 决定是否调用
-    2. 第二轮：如果第一轮有工具调用，仍然提供工具，可以继续调用
-    3. 第三轮：强制不提供工具，生成最终答案
+    _log_detail(
+        "工具调用开始 [%d/%d]: %s (id=%s)", idx, total, tool_name, tool_id,
+        event="tool_call_start", tool=tool_name, tool_call_id=tool_id, round=current_round
+    )
+    await emit({
+        "type": "tool_call_start",
+        "round": current_round,
+        "tool_call_id": tool_id,
+        "name": tool_name,
+        "arguments": tool_call.get("function", {}).get("arguments")
+    })
     
-    最多执行3轮，前2轮可以调用工具，第3轮强制生成答案。
+    # 工具超时不超过请求的剩余预算，并为之后强制生成答案的一轮留出预计耗时
+    timeout = max(_remaining(deadline) - _round_estimates["final"], 0.0) if deadline is not None else None
+    start = time.monotonic()
+    # 未注册的工具名来自模型输出，统一记为 unknown，避免标签无限增长
+    metric_name = tool_name if tool_registry.get(tool_name) else "unknown"
+    with tracer.span("tool", tool=metric_name, tool_call_id=tool_id, round=current_round) as span:
+        result = await tool_registry.dispatch(tool_call, timeout=timeout)
+        outcome = "error" if "error" in result else "ok"
+        if outcome == "error":
+            span.set_status("error", str(result["error"]))
+    elapsed = time.monotonic() - start
+    TOOL_LATENCY.labels(metric_name, outcome).observe(elapsed)
+    TOOL_CALLS.labels(metric_name, outcome).inc()
+    logger.info(
+        "工具调用完成: %s (%s, %.3f 秒)", metric_name, outcome, elapsed,
+        extra={"event": "tool_call", "tool": metric_name, "outcome": outcome, "duration": round(elapsed, 4), "round": current_round}
+    )
+    
+    await emit({
+        "type": "tool_call_end",
+        "round": current_round,
+        "tool_call_id": tool_id,
+        "name": tool_name,
+        "ok": "error" not in result
+    })
+    return {
+        "tool_call_id": tool_call["id"],
+        "result": result
+    }
+
+
+def _requested_model(body: Dict[str, Any]) -> Optional[str]:
+    """请求体中指定的模型（省略或 "auto" 时由路由器选择）"""
+    model = body.get("model")
+    if model is not None and (not isinstance(model, str) or not model.strip()):
+        raise HTTPException(status_code=400, detail="model 必须是非空字符串")
+    return model
+
+
+def _route_model(messages: List[Dict[str, Any]], requested: Optional[str] = None) -> RouteDecision:
+    """为一次请求选择模型并记录决策"""
+    route = model_router.route(messages, requested)
+    ROUTE_DECISIONS.labels(model_router.label(route.model), route.reason).inc()
+    logger.info(
+        "模型路由: %s（%s）", route.model, route.reason,
+        extra={"event": "model_routed", "model": route.model, "reason": route.reason}
+    )
+    return route
+
+
+async def run_agentic_loop(
+    messages: List[Dict[str, Any]],
+    extra_params: Dict[str, Any],
+    on_event: Optional[EventCallback] = None,
+    stream: bool = False,
+    deadline: Optional[float] = None,
+    speculative: Optional[bool] = None,
+    transcript: Optional[List[Dict[str, Any]]] = None,
+    route: Optional[RouteDecision] = None
+) -> Dict[str, Any]:
     """
-    # 获取原始消息和其他参数
-    messages = request.get("messages", []).copy()
-    if not messages:
-        raise HTTPException(status_code=400, detail="messages 字段不能为空")
+    执行多轮 Agentic Loop，返回最后一轮的上游响应
     
+    - on_event: 可选的进度回调，每轮开始、每个工具调用开始/结束时触发；
+      流式模式下还会收到上游的内容增量（type=delta）
+    - stream: 是否以流式方式调用上游
+    - deadline: time.monotonic() 下的截止时间，默认使用 AGENTIC_DEFAULT_DEADLINE。
+      剩余预算容纳不下一轮工具调用加最终回答时，提前强制生成答案；
+      每次上游调用和工具调用的超时都不超过剩余预算，超出时抛出 asyncio.TimeoutError
+    - speculative: 是否在第一轮调用期间推测性预取搜索结果，默认 SPECULATIVE_SEARCH_ENABLED
+    - transcript: 可选，成功结束时追加本次循环产生的 assistant（tool_calls）和 tool 消息（不含最终回答）
+    - route: 调用方已做出的模型路由决策，默认由 model_router 按消息内容选择；所有轮次使用同一个模型
+    """
+    if route is None:
+        route = _route_model(messages)
+    extra_params = {**extra_params, "model": route.model}
+    span = Tracer.current()
+    if span is not None:
+        span.set_attribute("model", route.model)
+    REQUESTS_IN_FLIGHT.inc()
+    start = time.monotonic()
+    outcome = "ok"
     try:
-        # 提取其他参数（如 max_tokens），但不包括 messages 和 model
-        extra_params = {k: v for k, v in request.items() if k not in ["messages", "model"]}
-        
-        max_rounds = 3  # 最多3轮
-        current_round = 1
-        
-        logger.info("=" * 60)
-        logger.info(f"开始 Agentic Loop，最多 {max_rounds} 轮")
-        logger.info("=" * 60)
-        
-        while current_round <= max_rounds:
-            # 决定是否提供工具：前2轮提供工具，第3轮不提供
+        if on_event:
+            await on_event({"type": "route", **route.to_dict()})
+        return await _agentic_loop(messages, extra_params, on_event, stream, deadline, speculative, transcript)
+    except asyncio.TimeoutError:
+        outcome = "timeout"
+        raise
+    except Exception:
+        outcome = "error"
+        raise
+    except BaseException:
+        outcome = "cancelled"
+        raise
+    finally:
+        REQUESTS_IN_FLIGHT.dec()
+        elapsed = time.monotonic() - start
+        REQUEST_LATENCY.labels("true" if stream else "false", outcome).observe(elapsed)
+        MODEL_REQUEST_LATENCY.labels(model_router.label(route.model), outcome).observe(elapsed)
+        model_router.observe(route.model, elapsed, outcome)
+
+
+async def _agentic_loop(
+    messages: List[Dict[str, Any]],
+    extra_params: Dict[str, Any],
+    on_event: Optional[EventCallback] = None,
+    stream: bool = False,
+    deadline: Optional[float] = None,
+    speculative: Optional[bool] = None,
+    transcript: Optional[List[Dict[str, Any]]] = None
+) -> Dict[str, Any]:
+    """run_agentic_loop 的实现"""
+    messages = list(messages)
+    history_length = len(messages)
+    max_rounds = AGENTIC_MAX_ROUNDS
+    current_round = 1
+    if deadline is None:
+        deadline = time.monotonic() + AGENTIC_DEFAULT_DEADLINE
+    
+    async def emit(event: Dict[str, Any]):
+        if on_event:
+            await on_event(event)
+    
+    logger.info("开始 Agentic Loop，最多 %d 轮", max_rounds, extra={"event": "loop_start", "max_rounds": max_rounds, "stream": stream})
+    
+    # 推测性搜索与第一轮 LLM 调用并行进行
+    if speculative is None:
+        speculative = SPECULATIVE_SEARCH_ENABLED
+    prefetched = search_speculator.start(messages) if speculative else set()
+    speculating = bool(prefetched)
+    
+    while current_round <= max_rounds:
+        with tracer.span("round", round=current_round) as round_span:
+            round_start = time.monotonic()
+            remaining = _remaining(deadline)
+            
+            # 决定是否提供工具：最后一轮不提供；剩余预算不够再跑一轮工具加最终回答时也不提供
             provide_tools = current_round < max_rounds
+            deadline_forced = provide_tools and remaining < _round_estimates["tool"] + _round_estimates["final"]
+            if deadline_forced:
+                provide_tools = False
+                max_rounds = current_round
+            tools = tool_registry.schemas() if provide_tools else None
             
-            logger.info(f"\n[第 {current_round} 轮]")
-            logger.info(f"  提供工具: {'是' if provide_tools else '否（最后一轮，强制生成答案）'}")
+            # 不提供工具时强制生成答案：最后一轮，或剩余预算不足以再执行一轮工具调用
+            logger.info(
+                "第 %d 轮开始（剩余预算 %.1f 秒，提供工具: %s）", current_round, remaining, provide_tools,
+                extra={"event": "round_start", "round": current_round, "remaining": round(remaining, 3),
+                       "tools": provide_tools, "deadline_forced": deadline_forced}
+            )
+            round_span.set_attribute("tools", provide_tools)
+            round_span.set_attribute("deadline_forced", deadline_forced)
+            await emit({
+                "type": "round_start",
+                "round": current_round,
+                "tools": provide_tools,
+                "remaining": round(remaining, 3),
+                "deadline_forced": deadline_forced
+            })
+            
+            # 超出 token 预算时压缩较早的轮次（只影响发送给上游的内容，本地历史保持完整）；
+            # 生成摘要的时间不超过剩余预算减去本轮的预计耗时，预算不足时跳过摘要
+            if CONTEXT_COMPACTION_ENABLED:
+                round_estimate = _round_estimates["final"] + (_round_estimates["tool"] if provide_tools else 0.0)
+                round_messages = await context_manager.compact(messages, timeout=_remaining(deadline) - round_estimate)
+            else:
+                round_messages = messages
+            if round_messages is not messages:
+                logger.info("上下文已压缩: %d 条消息 -> %d 条", len(messages), len(round_messages), extra={"event": "context_compacted"})
             
-            # 调用 AI Builder API
-            if provide_tools:
-                logger.info(f"  调用 AI Builder API（带工具）...")
-                response = await call_ai_builder_api(messages, tools=[SEARCH_TOOL], extra_params=extra_params)
+            # 上游调用的超时收缩到剩余预算
+            if stream:
+                round_call = _stream_round(round_messages, tools, extra_params, on_event)
             else:
-                # 最后一轮：强制不提供工具
-                logger.info(f"  调用 AI Builder API（不带工具，强制生成最终答案）...")
-                response = await call_ai_builder_api(messages, tools=None, extra_params=extra_params)
+                round_call = call_ai_builder_api(round_messages, tools=tools, extra_params=extra_params)
+            response = await asyncio.wait_for(round_call, timeout=max(_remaining(deadline), 0.0))
+            _record_usage(response)
             
             # 检查响应
             choice = response.get("choices", [{}])[0]
@@ -462,20 +1599,23 @@ async def chat_completions(
             tool_calls = message.get("tool_calls")
             content = message.get("content", "")
             
-            logger.info(f"  响应内容预览: {content[:100] if content else 'None'}...")
-            logger.info(f"  工具调用数量: {len(tool_calls) if tool_calls else 0}")
+            _log_detail("响应内容预览: %s", content[:100] if content else None, event="round_response", round=current_round)
+            round_span.set_attribute("tool_calls", len(tool_calls) if tool_calls else 0)
             
             # 如果没有工具调用，或者已经是最后一轮，直接返回结果
             if not tool_calls or current_round == max_rounds:
-                if not tool_calls:
-                    logger.info(f"  没有工具调用，返回结果")
-                else:
-                    logger.info(f"  第 {max_rounds} 轮有工具调用，但已到最大轮数，强制返回结果")
-                logger.info("=" * 60)
+                # 最后一轮仍有工具调用时忽略，直接返回结果
+                elapsed = time.monotonic() - round_start
+                logger.info(
+                    "第 %d 轮返回结果（%.3f 秒，忽略的工具调用: %d）", current_round, elapsed, len(tool_calls) if tool_calls else 0,
+                    extra={"event": "round_end", "round": current_round, "kind": "final", "duration": round(elapsed, 4)}
+                )
+                _record_round_latency("final", elapsed)
+                if transcript is not None:
+                    transcript.extend(messages[history_length:])
                 return response
             
             # 有工具调用且不是最后一轮，执行工具并继续下一轮
-            logger.info(f"  检测到 {len(tool_calls)} 个工具调用，开始执行...")
             
             # 添加 assistant message（包含所有 tool_calls）
             messages.append({
@@ -484,61 +1624,19 @@ async def chat_completions(
                 "tool_calls": tool_calls
             })
             
-            # 定义单个工具调用的执行函数
-            async def execute_single_tool_call(tool_call: Dict[str, Any], idx: int) -> Dict[str, Any]:
-                """执行单个工具调用并返回结果"""
-                tool_name = tool_call.get("function", {}).get("name", "unknown")
-                tool_id = tool_call.get("id", "unknown")
-                
-                logger.info(f"\n  [工具调用 {idx}/{len(tool_calls)}]")
-                logger.info(f"    工具名称: {tool_name}")
-                logger.info(f"    工具调用 ID: {tool_id}")
-                
-                if tool_name == "search":
-                    # 解析参数
-                    function_args = json.loads(tool_call["function"]["arguments"])
-                    keywords = function_args.get("keywords", [])
-                    max_results = function_args.get("max_results", 6)
-                    
-                    logger.info(f"    参数:")
-                    logger.info(f"      - keywords: {keywords}")
-                    logger.info(f"      - max_results: {max_results}")
-                    
-                    # 执行搜索
-                    logger.info(f"    执行搜索...")
-                    search_result = await execute_search(keywords, max_results)
-                    
-                    # 记录搜索结果摘要
-                    if "error" in search_result:
-                        logger.warning(f"    搜索结果: 错误 - {search_result.get('error', 'Unknown error')}")
-                    else:
-                        queries = search_result.get("queries", [])
-                        combined_answer = search_result.get("combined_answer")
-                        logger.info(f"    搜索结果:")
-                        logger.info(f"      - 查询数量: {len(queries)}")
-                        if combined_answer:
-                            logger.info(f"      - 组合答案: {combined_answer[:200]}...")
-                        for q_idx, query in enumerate(queries[:2], 1):  # 只显示前2个查询的摘要
-                            keyword = query.get("keyword", "unknown")
-                            response_data = query.get("response", {})
-                            results = response_data.get("results", [])
-                            logger.info(f"      - 查询 {q_idx} ({keyword}): {len(results)} 个结果")
-                    
-                    logger.info(f"    工具调用完成")
-                    return {
-                        "tool_call_id": tool_call["id"],
-                        "result": search_result
-                    }
-                else:
-                    logger.warning(f"    未知工具类型: {tool_name}，跳过执行")
-                    return {
-                        "tool_call_id": tool_call["id"],
-                        "result": {"error": f"未知工具类型: {tool_name}"}
-                    }
+            if speculating:
+                hits = search_speculator.observe(prefetched, _requested_search_keywords(tool_calls))
+                if hits:
+                    logger.info("推测性搜索命中 %d 个关键词", hits, extra={"event": "speculative_hit"})
             
-            # 并行执行所有工具调用
-            logger.info(f"  开始并行执行 {len(tool_calls)} 个工具调用...")
-            tasks = [execute_single_tool_call(tool_call, idx+1) for idx, tool_call in enumerate(tool_calls)]
+            # 通过工具注册表并行执行所有工具调用（同一轮内的并发数有上限）
+            round_semaphore = asyncio.Semaphore(TOOL_ROUND_CONCURRENCY)
+            
+            async def run_tool_call(tool_call: Dict[str, Any], idx: int) -> Dict[str, Any]:
+                async with round_semaphore:
+                    return await execute_tool_call(tool_call, idx, len(tool_calls), current_round, emit, deadline)
+            
+            tasks = [run_tool_call(tool_call, idx+1) for idx, tool_call in enumerate(tool_calls)]
             tool_results = await asyncio.gather(*tasks)
             
             # 按顺序将结果添加到消息列表（保持工具调用ID的顺序）
@@ -548,42 +1646,457 @@ async def chat_completions(
                 messages.append({
                     "role": "tool",
                     "tool_call_id": tool_call_id,
-                    "content": json.dumps(result, ensure_ascii=False)
+                    "content": fastjson.dumps_str(result)
                 })
             
-            logger.info(f"  所有工具调用完成，结果已添加到消息历史")
+            elapsed = time.monotonic() - round_start
+            logger.info(
+                "第 %d 轮完成: %d 个工具调用（%.3f 秒）", current_round, len(tool_calls), elapsed,
+                extra={"event": "round_end", "round": current_round, "kind": "tool", "duration": round(elapsed, 4)}
+            )
+            _record_round_latency("tool", elapsed)
             
             # 进入下一轮
-            logger.info(f"\n  第 {current_round} 轮完成，准备进入第 {current_round + 1} 轮...")
             current_round += 1
-        
-        # 理论上不应该到达这里，但为了安全起见
-        return response
-            
-    except HTTPException:
-        # 重新抛出 HTTPException（如 400 错误）
-        raise
-    except httpx.HTTPStatusError as e:
-        raise HTTPException(
+    
+    # 理论上不应该到达这里，但为了安全起见
+    return response
+
+
+def _to_http_exception(e: Exception) -> HTTPException:
+    """将 Agentic Loop 中的异常转换为对应的 HTTPException"""
+    if isinstance(e, HTTPException):
+        return e
+    if isinstance(e, (CircuitOpenError, Overloaded)):
+        return HTTPException(
+            status_code=503,
+            detail=str(e),
+            headers={"Retry-After": str(max(1, int(e.retry_after)))}
+        )
+    if isinstance(e, (asyncio.TimeoutError, httpx.TimeoutException)):
+        return HTTPException(
+            status_code=504,
+            detail="请求超出截止时间，上游未能及时响应"
+        )
+    if isinstance(e, httpx.HTTPStatusError):
+        return HTTPException(
             status_code=e.response.status_code,
             detail=f"AI Builder API 错误: {e.response.text}"
         )
-    except httpx.RequestError as e:
-        raise HTTPException(
+    if isinstance(e, httpx.RequestError):
+        return HTTPException(
             status_code=503,
             detail=f"无法连接到 AI Builder API: {str(e)}"
         )
-    except Exception as e:
-        raise HTTPException(
-            status_code=500,
-            detail=f"服务器错误: {str(e)}"
+    return HTTPException(
+        status_code=500,
+        detail=f"服务器错误: {str(e)}"
+    )
+
+
+async def _release_after(stream: AsyncIterator[str], release: Callable[[], None]) -> AsyncIterator[str]:
+    """转发流式响应，结束时归还准入名额"""
+    try:
+        async for item in stream:
+            yield item
+    finally:
+        release()
+
+
+def _sse_event(data: Dict[str, Any]) -> str:
+    """格式化一条 SSE data 事件"""
+    return f"data: {fastjson.dumps_str(data)}\n\n"
+
+
+async def _stream_chat_completions(
+    messages: List[Dict[str, Any]],
+    extra_params: Dict[str, Any],
+    route: RouteDecision,
+    deadline: Optional[float] = None,
+    speculative: Optional[bool] = None,
+    trace: Optional[Span] = None
+) -> AsyncIterator[str]:
+    """
+    以 OpenAI 兼容的 text/event-stream 格式输出 Agentic Loop
+    
+    - 每轮开始、每个工具调用开始/结束时输出一个空 delta 的 chunk，
+      进度信息放在扩展字段 "agentic" 中（标准 OpenAI 客户端会忽略）
+    - 上游的内容增量到达后立即以 delta.content 转发
+    - 最后输出带 finish_reason 的 chunk 和 [DONE]
+    - route: 模型路由决策，chunk 的 model 字段为路由到的模型
+    - trace: 请求的根 span，流结束时结束
+    """
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    created = int(time.time())
+    queue: asyncio.Queue = asyncio.Queue()
+    
+    def make_chunk(delta: Dict[str, Any], finish_reason: Optional[str] = None) -> Dict[str, Any]:
+        return {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": route.model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+        }
+    
+    async def runner():
+        try:
+            with tracer.activate(trace):
+                response = await run_agentic_loop(
+                    messages, extra_params, on_event=queue.put, stream=True, deadline=deadline,
+                    speculative=speculative, route=route
+                )
+            await queue.put({"type": "done", "response": response})
+        except Exception as e:
+            await queue.put({"type": "error", "error": e})
+    
+    task = asyncio.create_task(runner())
+    try:
+        # 立即输出 role chunk，缩短首字节时间
+        yield _sse_event(make_chunk({"role": "assistant", "content": ""}))
+        while True:
+            event = await queue.get()
+            event_type = event["type"]
+            if event_type == "delta":
+                yield _sse_event(make_chunk({"content": event["content"]}))
+            elif event_type == "done":
+                response = event["response"]
+                choice = response.get("choices", [{}])[0]
+                final_chunk = make_chunk({}, choice.get("finish_reason") or "stop")
+                if response.get("usage"):
+                    final_chunk["usage"] = response["usage"]
+                yield _sse_event(final_chunk)
+                break
+            elif event_type == "error":
+                http_error = _to_http_exception(event["error"])
+                logger.error("流式 Agentic Loop 错误: %s", http_error.detail)
+                if trace is not None:
+                    trace.set_status("error", str(http_error.detail))
+                yield _sse_event({"error": {"message": http_error.detail, "code": http_error.status_code}})
+                break
+            else:
+                chunk = make_chunk({})
+                chunk["agentic"] = event
+                yield _sse_event(chunk)
+        yield "data: [DONE]\n\n"
+    finally:
+        # 客户端断开时取消仍在执行的 Agentic Loop
+        if not task.done():
+            task.cancel()
+        if trace is not None:
+            trace.end()
+
+
+# 请求体中不转发给上游的字段
+_NON_UPSTREAM_FIELDS = ("messages", "model", "request_timeout", "speculative_search", "verbose_logging")
+
+
+async def _read_json_object(raw_request: Request) -> Dict[str, Any]:
+    """用 fastjson 解析请求体（替代 FastAPI 的 Body 解析），要求为 JSON 对象"""
+    try:
+        body = fastjson.loads(await raw_request.body())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"请求体不是合法的 JSON: {str(e)}")
+    if not isinstance(body, dict):
+        raise HTTPException(status_code=400, detail="请求体必须是 JSON 对象")
+    return body
+
+
+@app.post(
+    "/v1/chat/completions",
+    summary="Chat Completions (OpenAI 兼容 + Agentic Loop)",
+    tags=["Chat API"],
+    openapi_extra={"requestBody": {"required": True, "content": {"application/json": {"schema": {"type": "object"}}}}}
+)
+async def chat_completions(
+    raw_request: Request,
+    authorization: Optional[str] = Header(None, alias="Authorization"),
+    x_request_timeout: Optional[str] = Header(None, alias="X-Request-Timeout"),
+    traceparent: Optional[str] = Header(None)
+):
+    """
+    Chat Completions 接口 - 支持多轮 Agentic Loop
+    
+    接收 OpenAI 格式的请求，实现 agentic loop：
+    1. 第一轮：提供搜索工具，LLM 决定是否调用
+    2. 第二轮：如果第一轮有工具调用，仍然提供工具，可以继续调用
+    3. 第三轮：强制不提供工具，生成最终答案
+    
+    最多执行3轮，前2轮可以调用工具，第3轮强制生成答案。
+    
+    整个请求受截止时间约束（请求体 `request_timeout` 或请求头 `X-Request-Timeout`，单位秒，
+    默认 AGENTIC_DEFAULT_DEADLINE）：剩余预算不足以再执行一轮工具调用时提前强制生成答案，
+    超出截止时间返回 504。
+    
+    设置 `stream: true` 时返回 OpenAI 兼容的 `text/event-stream`：
+    每轮和每个工具调用的进度以 chunk 的 `agentic` 扩展字段实时推送，
+    最终回答的 token 增量随上游到达即时转发。
+    
+    `model` 省略或为 `"auto"` 时由模型路由器选择：简单、简短的问题使用快速模型（MODEL_ROUTER_FAST_MODEL），
+    复杂或需要搜索的问题使用强模型（MODEL_ROUTER_STRONG_MODEL）；显式指定的模型原样使用。
+    选中的模型和原因在响应头 `X-Model-Route` 中返回。
+    
+    设置 `verbose_logging: true` 时，本请求的工具调用详情（参数、搜索结果摘要、响应预览）以 INFO 级别记录。
+    
+    请求带 W3C `traceparent` 头时沿用其 trace；被采样的请求在响应头 `X-Trace-Id` 中返回 trace ID，
+    可通过 `/debug/traces/{trace_id}` 查看每轮、每次上游调用和每个工具调用的耗时。
+    """
+    request = await _read_json_object(raw_request)
+    
+    # 获取原始消息和其他参数
+    messages = request.get("messages", []).copy()
+    if not messages:
+        raise HTTPException(status_code=400, detail="messages 字段不能为空")
+    
+    deadline = resolve_deadline(request, x_request_timeout)
+    requested_model = _requested_model(request)
+    
+    # 提取其他参数（如 max_tokens），但不包括 messages、model 和本服务自己的字段
+    extra_params = {k: v for k, v in request.items() if k not in _NON_UPSTREAM_FIELDS}
+    speculative = request.get("speculative_search")
+    # 本请求的工具参数、搜索结果摘要和响应预览以 INFO 级别记录（流式响应的执行任务会继承该设置）
+    verbose_logging.set(bool(request.get("verbose_logging")))
+    
+    trace = tracer.start_trace("POST /v1/chat/completions", traceparent, stream=bool(request.get("stream")))
+    trace_headers = {"X-Trace-Id": trace.trace_id} if trace.sampled else {}
+    
+    # 准入控制：排队过久或队列已满时快速返回 503
+    try:
+        with tracer.activate(trace), tracer.span("admission", lane="api"):
+            release = await admission.acquire("api")
+    except Overloaded as e:
+        trace.set_status("error", str(e))
+        trace.end()
+        raise _to_http_exception(e)
+    
+    route = _route_model(messages, requested_model)
+    trace.set_attribute("model", route.model)
+    response_headers = {"X-Model-Route": f"{route.model}; reason={route.reason}", **trace_headers}
+    
+    if request.get("stream"):
+        # 流式响应结束（或客户端断开）后才归还名额
+        return StreamingResponse(
+            _release_after(
+                _stream_chat_completions(messages, extra_params, route, deadline, speculative, trace),
+                release
+            ),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", **response_headers}
         )
+    
+    try:
+        with tracer.activate(trace):
+            response = await run_agentic_loop(messages, extra_params, deadline=deadline, speculative=speculative, route=route)
+        # 最后一轮的上游响应未被修改，直接返回原始字节
+        return JSONBytesResponse(response, headers=response_headers)
+    except Exception as e:
+        http_error = _to_http_exception(e)
+        trace.set_status("error", str(http_error.detail))
+        raise http_error
+    finally:
+        release()
+        trace.end()
 
 
-# 在所有路由定义之后挂载静态文件目录
-static_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
-if os.path.exists(static_dir):
-    app.mount("/static", StaticFiles(directory=static_dir), name="static")
-    logger.info(f"静态文件目录已挂载: {static_dir}")
-else:
-    logger.warning(f"静态文件目录不存在: {static_dir}")
+def _batch_line(record: Dict[str, Any], response: Any = None) -> bytes:
+    """格式化一行 NDJSON 结果；上游原始字节不含换行时直接拼接，省去重新序列化"""
+    if isinstance(response, fastjson.RawJSON) and response.raw is not None and b"\n" not in response.raw:
+        return fastjson.dumps(record)[:-1] + b',"response":' + response.raw + b"}\n"
+    if response is not None:
+        record = {**record, "response": response}
+    return fastjson.dumps(record) + b"\n"
+
+
+async def _run_batch_item(index: int, item: Any) -> bytes:
+    """执行批量请求中的一个条目（在 batch 通道获取准入名额），错误转为该条目的结果行"""
+    custom_id = item.get("custom_id", str(index)) if isinstance(item, dict) else str(index)
+    record: Dict[str, Any] = {"custom_id": custom_id, "index": index}
+    body = item.get("body") if isinstance(item, dict) else None
+    if not isinstance(body, dict) or not body.get("messages"):
+        return _batch_line({**record, "status": 400, "error": {"message": "条目必须包含 body.messages"}})
+
+    try:
+        deadline = resolve_deadline(body)
+        requested_model = _requested_model(body)
+        # 批量结果整体以 NDJSON 返回，条目本身不支持流式
+        extra_params = {k: v for k, v in body.items() if k not in _NON_UPSTREAM_FIELDS and k not in ("stream", "stream_options")}
+        with tracer.span("batch_item", index=index, custom_id=custom_id):
+            async with admission.slot("batch", max_wait=BATCH_ITEM_MAX_WAIT):
+                response = await run_agentic_loop(
+                    list(body["messages"]), extra_params, deadline=deadline, speculative=body.get("speculative_search"),
+                    route=_route_model(body["messages"], requested_model)
+                )
+        return _batch_line({**record, "status": 200}, response)
+    except Exception as e:
+        http_error = _to_http_exception(e)
+        logger.warning("批量条目失败 [%s]: %s", custom_id, http_error.detail)
+        return _batch_line({**record, "status": http_error.status_code, "error": {"message": str(http_error.detail)}})
+
+
+async def _stream_batch(items: List[Any], concurrency: int, trace: Span) -> AsyncIterator[bytes]:
+    """
+    用 concurrency 个 worker 执行批量条目，每完成一个就输出一行（不保证顺序）
+
+    客户端断开时生成器被关闭，取消所有 worker。
+    """
+    pending = iter(enumerate(items))
+    results: asyncio.Queue = asyncio.Queue()
+
+    async def worker():
+        for index, item in pending:
+            await results.put(await _run_batch_item(index, item))
+
+    with tracer.activate(trace):
+        workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    try:
+        for _ in range(len(items)):
+            yield await results.get()
+    except BaseException:
+        trace.set_status("cancelled")
+        raise
+    finally:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        trace.end()
+
+
+@app.post(
+    "/v1/chat/completions/batch",
+    summary="批量 Chat Completions（NDJSON 输出）",
+    tags=["Chat API"],
+    openapi_extra={"requestBody": {"required": True, "content": {"application/json": {"schema": {"type": "object"}}}}}
+)
+async def chat_completions_batch(raw_request: Request, traceparent: Optional[str] = Header(None)):
+    """
+    批量 Chat Completions 接口 - 一个请求提交多个对话
+    
+    请求体：`{"requests": [{"custom_id": "q1", "body": {"messages": [...], ...}}, ...], "concurrency": 4}`，
+    `body` 与 `/v1/chat/completions` 的请求体相同（不支持 `stream`）。
+    
+    每个条目经过完整的 Agentic Loop，最多 `concurrency` 个（默认 BATCH_DEFAULT_CONCURRENCY，
+    上限 BATCH_MAX_CONCURRENCY）同时执行。结果以 `application/x-ndjson` 流式返回，
+    每完成一个条目输出一行 `{"custom_id", "index", "status", "response" | "error"}`，顺序与提交顺序无关。
+    
+    条目在优先级最低的 batch 准入通道中排队（最多等待 BATCH_ITEM_MAX_WAIT 秒），
+    且批量流量最多占用 ADMISSION_BATCH_MAX_ACTIVE 个名额，不会挤占前端聊天和单个 API 请求。
+    """
+    request = await _read_json_object(raw_request)
+    items = request.get("requests")
+    if not isinstance(items, list) or not items:
+        raise HTTPException(status_code=400, detail="requests 必须是非空数组")
+    if len(items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"单个批量请求最多 {BATCH_MAX_ITEMS} 个条目")
+    try:
+        concurrency = int(request.get("concurrency", BATCH_DEFAULT_CONCURRENCY))
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="concurrency 必须是整数")
+    if concurrency <= 0:
+        raise HTTPException(status_code=400, detail="concurrency 必须大于 0")
+    concurrency = min(concurrency, BATCH_MAX_CONCURRENCY, len(items))
+    verbose_logging.set(bool(request.get("verbose_logging")))
+    
+    trace = tracer.start_trace("POST /v1/chat/completions/batch", traceparent, items=len(items), concurrency=concurrency)
+    trace_headers = {"X-Trace-Id": trace.trace_id} if trace.sampled else {}
+    return StreamingResponse(
+        _stream_batch(items, concurrency, trace),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", **trace_headers}
+    )
+
+
+async def _run_job(job: Job) -> Dict[str, Any]:
+    """在后台 worker 中执行一个任务：与批量条目共用 batch 准入通道，进度事件写入任务"""
+    body = job.payload["body"]
+    extra_params = {k: v for k, v in body.items() if k not in _NON_UPSTREAM_FIELDS and k not in ("stream", "stream_options")}
+    with tracer.trace("job", job.payload.get("traceparent"), job_id=job.id):
+        async with admission.slot("batch", max_wait=BATCH_ITEM_MAX_WAIT):
+            # 截止时间从开始执行时算起，排队时间不计入
+            return await run_agentic_loop(
+                list(body["messages"]), extra_params, on_event=job.emit,
+                deadline=resolve_deadline(body), speculative=body.get("speculative_search"),
+                route=_route_model(body["messages"], body.get("model"))
+            )
+
+
+def _describe_job_error(e: Exception) -> Dict[str, Any]:
+    http_error = _to_http_exception(e)
+    return {"message": str(http_error.detail), "status": http_error.status_code}
+
+
+job_manager = JobManager(
+    _run_job,
+    workers=JOBS_WORKERS,
+    max_queue=JOBS_MAX_QUEUE,
+    max_jobs=JOBS_MAX_STORED,
+    ttl=JOBS_TTL,
+    retry_after=ADMISSION_RETRY_AFTER,
+    describe_error=_describe_job_error
+)
+
+
+def _get_job(job_id: str) -> Job:
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在或已过期")
+    return job
+
+
+@app.post(
+    "/v1/jobs",
+    summary="提交异步 Chat Completions 任务",
+    tags=["Chat API"],
+    status_code=202,
+    openapi_extra={"requestBody": {"required": True, "content": {"application/json": {"schema": {"type": "object"}}}}}
+)
+async def create_job(raw_request: Request, traceparent: Optional[str] = Header(None)):
+    """
+    提交一个异步任务，立即返回任务 ID
+    
+    请求体与 `/v1/chat/completions` 相同（不支持 `stream`）。任务由后台 worker 池执行
+    （最多 JOBS_WORKERS 个同时执行，排队超过 JOBS_MAX_QUEUE 个时返回 503），
+    通过 `GET /v1/jobs/{id}` 查询状态和结果，或通过 `GET /v1/jobs/{id}/events` 以 SSE 实时接收进度。
+    已结束的任务保留 JOBS_TTL 秒。
+    """
+    request = await _read_json_object(raw_request)
+    if not request.get("messages"):
+        raise HTTPException(status_code=400, detail="messages 字段不能为空")
+    # 提交时校验 request_timeout 和 model，避免任务执行时才失败
+    resolve_deadline(request)
+    _requested_model(request)
+    try:
+        job = job_manager.submit({"body": request, "traceparent": traceparent})
+    except Overloaded as e:
+        raise _to_http_exception(e)
+    return JSONBytesResponse(
+        job.to_dict(include_result=False),
+        status_code=202,
+        headers={"Location": f"/v1/jobs/{job.id}"}
+    )
+
+
+@app.get("/v1/jobs/{job_id}", summary="查询异步任务", tags=["Chat API"])
+async def get_job(job_id: str):
+    """返回任务状态、每轮进度事件，以及结束后的结果（成功时为 chat.completion 响应）或错误"""
+    return _get_job(job_id).to_dict()
+
+
+@app.get("/v1/jobs/{job_id}/events", summary="订阅异步任务进度（SSE）", tags=["Chat API"])
+async def watch_job(job_id: str):
+    """
+    以 text/event-stream 推送任务的进度事件（包括订阅前已发生的事件）和状态变化，
+    任务结束后推送一条 `{"type": "job", "job": {...}}`（含结果）并以 [DONE] 结束
+    """
+    job = _get_job(job_id)
+    
+    async def stream() -> AsyncIterator[str]:
+        async for event in job_manager.watch(job):
+            yield _sse_event(event)
+        yield _sse_event({"type": "job", "job": job.to_dict()})
+        yield "data: [DONE]\n\n"
+    
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
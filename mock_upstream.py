@@ -0,0 +1,325 @@
+"""
+本地模拟的 AI Builder 上游，用于可重复的性能测试（不消耗真实 API 配额）
+
+实现的接口：
+- POST /v1/chat/completions：普通和流式（SSE）响应，提供 tools 时按配置返回 tool_calls
+- POST /v1/search/：按关键词返回可配置数量和大小的搜索结果
+- POST /v1/audio/transcriptions：multipart 上传（audio_file / audio_url / language），返回转写文本
+- GET/POST /mock/config：查看 / 在运行中修改配置；GET /mock/stats：请求和注入错误的统计
+
+用法：
+    python mock_upstream.py --port 9000
+    AI_BUILDER_BASE_URL=http://127.0.0.1:9000 AI_BUILDER_API_KEY=mock uvicorn main:app --port 8000
+
+配置（环境变量，也可以 POST /mock/config 传入同名的小写字段，如 {"chat_latency": "fixed:0.2"}）：
+- MOCK_CHAT_LATENCY / MOCK_SEARCH_LATENCY / MOCK_TRANSCRIBE_LATENCY：延迟分布，
+  格式为 "fixed:秒"、"uniform:最小:最大"、"normal:均值:标准差"、"lognormal:中位数:sigma"，或直接写秒数
+- MOCK_STREAM_CHUNK_DELAY：流式响应中每个 chunk 之间的间隔（秒）
+- MOCK_ERROR_RATE：注入错误的概率（所有接口），MOCK_ERROR_STATUS：错误状态码（默认 503）
+- MOCK_RATE_LIMIT_RATE：返回 429 + Retry-After 的概率，MOCK_RETRY_AFTER：Retry-After 秒数
+- MOCK_TOOL_CALL_RATE：提供 tools 时返回 tool_calls 的概率
+- MOCK_TOOL_CALLS：每轮返回的并行 tool_calls 数量，MOCK_TOOL_ROUNDS：最多连续几轮返回 tool_calls
+- MOCK_ANSWER_WORDS：最终回答的词数，MOCK_SEARCH_RESULTS / MOCK_SNIPPET_CHARS：每个关键词的结果数和摘要长度
+- MOCK_SEED：随机数种子（相同的请求序列得到相同的延迟和错误）
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from compression import CompressionMiddleware
+
+_DEFAULTS: Dict[str, Any] = {
+    "chat_latency": "lognormal:0.8:0.4",
+    "search_latency": "uniform:0.2:0.6",
+    "transcribe_latency": "fixed:1.0",
+    "stream_chunk_delay": 0.02,
+    "error_rate": 0.0,
+    "error_status": 503,
+    "rate_limit_rate": 0.0,
+    "retry_after": 1,
+    "tool_call_rate": 1.0,
+    "tool_calls": 1,
+    "tool_rounds": 1,
+    "answer_words": 60,
+    "search_results": 6,
+    "snippet_chars": 300,
+    "seed": None
+}
+
+
+def parse_latency(spec: Any):
+    """把延迟分布描述解析为采样函数 rng -> 秒数"""
+    if isinstance(spec, (int, float)):
+        return lambda rng: float(spec)
+    kind, _, params = str(spec).partition(":")
+    try:
+        values = [float(v) for v in params.split(":")] if params else []
+        if kind == "fixed":
+            return lambda rng: values[0]
+        if kind == "uniform":
+            return lambda rng: rng.uniform(values[0], values[1])
+        if kind == "normal":
+            return lambda rng: max(0.0, rng.gauss(values[0], values[1]))
+        if kind == "lognormal":
+            return lambda rng: rng.lognormvariate(math.log(values[0]), values[1])
+        seconds = float(kind)
+        return lambda rng: seconds
+    except (ValueError, IndexError):
+        raise ValueError(f"无法解析延迟分布: {spec!r}")
+
+
+class MockConfig:
+    """模拟上游的行为配置"""
+
+    def __init__(self, values: Dict[str, Any]):
+        self.values = dict(_DEFAULTS)
+        self.update(values)
+
+    @classmethod
+    def from_env(cls) -> "MockConfig":
+        values = {}
+        for key in _DEFAULTS:
+            raw = os.getenv(f"MOCK_{key.upper()}")
+            if raw is not None:
+                values[key] = raw
+        return cls(values)
+
+    def update(self, values: Dict[str, Any]):
+        """更新配置（未知字段报错），并按新的种子重置随机数生成器"""
+        unknown = set(values) - set(_DEFAULTS)
+        if unknown:
+            raise ValueError(f"未知的配置字段: {sorted(unknown)}")
+        merged = {**self.values, **values}
+        for key, default in _DEFAULTS.items():
+            if key.endswith("_latency"):
+                parse_latency(merged[key])
+            elif isinstance(default, int) and not isinstance(default, bool):
+                merged[key] = int(merged[key])
+            elif isinstance(default, float):
+                merged[key] = float(merged[key])
+        self.values = merged
+        self.latency = {name: parse_latency(merged[f"{name}_latency"]) for name in ("chat", "search", "transcribe")}
+        seed = merged["seed"]
+        self.rng = random.Random(int(seed) if seed not in (None, "") else None)
+
+    def __getattr__(self, name: str) -> Any:
+        try:
+            return self.__dict__["values"][name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+config = MockConfig.from_env()
+stats: Dict[str, Dict[str, int]] = {}
+
+app = FastAPI(title="Mock AI Builder Upstream", description="用于性能测试的模拟上游")
+# 接受 gzip 压缩的请求体（main.py 的 UPSTREAM_REQUEST_COMPRESSION）；响应不压缩，便于测量原始开销
+app.add_middleware(CompressionMiddleware, compress_responses=False)
+
+
+def _count(endpoint: str, field: str):
+    endpoint_stats = stats.setdefault(endpoint, {"requests": 0, "errors_injected": 0, "rate_limited": 0, "tool_call_responses": 0})
+    endpoint_stats[field] += 1
+
+
+async def _simulate(endpoint: str) -> Optional[JSONResponse]:
+    """等待模拟延迟，并按配置注入错误；需要返回错误时返回错误响应"""
+    _count(endpoint, "requests")
+    await asyncio.sleep(config.latency[endpoint](config.rng))
+    roll = config.rng.random()
+    if roll < config.rate_limit_rate:
+        _count(endpoint, "rate_limited")
+        return JSONResponse(
+            {"error": {"message": "模拟限流", "type": "rate_limit_error"}},
+            status_code=429,
+            headers={"Retry-After": str(config.retry_after)}
+        )
+    if roll < config.rate_limit_rate + config.error_rate:
+        _count(endpoint, "errors_injected")
+        return JSONResponse({"error": {"message": "模拟上游错误", "type": "server_error"}}, status_code=config.error_status)
+    return None
+
+
+def _last_user_text(messages: List[Dict[str, Any]]) -> str:
+    for message in reversed(messages):
+        if message.get("role") == "user" and isinstance(message.get("content"), str):
+            return message["content"]
+    return ""
+
+
+def _tool_rounds_so_far(messages: List[Dict[str, Any]]) -> int:
+    return sum(1 for m in messages if m.get("role") == "assistant" and m.get("tool_calls"))
+
+
+def _words(n: int) -> List[str]:
+    vocabulary = ("模拟", "回答", "latency", "benchmark", "search", "结果", "agentic", "loop", "上游", "token")
+    return [vocabulary[config.rng.randrange(len(vocabulary))] for _ in range(n)]
+
+
+def _estimate_tokens(messages: List[Dict[str, Any]]) -> int:
+    return sum(len(str(m.get("content") or "")) for m in messages) // 4 + 1
+
+
+def _chat_message(body: Dict[str, Any]) -> Dict[str, Any]:
+    """根据请求和配置决定返回 tool_calls 还是最终回答"""
+    messages = body.get("messages", [])
+    tools = body.get("tools") or []
+    if tools and _tool_rounds_so_far(messages) < config.tool_rounds and config.rng.random() < config.tool_call_rate:
+        tool_name = tools[0].get("function", {}).get("name", "search")
+        query = _last_user_text(messages)[:40] or "mock query"
+        return {
+            "role": "assistant",
+            "content": None,
+            "tool_calls": [
+                {
+                    "id": f"call_{uuid.uuid4().hex[:12]}",
+                    "type": "function",
+                    "function": {"name": tool_name, "arguments": json.dumps({"keywords": [f"{query} {i + 1}"]}, ensure_ascii=False)}
+                }
+                for i in range(config.tool_calls)
+            ]
+        }
+    return {"role": "assistant", "content": " ".join(_words(config.answer_words))}
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    error = await _simulate("chat")
+    if error is not None:
+        return error
+
+    message = _chat_message(body)
+    finish_reason = "tool_calls" if message.get("tool_calls") else "stop"
+    if message.get("tool_calls"):
+        _count("chat", "tool_call_responses")
+    prompt_tokens = _estimate_tokens(body.get("messages", []))
+    completion_tokens = len((message.get("content") or "").split()) or 10
+    usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+    base = {"id": f"chatcmpl-mock-{uuid.uuid4().hex[:16]}", "created": int(time.time()), "model": body.get("model", "gpt-5")}
+
+    if not body.get("stream"):
+        return {**base, "object": "chat.completion", "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}], "usage": usage}
+
+    include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+    return StreamingResponse(_stream_chunks(base, message, finish_reason, usage if include_usage else None), media_type="text/event-stream")
+
+
+async def _stream_chunks(base: Dict[str, Any], message: Dict[str, Any], finish_reason: str, usage: Optional[Dict[str, int]]):
+    """按 OpenAI chat.completion.chunk 格式逐块输出（工具参数分两片到达）"""
+    def chunk(delta: Dict[str, Any], finish: Optional[str] = None) -> str:
+        data = {**base, "object": "chat.completion.chunk", "choices": [{"index": 0, "delta": delta, "finish_reason": finish}]}
+        return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+    yield chunk({"role": "assistant", "content": ""})
+    if message.get("tool_calls"):
+        for index, tool_call in enumerate(message["tool_calls"]):
+            arguments = tool_call["function"]["arguments"]
+            half = len(arguments) // 2
+            yield chunk({"tool_calls": [{"index": index, "id": tool_call["id"], "type": "function",
+                                         "function": {"name": tool_call["function"]["name"], "arguments": arguments[:half]}}]})
+            await asyncio.sleep(config.stream_chunk_delay)
+            yield chunk({"tool_calls": [{"index": index, "function": {"arguments": arguments[half:]}}]})
+    else:
+        for word in message["content"].split(" "):
+            await asyncio.sleep(config.stream_chunk_delay)
+            yield chunk({"content": word + " "})
+    yield chunk({}, finish_reason)
+    if usage is not None:
+        yield f"data: {json.dumps({**base, 'object': 'chat.completion.chunk', 'choices': [], 'usage': usage})}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+@app.post("/v1/search/")
+async def search(request: Request):
+    body = await request.json()
+    error = await _simulate("search")
+    if error is not None:
+        return error
+
+    keywords = body.get("keywords") or []
+    if isinstance(keywords, str):
+        keywords = [keywords]
+    max_results = min(int(body.get("max_results", config.search_results)), config.search_results)
+    filler = ("模拟搜索结果摘要 mock snippet " * (config.snippet_chars // 10 + 1))[:config.snippet_chars]
+    queries = [
+        {
+            "keyword": keyword,
+            "response": {
+                "results": [
+                    {"title": f"{keyword} - 结果 {i + 1}", "url": f"https://example.com/{i + 1}", "content": filler}
+                    for i in range(max_results)
+                ]
+            }
+        }
+        for keyword in keywords
+    ]
+    return {"queries": queries, "combined_answer": "；".join(f"关于 {k} 的模拟答案" for k in keywords) or None}
+
+
+@app.post("/v1/audio/transcriptions")
+async def transcriptions(request: Request):
+    form = await request.form()
+    error = await _simulate("transcribe")
+    if error is not None:
+        return error
+
+    audio_file = form.get("audio_file")
+    size = len(await audio_file.read()) if audio_file is not None and hasattr(audio_file, "read") else 0
+    if audio_file is None and not form.get("audio_url"):
+        return JSONResponse({"error": {"message": "需要 audio_file 或 audio_url"}}, status_code=400)
+    return {
+        "text": " ".join(_words(20)),
+        "language": form.get("language") or "zh",
+        "duration": round(size / 16000, 2),
+        "bytes": size
+    }
+
+
+@app.get("/mock/config")
+async def get_config():
+    return config.values
+
+
+@app.post("/mock/config")
+async def update_config(request: Request):
+    try:
+        config.update(await request.json())
+    except (ValueError, TypeError) as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    return config.values
+
+
+@app.get("/mock/stats")
+async def get_stats():
+    return stats
+
+
+@app.post("/mock/stats/reset")
+async def reset_stats():
+    stats.clear()
+    return {"ok": True}
+
+
+@app.get("/health")
+async def health():
+    return {"status": "ok", "mock": True}
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="本地模拟的 AI Builder 上游")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    args = parser.parse_args()
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
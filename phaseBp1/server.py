@@ -8,6 +8,7 @@ from http.server import HTTPServer, BaseHTTPRequestHandler
 import urllib.request
 import urllib.parse
 import json
+import gzip
 import os
 from pathlib import Path
 
@@ -35,7 +36,25 @@ if not API_KEY:
 else:
     print(f"API Key loaded: {API_KEY[:20]}...{API_KEY[-10:]}")
 
+# Responses at least this large are gzipped for clients that send Accept-Encoding: gzip
+COMPRESSION_MIN_SIZE = int(ENV.get('COMPRESSION_MIN_SIZE', 1024))
+
+
 class ProxyHandler(BaseHTTPRequestHandler):
+    def _accepts_gzip(self):
+        encodings = self.headers.get('Accept-Encoding', '')
+        return any(e.split(';')[0].strip().lower() == 'gzip' for e in encodings.split(','))
+
+    def _write_body(self, body):
+        """Finish the headers and write the body, gzipping it when worthwhile"""
+        if len(body) >= COMPRESSION_MIN_SIZE and self._accepts_gzip():
+            body = gzip.compress(body, compresslevel=6)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
     def do_OPTIONS(self):
         """Handle CORS preflight requests"""
         self.send_response(200)
@@ -76,8 +95,7 @@ class ProxyHandler(BaseHTTPRequestHandler):
                     self.send_response(200)
                     self.send_header('Content-type', 'text/html')
                     self.send_header('Access-Control-Allow-Origin', '*')
-                    self.end_headers()
-                    self.wfile.write(content)
+                    self._write_body(content)
             except FileNotFoundError:
                 self.send_error(404, "File not found")
         else:
@@ -92,6 +110,12 @@ class ProxyHandler(BaseHTTPRequestHandler):
             # Read request body
             content_length = int(self.headers.get('Content-Length', 0))
             body = self.rfile.read(content_length)
+            if self.headers.get('Content-Encoding', '').lower() == 'gzip':
+                try:
+                    body = gzip.decompress(body)
+                except (OSError, EOFError) as e:
+                    self.send_error(400, f"Invalid gzip body: {e}")
+                    return
             
             # Determine content type - preserve multipart boundary if present
             content_type = self.headers.get('Content-Type', 'application/json')
@@ -126,8 +150,7 @@ class ProxyHandler(BaseHTTPRequestHandler):
                     self.send_response(response_code)
                     self.send_header('Access-Control-Allow-Origin', '*')
                     self.send_header('Content-Type', response_headers.get('Content-Type', 'application/json'))
-                    self.end_headers()
-                    self.wfile.write(response_data)
+                    self._write_body(response_data)
                     
             except urllib.error.HTTPError as e:
                 # Read error response body
@@ -0,0 +1,279 @@
+"""
+上游调用的弹性层：带抖动的指数退避重试、Retry-After 支持和按端点的熔断器
+
+- 只重试瞬时故障：429 / 5xx 状态码，以及调用方声明的连接类异常
+- 熔断器把瞬时故障和所有没有响应的异常（超时、传输错误等）都记为失败；
+  只有非瞬时的 HTTP 错误（如 400）说明上游仍然可用，记为成功
+- 上游返回 Retry-After 时按其等待（超过 max_retry_after 则直接放弃重试）
+- 从第一次调用开始计时，等待后会超过 max_elapsed 秒时不再重试，避免重试把单个请求拖到数分钟
+- 熔断器连续失败达到阈值后进入 open 状态，期间直接快速失败；
+  经过 recovery_timeout 后进入 half_open，放行少量探测请求，成功则恢复 closed
+
+异步调用使用 call()，同步调用（例如 requests 库）使用 call_sync()。
+"""
+import asyncio
+import email.utils
+import logging
+import random
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple, Type
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """熔断器处于 open 状态，请求被快速拒绝"""
+
+    def __init__(self, endpoint: str, retry_after: float):
+        super().__init__(f"上游 {endpoint} 暂时不可用（熔断中），请在 {retry_after:.0f} 秒后重试")
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """解析 Retry-After 头（秒数或 HTTP 日期），返回需要等待的秒数"""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        parsed = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if parsed is None:
+        return None
+    return max(0.0, parsed.timestamp() - time.time())
+
+
+class CircuitBreaker:
+    """单个端点的熔断器（线程安全，可同时用于事件循环和工作线程）"""
+
+    def __init__(self, endpoint: str, failure_threshold: int = 5, recovery_timeout: float = 30.0, half_open_max_calls: int = 1):
+        self.endpoint = endpoint
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self.state = CLOSED
+        self._lock = threading.Lock()
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._half_open_in_flight = 0
+        self.failures = 0
+        self.successes = 0
+        self.rejections = 0
+        self.opens = 0
+
+    def _maybe_half_open(self):
+        if self.state == OPEN and time.monotonic() - self._opened_at >= self.recovery_timeout:
+            self.state = HALF_OPEN
+            self._half_open_in_flight = 0
+            logger.info(f"熔断器 {self.endpoint} 进入 half_open，开始探测")
+
+    def allows_requests(self) -> bool:
+        """当前是否可能放行请求（不占用探测名额）"""
+        with self._lock:
+            self._maybe_half_open()
+            return self.state != OPEN
+
+    def before_call(self):
+        """调用前检查，熔断中时抛出 CircuitOpenError"""
+        with self._lock:
+            self._maybe_half_open()
+            if self.state == OPEN:
+                self.rejections += 1
+                raise CircuitOpenError(self.endpoint, self.recovery_timeout - (time.monotonic() - self._opened_at))
+            if self.state == HALF_OPEN:
+                if self._half_open_in_flight >= self.half_open_max_calls:
+                    self.rejections += 1
+                    raise CircuitOpenError(self.endpoint, self.recovery_timeout)
+                self._half_open_in_flight += 1
+
+    def record_success(self):
+        with self._lock:
+            self.successes += 1
+            self._consecutive_failures = 0
+            if self.state == HALF_OPEN:
+                logger.info(f"熔断器 {self.endpoint} 探测成功，恢复 closed")
+            self.state = CLOSED
+            self._half_open_in_flight = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._consecutive_failures += 1
+            if self.state == HALF_OPEN or self._consecutive_failures >= self.failure_threshold:
+                if self.state != OPEN:
+                    self.opens += 1
+                    logger.warning(f"熔断器 {self.endpoint} 打开（连续失败 {self._consecutive_failures} 次）")
+                self.state = OPEN
+                self._opened_at = time.monotonic()
+                self._half_open_in_flight = 0
+
+    def record_abandoned(self):
+        """调用被取消，既不算成功也不算失败，只释放探测名额"""
+        with self._lock:
+            if self.state == HALF_OPEN and self._half_open_in_flight > 0:
+                self._half_open_in_flight -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            self._maybe_half_open()
+            return {
+                "state": self.state,
+                "consecutive_failures": self._consecutive_failures,
+                "failures": self.failures,
+                "successes": self.successes,
+                "rejections": self.rejections,
+                "opens": self.opens
+            }
+
+
+class Resilience:
+    """按端点管理熔断器，并以统一的重试策略执行调用"""
+
+    def __init__(
+        self,
+        transient_errors: Tuple[Type[BaseException], ...] = (),
+        max_attempts: int = 3,
+        base_delay: float = 0.5,
+        max_delay: float = 8.0,
+        max_retry_after: float = 30.0,
+        max_elapsed: Optional[float] = None,
+        failure_threshold: int = 5,
+        recovery_timeout: float = 30.0,
+        half_open_max_calls: int = 1
+    ):
+        """
+        transient_errors: 视为瞬时故障、可以重试的异常（应只包含请求肯定没有被上游处理的连接类异常）
+        max_elapsed: 整个调用（包括所有重试和等待）的时间预算，None 表示不限制
+        """
+        self.transient_errors = transient_errors
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+        self.max_elapsed = max_elapsed
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+        self.retries = 0
+
+    def breaker(self, endpoint: str) -> CircuitBreaker:
+        with self._lock:
+            breaker = self._breakers.get(endpoint)
+            if breaker is None:
+                breaker = CircuitBreaker(endpoint, self.failure_threshold, self.recovery_timeout, self.half_open_max_calls)
+                self._breakers[endpoint] = breaker
+            return breaker
+
+    @staticmethod
+    def _upstream_responded(exc: BaseException) -> bool:
+        """异常是否带有上游的 HTTP 响应"""
+        return getattr(getattr(exc, "response", None), "status_code", None) is not None
+
+    def _record_error(self, breaker: CircuitBreaker, exc: BaseException, transient: bool):
+        """非瞬时的 HTTP 错误记为成功，其余（瞬时故障、超时、传输错误）记为失败"""
+        if not transient and self._upstream_responded(exc):
+            breaker.record_success()
+        else:
+            breaker.record_failure()
+
+    def classify(self, exc: BaseException) -> Tuple[bool, Optional[float]]:
+        """判断异常是否为瞬时故障，并返回上游给出的 Retry-After 秒数"""
+        response = getattr(exc, "response", None)
+        status = getattr(response, "status_code", None)
+        if status is not None:
+            retry_after = parse_retry_after(response.headers.get("Retry-After")) if status in (429, 503) else None
+            return status in RETRYABLE_STATUSES, retry_after
+        return isinstance(exc, self.transient_errors), None
+
+    def _next_delay(self, attempt: int, retry_after: Optional[float], started: float) -> Optional[float]:
+        """计算第 attempt 次失败后的等待时间，返回 None 表示不再重试"""
+        if attempt >= self.max_attempts:
+            return None
+        if retry_after is not None:
+            if retry_after > self.max_retry_after:
+                return None
+            delay = retry_after
+        else:
+            # full jitter 指数退避
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** (attempt - 1))))
+        if self.max_elapsed is not None and time.monotonic() - started + delay >= self.max_elapsed:
+            return None
+        return delay
+
+    async def call(self, endpoint: str, fn: Callable[[], Awaitable[Any]], can_retry: Optional[Callable[[], bool]] = None) -> Any:
+        """
+        在熔断器保护下执行异步调用，瞬时故障按策略重试
+
+        can_retry: 可选，返回 False 时不再重试（例如流式响应已经向客户端输出了内容）
+        """
+        breaker = self.breaker(endpoint)
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            attempt += 1
+            breaker.before_call()
+            try:
+                result = await fn()
+            except asyncio.CancelledError:
+                breaker.record_abandoned()
+                raise
+            except Exception as e:
+                transient, retry_after = self.classify(e)
+                self._record_error(breaker, e, transient)
+                if not transient:
+                    raise
+                delay = self._next_delay(attempt, retry_after, started)
+                if delay is None or (can_retry is not None and not can_retry()):
+                    raise
+                self.retries += 1
+                logger.warning(f"上游 {endpoint} 调用失败（第 {attempt} 次）: {str(e)}，{delay:.2f} 秒后重试")
+                await asyncio.sleep(delay)
+                continue
+            breaker.record_success()
+            return result
+
+    def call_sync(self, endpoint: str, fn: Callable[[], Any]) -> Any:
+        """call() 的同步版本，用于 requests 等阻塞客户端（应在工作线程中调用）"""
+        breaker = self.breaker(endpoint)
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            attempt += 1
+            breaker.before_call()
+            try:
+                result = fn()
+            except Exception as e:
+                transient, retry_after = self.classify(e)
+                self._record_error(breaker, e, transient)
+                if not transient:
+                    raise
+                delay = self._next_delay(attempt, retry_after, started)
+                if delay is None:
+                    raise
+                self.retries += 1
+                logger.warning(f"上游 {endpoint} 调用失败（第 {attempt} 次）: {str(e)}，{delay:.2f} 秒后重试")
+                time.sleep(delay)
+                continue
+            breaker.record_success()
+            return result
+
+    def stats(self) -> Dict[str, Any]:
+        """返回重试次数和每个端点的熔断器状态"""
+        return {
+            "retries": self.retries,
+            "breakers": {endpoint: breaker.stats() for endpoint, breaker in list(self._breakers.items())}
+        }
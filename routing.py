@@ -0,0 +1,182 @@
+"""
+请求级模型路由：按请求内容为 Agentic Loop 选择上游模型
+
+- 调用方显式指定了模型（且不是 "auto"）时直接使用
+- 否则依次应用规则：规则是 (名称, 函数)，函数接收 RequestFeatures，返回模型名或 None（不做决定）；
+  默认规则把需要最新信息（大概率要调用搜索工具）的请求发给强模型
+- 所有规则都不做决定时，由本地复杂度分类器打分：简单、简短的问题发给快速模型，复杂的发给强模型
+- 分类只用正则和字符统计，不调用上游
+- 统计每个模型按原因的路由次数，以及按模型的请求延迟分位数；模型名来自请求体，
+  不在已知模型列表中的统一记为 other，避免统计和指标标签无限增长
+"""
+import re
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from context_manager import estimate_tokens
+from hedging import LatencyTracker
+from speculative_search import is_time_sensitive, latest_user_text
+
+# 请求体中 model 为该值（或省略）时由路由器选择
+AUTO = "auto"
+# 不在已知模型列表中的模型在统计中的名称
+OTHER = "other"
+
+# 提示问题需要推理、写作或多步骤回答的线索词
+_HARD_TERMS = re.compile(
+    r"证明|推导|分析|比较|对比|区别|设计|架构|优化|算法|代码|编程|实现|调试|报错|原理|为什么|步骤|详细|解释|翻译|总结|改写|写一[篇个段首]|"
+    r"\b(prove|derive|analy[sz]e|compare|difference|design|architecture|optimi[sz]e|algorithm|code|implement|debug|"
+    r"error|why|explain|step[- ]by[- ]step|refactor|translate|summari[sz]e|rewrite|essay)\b",
+    re.IGNORECASE
+)
+# 代码片段的线索（代码块、函数/类定义、语句结尾）
+_CODE = re.compile(r"```|^\s*(def|class|function|import|#include|public|fn)\b|;\s*$", re.MULTILINE)
+_QUESTION = re.compile(r"[?？]")
+
+
+class RequestFeatures:
+    """从消息列表提取的路由特征"""
+
+    __slots__ = ("text", "chars", "turns", "context_tokens", "hard_terms", "has_code", "questions", "time_sensitive", "tool_history")
+
+    def __init__(self, messages: List[Dict[str, Any]]):
+        self.text = latest_user_text(messages)
+        self.chars = len(self.text)
+        self.turns = sum(1 for m in messages if m.get("role") == "user")
+        self.context_tokens = estimate_tokens(messages)
+        self.hard_terms = len(set(match.group(0).lower() for match in _HARD_TERMS.finditer(self.text)))
+        self.has_code = _CODE.search(self.text) is not None
+        self.questions = len(_QUESTION.findall(self.text))
+        self.time_sensitive = is_time_sensitive(self.text)
+        # 历史中已有工具调用：后续追问大概率还要用工具
+        self.tool_history = any(m.get("role") == "tool" or m.get("tool_calls") for m in messages)
+
+
+Rule = Callable[[RequestFeatures], Optional[str]]
+
+
+class ComplexityClassifier:
+    """按特征给请求打复杂度分，达到 threshold 即视为复杂请求"""
+
+    def __init__(self, threshold: float = 2.0, long_prompt_chars: int = 400, long_context_tokens: int = 4000):
+        self.threshold = threshold
+        self.long_prompt_chars = long_prompt_chars
+        self.long_context_tokens = long_context_tokens
+
+    def score(self, features: RequestFeatures) -> float:
+        score = float(min(features.hard_terms, 3))
+        if features.has_code:
+            score += 2
+        if features.chars >= self.long_prompt_chars:
+            score += 1
+        if features.chars >= self.long_prompt_chars * 4:
+            score += 1
+        if features.context_tokens >= self.long_context_tokens:
+            score += 1
+        if features.questions >= 2:
+            score += 1
+        return score
+
+    def is_complex(self, features: RequestFeatures) -> bool:
+        return self.score(features) >= self.threshold
+
+
+class RouteDecision:
+    """一次路由的结果：选中的模型和原因（explicit / disabled / rule:<名称> / complex / simple）"""
+
+    __slots__ = ("model", "reason")
+
+    def __init__(self, model: str, reason: str):
+        self.model = model
+        self.reason = reason
+
+    def to_dict(self) -> Dict[str, str]:
+        return {"model": self.model, "reason": self.reason}
+
+
+class ModelRouter:
+    """按规则和复杂度分类器选择模型，并统计路由决策和按模型的延迟"""
+
+    def __init__(
+        self,
+        fast_model: str = "grok-4-fast",
+        strong_model: str = "gpt-5",
+        enabled: bool = True,
+        classifier: Optional[ComplexityClassifier] = None,
+        latency_window: int = 200,
+        known_models: Iterable[str] = ()
+    ):
+        """known_models: 除快速模型和强模型外，统计时按名称区分的模型"""
+        self.fast_model = fast_model
+        self.strong_model = strong_model
+        self.known_models = frozenset((fast_model, strong_model, *known_models))
+        self.enabled = enabled
+        self.classifier = classifier or ComplexityClassifier()
+        self.rules: List[Tuple[str, Rule]] = [
+            ("tools", lambda f: self.strong_model if f.time_sensitive or f.tool_history else None)
+        ]
+        self.latency = LatencyTracker(window=latency_window, min_samples=1)
+        # 模型 -> 原因 -> 次数
+        self.decisions: Dict[str, Dict[str, int]] = {}
+        # 模型 -> 结果 -> 次数
+        self.outcomes: Dict[str, Dict[str, int]] = {}
+
+    def label(self, model: str) -> str:
+        """统计和指标中使用的模型名：已知模型原样返回，其余记为 other"""
+        return model if model in self.known_models else OTHER
+
+    def add_rule(self, name: str, rule: Rule, first: bool = False):
+        """添加规则；first=True 时排在已有规则之前"""
+        if first:
+            self.rules.insert(0, (name, rule))
+        else:
+            self.rules.append((name, rule))
+
+    def route(self, messages: List[Dict[str, Any]], requested: Optional[str] = None) -> RouteDecision:
+        """为一次请求选择模型；requested 为调用方指定的模型（None 或 "auto" 表示由路由器选择）"""
+        if requested and requested != AUTO:
+            decision = RouteDecision(requested, "explicit")
+        elif not self.enabled:
+            decision = RouteDecision(self.strong_model, "disabled")
+        else:
+            decision = self._classify(RequestFeatures(messages))
+        reasons = self.decisions.setdefault(self.label(decision.model), {})
+        reasons[decision.reason] = reasons.get(decision.reason, 0) + 1
+        return decision
+
+    def _classify(self, features: RequestFeatures) -> RouteDecision:
+        for name, rule in self.rules:
+            model = rule(features)
+            if model:
+                return RouteDecision(model, f"rule:{name}")
+        if self.classifier.is_complex(features):
+            return RouteDecision(self.strong_model, "complex")
+        return RouteDecision(self.fast_model, "simple")
+
+    def observe(self, model: str, seconds: float, outcome: str = "ok"):
+        """记录一次使用 model 的请求的耗时和结果"""
+        model = self.label(model)
+        outcomes = self.outcomes.setdefault(model, {})
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+        if outcome == "ok":
+            self.latency.record(model, seconds)
+
+    def stats(self) -> Dict[str, Any]:
+        models = {}
+        for model in sorted(set(self.decisions) | set(self.outcomes)):
+            p50 = self.latency.percentile(model, 50)
+            p95 = self.latency.percentile(model, 95)
+            models[model] = {
+                "decisions": dict(self.decisions.get(model, {})),
+                "outcomes": dict(self.outcomes.get(model, {})),
+                "latency_p50": round(p50, 4) if p50 is not None else None,
+                "latency_p95": round(p95, 4) if p95 is not None else None
+            }
+        return {
+            "enabled": self.enabled,
+            "fast_model": self.fast_model,
+            "strong_model": self.strong_model,
+            "known_models": sorted(self.known_models),
+            "threshold": self.classifier.threshold,
+            "rules": [name for name, _ in self.rules],
+            "models": models
+        }
@@ -0,0 +1,73 @@
+"""
+相同上游请求的合并（single-flight）
+
+同一时刻 key 相同的调用只真正执行一次：第一个调用方启动请求，
+并发的重复调用方等待同一个结果。请求在独立的 task 中执行，
+单个调用方被取消（例如客户端断开）不会影响其他调用方；
+只有所有等待者都取消时才取消底层请求。
+"""
+import asyncio
+import hashlib
+import json
+from typing import Any, Awaitable, Callable, Dict
+
+
+def canonical_key(*parts: Any) -> str:
+    """对请求内容做规范化 JSON 序列化后取 sha256，作为合并的 key"""
+    payload = json.dumps(parts, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class _Call:
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """按 key 合并并发中的相同调用"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls: Dict[str, _Call] = {}
+        self.executed = 0
+        self.coalesced = 0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """执行 fn，若已有相同 key 的调用在进行中则等待其结果"""
+        call = self._calls.get(key)
+        if call is None:
+            call = _Call(asyncio.create_task(fn()))
+            self._calls[key] = call
+            call.task.add_done_callback(lambda task: self._on_done(key, call))
+            self.executed += 1
+        else:
+            self.coalesced += 1
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        except asyncio.CancelledError:
+            # 最后一个等待者离开时才取消底层请求
+            if call.waiters == 1 and not call.task.done():
+                call.task.cancel()
+            raise
+        finally:
+            call.waiters -= 1
+
+    def _on_done(self, key: str, call: _Call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+        # 所有等待者都已取消时，避免 "exception was never retrieved" 警告
+        if not call.task.cancelled():
+            call.task.exception()
+
+    def stats(self) -> Dict[str, Any]:
+        """返回合并统计"""
+        return {
+            "in_flight": len(self._calls),
+            "executed": self.executed,
+            "coalesced": self.coalesced
+        }
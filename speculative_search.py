@@ -0,0 +1,145 @@
+"""
+第一轮 LLM 调用期间的推测性搜索预取
+
+根据最新的用户消息用本地启发式规则推测可能的搜索关键词，
+在第一轮 LLM 调用进行的同时把搜索结果预取进缓存。
+模型随后请求了相同（规范化后）的关键词时，搜索直接命中缓存或合并到进行中的请求。
+命中统计用于判断推测是否划算。
+"""
+import asyncio
+import logging
+import re
+from typing import Any, Awaitable, Callable, Dict, List, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 提示问题需要最新信息的线索词
+_TIME_SENSITIVE = re.compile(
+    r"最新|最近|今天|今年|明天|昨天|现在|目前|当前|新闻|价格|股价|汇率|天气|版本|发布|比分|排名|"
+    r"\b(latest|recent|today|now|current|news|price|release|version|weather|score)\b|20\d\d",
+    re.IGNORECASE
+)
+# 去掉的提问套话和标点
+_FILLER = re.compile(
+    r"请问|请|帮我|帮忙|告诉我|查一下|搜索一下|搜索|一下|是什么|是多少|有哪些|什么|多少|怎么样|如何|吗|呢|吧|呀|啊|"
+    r"[，。！？、；：“”‘’（）《》【】,.!?;:\"'()\[\]<>]"
+)
+_LATIN_TERM = re.compile(r"[A-Za-z][A-Za-z0-9.+#\-]*")
+
+Keyword = Tuple[str, int]
+
+
+def is_time_sensitive(text: str) -> bool:
+    """问题是否看起来需要最新信息（即大概率需要搜索）"""
+    return bool(text) and _TIME_SENSITIVE.search(text) is not None
+
+
+def derive_keywords(text: str, max_keywords: int = 2) -> List[str]:
+    """
+    从用户消息推测搜索关键词；问题看起来不需要最新信息时返回空列表
+
+    候选依次为：去掉套话和标点后的整句、消息中的英文术语组合。
+    """
+    if not is_time_sensitive(text):
+        return []
+
+    candidates = []
+    cleaned = " ".join(_FILLER.sub(" ", text).split())
+    if cleaned:
+        candidates.append(cleaned[:60])
+    latin_terms = _LATIN_TERM.findall(text)
+    if latin_terms:
+        candidates.append(" ".join(latin_terms)[:60])
+
+    keywords = []
+    for candidate in candidates:
+        if candidate.lower() not in (k.lower() for k in keywords):
+            keywords.append(candidate)
+    return keywords[:max_keywords]
+
+
+def latest_user_text(messages: List[Dict[str, Any]]) -> str:
+    """取最新一条用户消息的文本"""
+    for message in reversed(messages):
+        if message.get("role") == "user":
+            content = message.get("content")
+            if isinstance(content, str):
+                return content
+            if isinstance(content, list):
+                return " ".join(part.get("text", "") for part in content if isinstance(part, dict))
+            return ""
+    return ""
+
+
+class SearchSpeculator:
+    """发起推测性搜索预取并统计命中率"""
+
+    def __init__(
+        self,
+        search: Callable[[List[str], int], Awaitable[Any]],
+        normalize: Callable[[str], str],
+        max_keywords: int = 2,
+        max_results: int = 6
+    ):
+        self.search = search
+        self.normalize = normalize
+        self.max_keywords = max_keywords
+        self.max_results = max_results
+        self._tasks: Set[asyncio.Task] = set()
+        self.requests = 0
+        self.prefetched = 0
+        self.prefetch_errors = 0
+        self.used = 0
+        self.model_keywords = 0
+        self.rounds_with_hit = 0
+
+    def start(self, messages: List[Dict[str, Any]]) -> Set[Keyword]:
+        """根据对话发起预取，返回已预取的 (规范化关键词, max_results) 集合"""
+        keywords = derive_keywords(latest_user_text(messages), self.max_keywords)
+        if not keywords:
+            return set()
+
+        self.requests += 1
+        prefetched = set()
+        for keyword in keywords:
+            self.prefetched += 1
+            prefetched.add((self.normalize(keyword), self.max_results))
+            # 预取任务不随请求结束而取消，结果留在缓存中
+            task = asyncio.create_task(self._prefetch(keyword))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        logger.info(f"  推测性搜索预取: {keywords}")
+        return prefetched
+
+    async def _prefetch(self, keyword: str):
+        try:
+            await self.search([keyword], self.max_results)
+        except Exception as e:
+            self.prefetch_errors += 1
+            logger.debug(f"  推测性搜索预取失败: {str(e)}")
+
+    def observe(self, prefetched: Set[Keyword], requested: List[Keyword]) -> int:
+        """记录模型实际请求的搜索关键词，返回命中预取的个数"""
+        requested_keys = {(self.normalize(keyword), max_results) for keyword, max_results in requested}
+        hits = len(requested_keys & prefetched)
+        self.model_keywords += len(requested_keys)
+        self.used += hits
+        if hits:
+            self.rounds_with_hit += 1
+        # 已命中的不再重复计数
+        prefetched -= requested_keys
+        return hits
+
+    def stats(self) -> Dict[str, Any]:
+        """返回预取命中统计：hit_rate 为被使用的预取占比，coverage 为模型关键词被预取覆盖的占比"""
+        return {
+            "requests": self.requests,
+            "prefetched": self.prefetched,
+            "prefetch_errors": self.prefetch_errors,
+            "used": self.used,
+            "rounds_with_hit": self.rounds_with_hit,
+            "model_keywords": self.model_keywords,
+            "hit_rate": round(self.used / self.prefetched, 4) if self.prefetched else 0.0,
+            "coverage": round(self.used / self.model_keywords, 4) if self.model_keywords else 0.0,
+            "in_flight": len(self._tasks)
+        }
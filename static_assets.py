@@ -0,0 +1,202 @@
+"""
+静态资源的内存缓存：启动时一次性加载并预压缩，按 ETag 协商缓存
+
+- 目录下的每个文件在加载时计算强 ETag（内容哈希），并预先生成 gzip 和 brotli（安装了 brotli 包时）版本，
+  只保留比原文更小的压缩版本
+- 请求按 Accept-Encoding 选择 br > gzip > 原文，If-None-Match 命中时返回 304
+- 开发模式下后台任务定期检查文件修改时间，有变化时重新加载（不依赖额外的文件监听库）
+"""
+import asyncio
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+from typing import Dict, Optional, Tuple
+
+from fastapi import Request
+from fastapi.responses import Response
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - 取决于运行环境
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# 小于该字节数的文件不压缩（压缩收益抵不上 Content-Encoding 的开销）
+MIN_COMPRESS_SIZE = 512
+_COMPRESSIBLE_PREFIXES = ("text/", "application/javascript", "application/json", "application/xml", "image/svg+xml")
+
+
+class Asset:
+    """一个已加载的文件及其预压缩版本"""
+
+    __slots__ = ("path", "mtime", "content_type", "etag", "variants")
+
+    def __init__(self, path: str, mtime: float, content: bytes, content_type: str):
+        self.path = path
+        self.mtime = mtime
+        self.content_type = content_type
+        digest = hashlib.sha256(content).hexdigest()[:20]
+        self.etag = f'"{digest}"'
+        # Content-Encoding -> (内容, ETag)；同一资源的不同编码使用不同的强 ETag
+        self.variants: Dict[str, Tuple[bytes, str]] = {"identity": (content, self.etag)}
+        if len(content) >= MIN_COMPRESS_SIZE and content_type.startswith(_COMPRESSIBLE_PREFIXES):
+            gzipped = gzip.compress(content, compresslevel=9, mtime=0)
+            if len(gzipped) < len(content):
+                self.variants["gzip"] = (gzipped, f'"{digest}-gz"')
+            if brotli is not None:
+                compressed = brotli.compress(content, quality=11)
+                if len(compressed) < len(content):
+                    self.variants["br"] = (compressed, f'"{digest}-br"')
+
+    def matches(self, if_none_match: str) -> bool:
+        """If-None-Match 是否命中任意一个编码版本（按弱比较，忽略 W/ 前缀）"""
+        known = {etag for _, etag in self.variants.values()}
+        for tag in if_none_match.split(","):
+            tag = tag.strip()
+            if tag == "*" or (tag[2:] if tag.startswith("W/") else tag) in known:
+                return True
+        return False
+
+
+def accepted_encodings(accept_encoding: str) -> Dict[str, float]:
+    """解析 Accept-Encoding，返回 编码 -> q 值"""
+    accepted = {}
+    for item in accept_encoding.split(","):
+        parts = item.strip().split(";")
+        name = parts[0].strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        for param in parts[1:]:
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[name] = q
+    return accepted
+
+
+class AssetStore:
+    """目录下所有文件的内存缓存"""
+
+    def __init__(self, directory: str, max_age: int = 3600, dev_mode: bool = False, reload_interval: float = 1.0):
+        self.directory = os.path.abspath(directory)
+        self.max_age = max_age
+        self.dev_mode = dev_mode
+        self.reload_interval = reload_interval
+        self._assets: Dict[str, Asset] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.reloads = 0
+        self.not_modified = 0
+
+    def load(self) -> int:
+        """加载（或重新加载有变化的）文件，返回加载的文件数"""
+        found: Dict[str, Tuple[str, float]] = {}
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                full_path = os.path.join(root, name)
+                rel_path = os.path.relpath(full_path, self.directory).replace(os.sep, "/")
+                try:
+                    found[rel_path] = (full_path, os.stat(full_path).st_mtime)
+                except OSError:
+                    continue
+
+        loaded = 0
+        assets = dict(self._assets)
+        for rel_path, (full_path, mtime) in found.items():
+            existing = assets.get(rel_path)
+            if existing is not None and existing.mtime == mtime:
+                continue
+            try:
+                with open(full_path, "rb") as f:
+                    content = f.read()
+            except OSError as e:
+                logger.warning(f"加载静态文件失败 {rel_path}: {e}")
+                continue
+            # text/* 类型由 Starlette 自动追加 charset=utf-8
+            content_type = mimetypes.guess_type(rel_path)[0] or "application/octet-stream"
+            assets[rel_path] = Asset(rel_path, mtime, content, content_type)
+            loaded += 1
+        for rel_path in set(assets) - set(found):
+            del assets[rel_path]
+            loaded += 1
+        self._assets = assets
+        return loaded
+
+    def get(self, path: str) -> Optional[Asset]:
+        return self._assets.get(path)
+
+    def response(self, request: Request, path: str, cache_control: Optional[str] = None) -> Optional[Response]:
+        """按协商结果生成响应；文件不存在时返回 None"""
+        asset = self._assets.get(path)
+        if asset is None:
+            return None
+
+        if cache_control is None:
+            cache_control = f"public, max-age={self.max_age}"
+        if self.dev_mode:
+            cache_control = "no-cache"
+        headers = {"Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+
+        accepted = accepted_encodings(request.headers.get("accept-encoding", ""))
+        encoding = "identity"
+        for candidate in ("br", "gzip"):
+            if candidate in asset.variants and accepted.get(candidate, 0.0) > 0:
+                encoding = candidate
+                break
+        content, etag = asset.variants[encoding]
+        headers["ETag"] = etag
+
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match and asset.matches(if_none_match):
+            self.not_modified += 1
+            return Response(status_code=304, headers=headers)
+
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        if request.method == "HEAD":
+            headers["Content-Length"] = str(len(content))
+            return Response(status_code=200, headers=headers, media_type=asset.content_type)
+        return Response(content=content, headers=headers, media_type=asset.content_type)
+
+    def start(self):
+        """开发模式下启动文件变化检查任务"""
+        if self.dev_mode and self._task is None:
+            self._task = asyncio.create_task(self._watch())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            try:
+                changed = await asyncio.to_thread(self.load)
+            except Exception as e:
+                logger.warning(f"检查静态文件变化失败: {e}")
+                continue
+            if changed:
+                self.reloads += 1
+                logger.info(f"静态文件已重新加载: {changed} 个文件有变化")
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "files": len(self._assets),
+            "bytes": sum(len(a.variants["identity"][0]) for a in self._assets.values()),
+            "compressed_variants": sum(len(a.variants) - 1 for a in self._assets.values()),
+            "brotli": brotli is not None,
+            "dev_mode": self.dev_mode,
+            "reloads": self.reloads,
+            "not_modified": self.not_modified
+        }
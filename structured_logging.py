@@ -0,0 +1,162 @@
+"""
+结构化日志：JSON 行格式 + 后台线程写出 + 按事件采样
+
+- 根 logger 只挂一个 QueueHandler：事件循环里的日志调用只做采样判断并把 LogRecord 放入有界队列，
+  消息格式化（%s 参数展开）和 JSON 序列化都在 QueueListener 的后台线程中完成，
+  stdout 变慢时不会阻塞事件循环；队列满时直接丢弃并计数
+- 日志调用通过 extra={"event": "...", ...} 附带事件名和结构化字段，
+  LOG_SAMPLING（如 "tool_call=0.1,round=0.5"）按事件名配置采样率，未配置的事件全部保留，WARNING 及以上从不采样
+- context 回调在入队时执行（仍在调用方的上下文中），用于附带 trace_id 等请求上下文
+
+注意：参数在后台线程中才展开，传入的可变对象（列表、字典）在日志调用后不应再被修改。
+"""
+import atexit
+import contextvars
+import json
+import logging
+import queue
+import random
+import sys
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Callable, Dict, Optional
+
+# 当前请求是否开启详细日志（工具参数、搜索结果摘要、响应预览等）
+verbose_logging: contextvars.ContextVar[bool] = contextvars.ContextVar("verbose_logging", default=False)
+
+# LogRecord 的标准属性，其余属性视为通过 extra 传入的结构化字段
+_RESERVED = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName"}
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+class JsonFormatter(logging.Formatter):
+    """把 LogRecord 格式化为一行 JSON"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            "ts": self.formatTime(record, DATE_FORMAT) + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def parse_sampling(spec: str) -> Dict[str, float]:
+    """解析 "event=rate,event=rate" 形式的采样配置"""
+    rates = {}
+    for item in spec.split(","):
+        if "=" not in item:
+            continue
+        event, rate = item.split("=", 1)
+        try:
+            rates[event.strip()] = min(1.0, max(0.0, float(rate)))
+        except ValueError:
+            continue
+    return rates
+
+
+class EventSampler(logging.Filter):
+    """按 record.event 采样（在调用方线程执行，被丢弃的记录不会进入队列）"""
+
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        self.rates = rates
+        self.dropped = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        rate = self.rates.get(getattr(record, "event", None), 1.0)
+        if rate >= 1.0 or record.levelno >= logging.WARNING or random.random() < rate:
+            return True
+        self.dropped += 1
+        return False
+
+
+class _DeferredQueueHandler(QueueHandler):
+    """
+    不在调用方线程格式化的 QueueHandler
+
+    标准 QueueHandler.prepare() 会在入队前格式化消息，这里只附带上下文字段，
+    格式化留给 QueueListener 线程中的 handler。
+    """
+
+    def __init__(self, log_queue: queue.Queue, context: Optional[Callable[[], Dict[str, Any]]] = None):
+        super().__init__(log_queue)
+        self.context = context
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if self.context is not None:
+            for key, value in self.context().items():
+                if not hasattr(record, key):
+                    setattr(record, key, value)
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_listener: Optional[QueueListener] = None
+_queue_handler: Optional[_DeferredQueueHandler] = None
+_sampler: Optional[EventSampler] = None
+
+
+def setup_logging(
+    level: str = "INFO",
+    fmt: str = "json",
+    sampling: str = "",
+    queue_size: int = 10000,
+    context: Optional[Callable[[], Dict[str, Any]]] = None
+):
+    """
+    配置根 logger：QueueHandler -> 有界队列 -> 后台线程中的 stdout handler
+
+    fmt: "json" 输出 JSON 行，"text" 输出原有的文本格式
+    """
+    global _listener, _queue_handler, _sampler
+    shutdown_logging()
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter() if fmt == "json" else logging.Formatter(TEXT_FORMAT, DATE_FORMAT))
+
+    log_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+    _queue_handler = _DeferredQueueHandler(log_queue, context)
+    _sampler = EventSampler(parse_sampling(sampling))
+    _queue_handler.addFilter(_sampler)
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_queue_handler)
+    root.setLevel(level.upper())
+
+    _listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+
+def shutdown_logging():
+    """停止后台线程并写出队列中剩余的日志"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def stats() -> Dict[str, Any]:
+    """返回队列深度和丢弃计数"""
+    return {
+        "queue_depth": _queue_handler.queue.qsize() if _queue_handler else 0,
+        "dropped_queue_full": _queue_handler.dropped if _queue_handler else 0,
+        "dropped_sampled": _sampler.dropped if _sampler else 0,
+        "sampling": _sampler.rates if _sampler else {}
+    }
@@ -202,6 +202,74 @@ def test_multi_round_tool_calls():
     return response.status_code == 200
 
 
+def test_streaming():
+    """测试 stream: true 的 SSE 流式输出"""
+    print("\n" + "=" * 60)
+    print("测试 5: 流式输出（SSE）")
+    print("=" * 60)
+    
+    url = f"{BASE_URL}/v1/chat/completions"
+    payload = {
+        "model": "gpt-5",
+        "stream": True,
+        "messages": [
+            {"role": "user", "content": "最新的 Python FastAPI 版本是什么？"}
+        ]
+    }
+    
+    print(f"请求: {json.dumps(payload, indent=2, ensure_ascii=False)}")
+    print("\n发送请求...")
+    
+    start_time = time.time()
+    first_byte_time = None
+    progress_events = []
+    content_parts = []
+    finish_reason = None
+    done = False
+    
+    with requests.post(url, json=payload, stream=True) as response:
+        print(f"\n响应状态码: {response.status_code}")
+        if response.status_code != 200:
+            print(f"\n❌ 测试失败")
+            print(f"错误信息: {response.text}")
+            return False
+        
+        for line in response.iter_lines(decode_unicode=True):
+            if first_byte_time is None:
+                first_byte_time = time.time() - start_time
+            if not line or not line.startswith("data: "):
+                continue
+            data = line[len("data: "):]
+            if data == "[DONE]":
+                done = True
+                break
+            chunk = json.loads(data)
+            if "error" in chunk:
+                print(f"\n❌ 流中返回错误: {chunk['error']}")
+                return False
+            if "agentic" in chunk:
+                progress_events.append(chunk["agentic"])
+                print(f"  进度: {chunk['agentic']}")
+            choice = chunk["choices"][0]
+            content_parts.append(choice["delta"].get("content") or "")
+            if choice.get("finish_reason"):
+                finish_reason = choice["finish_reason"]
+    
+    elapsed_time = time.time() - start_time
+    print(f"\n首字节时间: {first_byte_time:.2f} 秒")
+    print(f"总响应时间: {elapsed_time:.2f} 秒")
+    print(f"进度事件数量: {len(progress_events)}")
+    print(f"finish_reason: {finish_reason}")
+    print(f"\n最终答案:")
+    print(f"  {''.join(content_parts)[:500]}")
+    
+    if done and finish_reason:
+        print("\n✅ 测试通过")
+        return True
+    print(f"\n❌ 测试失败: 流没有正常结束")
+    return False
+
+
 if __name__ == "__main__":
     print("开始测试 Agentic Loop 功能...")
     print("请确保 FastAPI 服务正在运行: uvicorn main:app --reload")
@@ -238,6 +306,13 @@ if __name__ == "__main__":
         print(f"\n❌ 测试异常: {e}")
         results.append(("多轮工具调用", False))
     
+    # 测试流式输出
+    try:
+        results.append(("流式输出", test_streaming()))
+    except Exception as e:
+        print(f"\n❌ 测试异常: {e}")
+        results.append(("流式输出", False))
+    
     # 总结
     print("\n" + "=" * 60)
     print("测试总结")
@@ -0,0 +1,62 @@
+"""
+测试 search 工具的关键词参数处理（进程内执行，不需要启动服务，也不会请求上游）
+运行: python test_search_keywords.py 或 pytest test_search_keywords.py
+"""
+import asyncio
+import os
+import sys
+
+os.environ.setdefault("AI_BUILDER_API_KEY", "test")
+
+import main
+
+
+def _run_search_tool(keywords):
+    """用记录关键词的假搜索函数执行 search 工具，返回 (工具结果, 请求过的关键词)"""
+    searched = []
+
+    async def fake_search_keyword(keyword, max_results, semaphore):
+        searched.append(keyword)
+        return {"queries": [{"keyword": keyword, "response": {"results": []}}], "combined_answer": keyword}
+
+    original = main._search_keyword
+    main._search_keyword = fake_search_keyword
+    try:
+        result = asyncio.run(main._search_tool_handler({"keywords": keywords}))
+    finally:
+        main._search_keyword = original
+    return result, searched
+
+
+def test_string_keyword_is_one_search():
+    """单个字符串作为一个关键词搜索，而不是按字符拆分"""
+    result, searched = _run_search_tool("fastapi")
+    assert searched == ["fastapi"]
+    assert "error" not in result
+
+
+def test_empty_keywords():
+    """空关键词列表返回明确的错误，不请求上游"""
+    result, searched = _run_search_tool([])
+    assert searched == []
+    assert result["error"] == "搜索失败: 没有提供搜索关键词"
+
+
+def test_invalid_keywords_type():
+    """非字符串 / 列表的关键词被拒绝"""
+    result, searched = _run_search_tool({"q": "fastapi"})
+    assert searched == []
+    assert "keywords 必须是字符串或字符串列表" in result["error"]
+
+
+if __name__ == "__main__":
+    tests = [test_string_keyword_is_one_search, test_empty_keywords, test_invalid_keywords_type]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+            print(f"✅ {test.__name__}")
+        except AssertionError as e:
+            failed += 1
+            print(f"❌ {test.__name__}: {e}")
+    sys.exit(1 if failed else 0)
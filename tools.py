@@ -0,0 +1,146 @@
+"""
+Agentic Loop 的工具注册表
+
+每个工具声明：
+- schema: OpenAI function calling 格式的工具定义
+- handler: async (arguments) -> 结果 dict，结果中带 "error" 字段表示失败
+- max_concurrency: 全局（跨请求）并发上限
+- timeout: 单次调用超时（包含排队等待并发名额的时间），超时返回错误结果而不是阻塞整轮
+- cacheable: 结果是否可按参数缓存（失败结果不缓存）
+- available: 可选，返回 False 时本轮不向模型提供该工具（例如依赖的上游正在熔断）
+"""
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import fastjson
+from cache import TTLCache
+from singleflight import canonical_key
+
+logger = logging.getLogger(__name__)
+
+ToolHandler = Callable[[Dict[str, Any]], Awaitable[Dict[str, Any]]]
+
+
+class Tool:
+    """一个可被 LLM 调用的工具"""
+
+    def __init__(
+        self,
+        schema: Dict[str, Any],
+        handler: ToolHandler,
+        max_concurrency: int = 8,
+        timeout: float = 30.0,
+        cacheable: bool = False,
+        cache_ttl: float = 300.0,
+        available: Optional[Callable[[], bool]] = None
+    ):
+        self.schema = schema
+        self.name = schema["function"]["name"]
+        self.handler = handler
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.cacheable = cacheable
+        self.available = available
+        self.cache = TTLCache(f"tool:{self.name}", max_size=256, ttl=cache_ttl, stale_ttl=0) if cacheable else None
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.calls = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.in_flight = 0
+
+
+class _ToolFailed(Exception):
+    """工具返回了错误结果（用于跳过缓存）"""
+
+    def __init__(self, result: Dict[str, Any]):
+        super().__init__(result.get("error"))
+        self.result = result
+
+
+class ToolRegistry:
+    """工具注册表：按名称分发工具调用，执行并发限制和超时"""
+
+    def __init__(self):
+        self._tools: Dict[str, Tool] = {}
+
+    def register(self, tool: Tool) -> Tool:
+        """注册工具，同名工具会被覆盖"""
+        self._tools[tool.name] = tool
+        return tool
+
+    def get(self, name: str) -> Optional[Tool]:
+        return self._tools.get(name)
+
+    def schemas(self, names: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        """返回当前可用的工具定义列表（用于上游请求的 tools 字段）"""
+        return [
+            tool.schema for name, tool in self._tools.items()
+            if (names is None or name in names) and (tool.available is None or tool.available())
+        ]
+
+    async def dispatch(self, tool_call: Dict[str, Any], timeout: Optional[float] = None) -> Dict[str, Any]:
+        """
+        执行一个 tool_call，任何失败（未知工具、参数错误、超时、异常）都转为错误结果
+
+        timeout 用于进一步收紧工具自身的超时（例如请求的剩余预算）。
+        """
+        function = tool_call.get("function", {})
+        name = function.get("name", "unknown")
+        tool = self._tools.get(name)
+        if tool is None:
+            return {"error": f"未知工具类型: {name}"}
+
+        try:
+            arguments = fastjson.loads(function.get("arguments") or "{}")
+        except ValueError as e:
+            return {"error": f"工具参数不是合法的 JSON: {str(e)}"}
+
+        tool.calls += 1
+        effective_timeout = tool.timeout if timeout is None else min(tool.timeout, timeout)
+        try:
+            result = await asyncio.wait_for(self._run(tool, arguments), timeout=effective_timeout)
+        except asyncio.TimeoutError:
+            tool.timeouts += 1
+            logger.warning(f"工具 {name} 执行超时（{effective_timeout:.1f} 秒）")
+            result = {"error": f"工具 {name} 执行超时（{effective_timeout:.1f} 秒）"}
+        except _ToolFailed as e:
+            result = e.result
+        except Exception as e:
+            logger.error(f"工具 {name} 执行失败: {str(e)}")
+            result = {"error": f"工具 {name} 执行失败: {str(e)}"}
+
+        if "error" in result:
+            tool.errors += 1
+        return result
+
+    async def _run(self, tool: Tool, arguments: Dict[str, Any]) -> Dict[str, Any]:
+        async def call():
+            async with tool._semaphore:
+                tool.in_flight += 1
+                try:
+                    result = await tool.handler(arguments)
+                finally:
+                    tool.in_flight -= 1
+            if tool.cache is not None and "error" in result:
+                raise _ToolFailed(result)
+            return result
+
+        if tool.cache is None:
+            return await call()
+        return await tool.cache.get_or_fetch(canonical_key(tool.name, arguments), call)
+
+    def stats(self) -> Dict[str, Any]:
+        """返回每个工具的调用统计"""
+        return {
+            name: {
+                "calls": tool.calls,
+                "errors": tool.errors,
+                "timeouts": tool.timeouts,
+                "in_flight": tool.in_flight,
+                "max_concurrency": tool.max_concurrency,
+                "timeout": tool.timeout,
+                "cacheable": tool.cacheable
+            }
+            for name, tool in self._tools.items()
+        }
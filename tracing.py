@@ -0,0 +1,282 @@
+"""
+轻量级 span 追踪：请求 / 轮次 / 上游调用 / 工具调用
+
+- 当前 span 保存在 contextvars 中，asyncio 任务创建时自动继承，
+  因此并行的工具调用和上游请求会挂在创建它们的轮次 span 下
+- 入站请求的 W3C traceparent 头会被沿用（trace_id 和采样决定），
+  出站请求通过 inject() 生成的 traceparent 头把上下文传给上游
+- 没有上游采样决定的新 trace 按 sample_rate 采样；未采样的 span 只用于传播上下文，不会被导出
+- 已采样的 span 结束时交给 TraceExporter：按 trace 保存在内存环形缓冲区中，
+  可选同时以 JSON lines 追加写入文件
+"""
+import contextvars
+import json
+import logging
+import random
+import re
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+_TRACEPARENT = re.compile(r"^([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+_INVALID_TRACE_ID = "0" * 32
+
+_current_span: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar("current_span", default=None)
+
+
+def _new_id(bits: int) -> str:
+    return f"{random.getrandbits(bits):0{bits // 4}x}"
+
+
+def parse_traceparent(value: Optional[str]):
+    """解析 traceparent 头，返回 (trace_id, parent_span_id, sampled)；格式不合法时返回 None"""
+    if not value:
+        return None
+    match = _TRACEPARENT.match(value.strip().lower())
+    if not match:
+        return None
+    version, trace_id, span_id, flags = match.groups()
+    if version == "ff" or trace_id == _INVALID_TRACE_ID or span_id == "0" * 16:
+        return None
+    return trace_id, span_id, bool(int(flags, 16) & 1)
+
+
+class Span:
+    """一段计时的操作，结束后（已采样时）交给导出器"""
+
+    __slots__ = (
+        "_exporter", "name", "trace_id", "span_id", "parent_id", "sampled",
+        "attributes", "events", "status", "status_message", "start_time", "_start", "duration"
+    )
+
+    def __init__(self, exporter: Optional["TraceExporter"], name: str, trace_id: str, parent_id: Optional[str], sampled: bool, attributes: Dict[str, Any]):
+        self._exporter = exporter
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = _new_id(64)
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.attributes = attributes
+        self.events: List[Dict[str, Any]] = []
+        self.status = "ok"
+        self.status_message: Optional[str] = None
+        self.start_time = time.time()
+        self._start = time.monotonic()
+        self.duration: Optional[float] = None
+
+    def set_attribute(self, key: str, value: Any):
+        if self.sampled:
+            self.attributes[key] = value
+
+    def add_event(self, name: str, **attributes: Any):
+        if self.sampled:
+            self.events.append({"name": name, "offset": round(time.monotonic() - self._start, 6), **attributes})
+
+    def set_status(self, status: str, message: Optional[str] = None):
+        self.status = status
+        self.status_message = message
+
+    def end(self):
+        """结束 span（重复调用无效）"""
+        if self.duration is not None:
+            return
+        self.duration = time.monotonic() - self._start
+        if self.sampled and self._exporter is not None:
+            self._exporter.export(self)
+
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start_time,
+            "duration": round(self.duration, 6) if self.duration is not None else None,
+            "status": self.status,
+            "status_message": self.status_message,
+            "attributes": self.attributes,
+            "events": self.events
+        }
+
+
+class TraceExporter:
+    """按 trace 保存最近 max_traces 个 trace 的 span，可选同时写入 JSON lines 文件"""
+
+    def __init__(self, max_traces: int = 200, path: Optional[str] = None):
+        self.max_traces = max_traces
+        self.path = path
+        self._traces: "OrderedDict[str, List[Dict[str, Any]]]" = OrderedDict()
+        self._file = None
+        self.exported = 0
+        self.write_errors = 0
+        if path:
+            try:
+                self._file = open(path, "a", encoding="utf-8")
+            except OSError as e:
+                logger.error(f"无法打开 trace 导出文件 {path}: {e}")
+
+    def export(self, span: Span):
+        record = span.to_dict()
+        spans = self._traces.get(span.trace_id)
+        if spans is None:
+            spans = self._traces[span.trace_id] = []
+            while len(self._traces) > self.max_traces:
+                self._traces.popitem(last=False)
+        else:
+            self._traces.move_to_end(span.trace_id)
+        spans.append(record)
+        self.exported += 1
+
+        if self._file is not None:
+            try:
+                self._file.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+                # 根 span 结束时整个 trace 已完成，刷新到磁盘
+                if span.parent_id is None:
+                    self._file.flush()
+            except OSError as e:
+                self.write_errors += 1
+                logger.warning(f"写入 trace 导出文件失败: {e}")
+
+    def get(self, trace_id: str) -> Optional[List[Dict[str, Any]]]:
+        """返回 trace 的所有 span（按开始时间排序）"""
+        spans = self._traces.get(trace_id)
+        if spans is None:
+            return None
+        return sorted(spans, key=lambda s: s["start"])
+
+    def recent(self, limit: int = 50) -> List[Dict[str, Any]]:
+        """返回最近的 trace 摘要（有根 span 的显示根 span 的名称和耗时）"""
+        summaries = []
+        for trace_id in reversed(list(self._traces.keys())[-limit:]):
+            spans = self._traces[trace_id]
+            root = next((s for s in spans if s["parent_id"] is None), None) or spans[0]
+            summaries.append({
+                "trace_id": trace_id,
+                "name": root["name"],
+                "start": root["start"],
+                "duration": root["duration"],
+                "status": root["status"],
+                "spans": len(spans)
+            })
+        return summaries
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "traces": len(self._traces),
+            "max_traces": self.max_traces,
+            "exported_spans": self.exported,
+            "path": self.path,
+            "write_errors": self.write_errors
+        }
+
+
+class Tracer:
+    """创建 span 并维护当前 span 上下文"""
+
+    def __init__(self, exporter: TraceExporter, sample_rate: float = 1.0, enabled: bool = True):
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+        self.enabled = enabled
+        self.traces_started = 0
+        self.traces_sampled = 0
+
+    @staticmethod
+    def current() -> Optional[Span]:
+        return _current_span.get()
+
+    def start_trace(self, name: str, traceparent: Optional[str] = None, **attributes: Any) -> Span:
+        """开始一个请求的根 span：沿用入站 traceparent，否则按 sample_rate 采样"""
+        parent = parse_traceparent(traceparent)
+        if parent is not None:
+            trace_id, parent_id, sampled = parent
+        else:
+            trace_id, parent_id = _new_id(128), None
+            sampled = random.random() < self.sample_rate
+        sampled = sampled and self.enabled
+        self.traces_started += 1
+        if sampled:
+            self.traces_sampled += 1
+        # 调用方的 span 不在本地缓冲区中，本地根 span 的 parent_id 保持为空，只在属性中记录
+        if parent_id is not None:
+            attributes["remote_parent_id"] = parent_id
+        return Span(self.exporter, name, trace_id, None, sampled, attributes)
+
+    def start_span(self, name: str, parent: Optional[Span] = None, **attributes: Any) -> Optional[Span]:
+        """在 parent（默认为当前 span）下创建子 span；不在任何 trace 中时返回 None"""
+        parent = parent or _current_span.get()
+        if parent is None:
+            return None
+        return Span(self.exporter, name, parent.trace_id, parent.span_id, parent.sampled, attributes if parent.sampled else {})
+
+    @contextmanager
+    def trace(self, name: str, traceparent: Optional[str] = None, **attributes: Any) -> Iterator[Span]:
+        """start_trace 的 with 形式：块内为当前 span，异常时标记为 error，退出时结束"""
+        span = self.start_trace(name, traceparent, **attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except Exception as e:
+            span.set_status("error", f"{type(e).__name__}: {e}")
+            raise
+        finally:
+            _current_span.reset(token)
+            span.end()
+
+    @contextmanager
+    def activate(self, span: Optional[Span]) -> Iterator[Optional[Span]]:
+        """在 with 块内把 span 设为当前 span（不负责结束 span）"""
+        token = _current_span.set(span)
+        try:
+            yield span
+        finally:
+            _current_span.reset(token)
+
+    @contextmanager
+    def span(self, name: str, **attributes: Any) -> Iterator[Span]:
+        """
+        在当前 span 下创建子 span 并在 with 块内设为当前 span，异常时标记为 error
+
+        不在任何 trace 中时 yield 一个不会被导出的 span，调用方无需判断。
+        """
+        span = self.start_span(name, **attributes)
+        if span is None:
+            yield Span(None, name, _INVALID_TRACE_ID, None, False, {})
+            return
+        token = _current_span.set(span)
+        try:
+            yield span
+        except Exception as e:
+            span.set_status("error", f"{type(e).__name__}: {e}")
+            raise
+        except BaseException:
+            span.set_status("cancelled")
+            raise
+        finally:
+            _current_span.reset(token)
+            span.end()
+
+    def inject(self) -> Dict[str, str]:
+        """返回传递给上游的 traceparent 头（不在 trace 中时为空）"""
+        span = _current_span.get()
+        return {"traceparent": span.traceparent()} if span is not None else {}
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "sample_rate": self.sample_rate,
+            "traces_started": self.traces_started,
+            "traces_sampled": self.traces_sampled,
+            **self.exporter.stats()
+        }